@@ -0,0 +1,183 @@
+import logging
+import math
+import time
+import pyserialoscframebuffer
+
+# Frames per second of an animation started without saying how fast
+DEFAULT_FPS = 30
+# Whoever sends to a device decides how much gets uploaded, so there is a limit to what is kept
+MAX_ANIMATIONS = 32
+MAX_FRAMES = 1024
+
+# -----------
+# What can be played. Each animation has a number of frames for a grid size,
+# and renders any of them as one level per led, row by row, as the application sees the grid
+# -----------
+
+
+class FrameSequence:
+  def __init__(self):
+    super().__init__()
+    self.frames = []
+
+  def add_frame(self, levels):
+    # False once the sequence is full
+    if (len(self.frames) >= MAX_FRAMES):
+      return False
+    self.frames.append(bytes(levels))
+    return True
+
+  def frame_count(self, width, height):
+    return len(self.frames)
+
+  def render(self, index, width, height):
+    return self.frames[index]
+
+
+class Fade:
+  def __init__(self, fromlevel, tolevel, frames):
+    super().__init__()
+    self.fromlevel = pyserialoscframebuffer.clamp_level(fromlevel)
+    self.tolevel = pyserialoscframebuffer.clamp_level(tolevel)
+    self.frames = max(int(frames), 1)
+
+  def frame_count(self, width, height):
+    return self.frames
+
+  def render(self, index, width, height):
+    level = self.tolevel
+    if (self.frames > 1):
+      level = round(self.fromlevel + (self.tolevel - self.fromlevel) * index / (self.frames - 1))
+    return bytes((level,)) * (width * height)
+
+
+class Ramp:
+  # From fromlevel in the leftmost column to tolevel in the rightmost, moving one column to the right each frame
+  def __init__(self, fromlevel, tolevel):
+    super().__init__()
+    self.fromlevel = pyserialoscframebuffer.clamp_level(fromlevel)
+    self.tolevel = pyserialoscframebuffer.clamp_level(tolevel)
+
+  def frame_count(self, width, height):
+    return max(width, 1)
+
+  def render(self, index, width, height):
+    if (width < 2):
+      return bytes((self.fromlevel,)) * (width * height)
+    row = bytes(round(self.fromlevel + (self.tolevel - self.fromlevel) * x / (width - 1)) for x in range(width))
+    shift = index % width
+    return (row[width - shift:] + row[0:width - shift]) * height
+
+
+class Scroll:
+  # A frame moved by dx and dy leds each frame, wrapping around at the edges
+  def __init__(self, levels, dx, dy):
+    super().__init__()
+    self.levels = bytes(levels)
+    self.dx = int(dx)
+    self.dy = int(dy)
+
+  def frame_count(self, width, height):
+    # Until it is back where it started
+    periodx, periody = scroll_period(width, self.dx), scroll_period(height, self.dy)
+    return periodx * periody // math.gcd(periodx, periody)
+
+  def render(self, index, width, height):
+    if (len(self.levels) != width * height):
+      # Left for the framebuffer to complain about
+      return self.levels
+    shiftx = self.dx * index % width
+    shifty = self.dy * index % height
+    levels = bytearray(width * height)
+    for y in range(height):
+      start = (y - shifty) % height * width
+      row = self.levels[start:start + width]
+      levels[y * width:(y + 1) * width] = row[width - shiftx:] + row[0:width - shiftx]
+    return levels
+
+
+def scroll_period(size, step):
+  if (size == 0 or step % size == 0):
+    return 1
+  return size // math.gcd(size, abs(step) % size)
+
+# -----------
+# Plays one animation at a time into a framebuffer. The frame follows the clock, not the calls to render,
+# so a skipped LED flush does not slow the animation down
+# -----------
+
+
+class AnimationPlayer:
+  def __init__(self):
+    super().__init__()
+    # Replaced as a whole on changes, so rendering needs no lock
+    self.animations = {}
+    # (name, animation, start time, frames per second, loop) or None
+    self.playing = None
+    self.__lastframe = (None, None)
+
+  def define(self, name, animation):
+    if (name not in self.animations and len(self.animations) >= MAX_ANIMATIONS):
+      logging.warning("Ignoring animation %s, there are already %s", name, MAX_ANIMATIONS)
+      return False
+    animations = dict(self.animations)
+    animations[name] = animation
+    self.animations = animations
+    return True
+
+  def add_frame(self, name, levels):
+    sequence = self.animations.get(name)
+    if (not isinstance(sequence, FrameSequence)):
+      sequence = FrameSequence()
+      if (not self.define(name, sequence)):
+        return
+    if (not sequence.add_frame(levels)):
+      logging.warning("Ignoring frame for animation %s, it already has %s", name, MAX_FRAMES)
+
+  def delete(self, name):
+    playing = self.playing
+    if (playing is not None and playing[0] == name):
+      self.stop()
+    animations = dict(self.animations)
+    animations.pop(name, None)
+    self.animations = animations
+
+  def start(self, name, fps=DEFAULT_FPS, loop=False):
+    animation = self.animations.get(name)
+    if (animation is None):
+      logging.warning("Cannot start unknown animation %s", name)
+      return False
+    if (fps <= 0):
+      logging.warning("Cannot start animation %s at %s frames per second", name, fps)
+      return False
+    self.playing = (name, animation, time.monotonic(), fps, loop)
+    return True
+
+  def stop(self):
+    # The leds keep showing the last frame
+    self.playing = None
+
+  def render(self, framebuffer, now=None):
+    # Returns the name of an animation that has just played to its end
+    playing = self.playing
+    if (playing is None):
+      return None
+    name, animation, starttime, fps, loop = playing
+    if (now is None):
+      now = time.monotonic()
+    width, height = framebuffer.appwidth, framebuffer.appheight
+    framecount = animation.frame_count(width, height)
+    if (framecount == 0):
+      return None
+    index = int((now - starttime) * fps)
+    finished = index >= framecount and not loop
+    index = framecount - 1 if finished else index % framecount
+    # Only a new frame goes into the framebuffer, leds set in between stay until then
+    if (self.__lastframe[0] is not playing or self.__lastframe[1] != index):
+      self.__lastframe = (playing, index)
+      framebuffer.set_frame_level(animation.render(index, width, height))
+    if (not finished):
+      return None
+    if (self.playing is playing):
+      self.playing = None
+    return name
@@ -0,0 +1,492 @@
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from threading import Event
+
+import pyserialoscd
+import pyserialoscserialadapter
+import pyserialoscprotocol
+import pyserialoscutils
+import pyserialoscdevice
+import pyserialoscengine
+import pyserialoscframebuffer
+import pyserialoscvirtualdevice
+from pythonosc.osc_message_builder import OscMessageBuilder
+
+# -----------
+# Stand-ins for the parts around the one being measured
+# -----------
+
+
+class KeyTimingSender:
+  def __init__(self):
+    super().__init__()
+    self.receivedkey = Event()
+    self.receivedat = 0
+    self.keybundlewindow = None
+    self.encoderdeltawindow = None
+
+  def begin_batch(self, timetag):
+    pass
+
+  def has_pending_deltas(self):
+    return False
+
+  def end_batch(self):
+    pass
+
+  def send_grid_key(self, x, y, state):
+    self.receivedat = time.perf_counter()
+    self.receivedkey.set()
+
+
+def percentile(sortedvalues, fraction):
+  return sortedvalues[min(int(len(sortedvalues) * fraction), len(sortedvalues) - 1)]
+
+
+def print_latencies(name, latencies):
+  latencies = sorted(latencies)
+  print("{:<28} mean {:8.3f}ms  p50 {:8.3f}ms  p90 {:8.3f}ms  p99 {:8.3f}ms  max {:8.3f}ms".format(
+      name, statistics.mean(latencies) * 1000, percentile(latencies, 0.5) * 1000,
+      percentile(latencies, 0.9) * 1000, percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+
+
+def open_receiver():
+  # Stands in for the application the device sends its osc to
+  receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+  receiver.bind(("127.0.0.1", 0))
+  receiver.settimeout(1)
+  return receiver
+
+
+def start_device(grid, destinationport, **deviceoptions):
+  device = pyserialoscdevice.SerialOscDeviceEndpoint(
+      grid.port, destinationport=destinationport, **deviceoptions)
+  if (not device.start("localhost", pyserialoscutils.find_free_port())):
+    raise RuntimeError("Could not start device for virtual grid at " + grid.port)
+  return device
+
+
+def wait_on_engine(seconds):
+  # With the asyncio engine nothing happens unless the loop runs
+  if (pyserialoscengine.is_asyncio()):
+    pyserialoscengine.loop.run_until_complete(asyncio.sleep(seconds))
+  else:
+    time.sleep(seconds)
+
+# -----------
+# Key press to osc send latency of the serial listener
+# -----------
+
+
+def benchmark_key_latency(readmode, iterations):
+  ptyport = pyserialoscvirtualdevice.PtyPort()
+  serialport = ptyport.open_serial()
+  sender = KeyTimingSender()
+  listener = pyserialoscserialadapter.SerialListener(
+      serialport, sender, readmode)
+  listener.start()
+
+  latencies = []
+  try:
+    for iteration in range(iterations):
+      sender.receivedkey.clear()
+      # Keys arrive at arbitrary points in time, not in step with the poll interval
+      time.sleep(0.001 * (iteration % 7))
+      sentat = time.perf_counter()
+      ptyport.write(b"\x21\x01\x02")
+      if (not sender.receivedkey.wait(1)):
+        logging.warning("Key event got lost in %s mode", readmode)
+        continue
+      latencies.append(sender.receivedat - sentat)
+  finally:
+    listener.stop()
+    serialport.close()
+    ptyport.close()
+
+  print_latencies("key latency ({})".format(readmode), latencies)
+  return latencies
+
+
+def benchmark_key_latency_modes(iterations):
+  for readmode in pyserialoscserialadapter.SerialListener.READ_MODES:
+    benchmark_key_latency(readmode, iterations)
+
+
+# -----------
+# Throughput of the serial frame parser for key events arriving in chunks
+# -----------
+
+
+def benchmark_frame_parser(iterations):
+  parser = pyserialoscprotocol.SerialFrameParser()
+  keyevents = [0]
+  def count_key(payload, offset):
+    keyevents[0] += 1
+  parser.register(0x20, count_key)
+  parser.register(0x21, count_key)
+
+  # Chunk sizes that do not line up with frame boundaries
+  data = b"\x21\x03\x04\x20\x03\x04" * 1000
+  chunks = [data[position:position + 61] for position in range(0, len(data), 61)]
+  starttime = time.perf_counter()
+  for _ in range(iterations):
+    for chunk in chunks:
+      parser.feed(chunk)
+  duration = time.perf_counter() - starttime
+  print("{:<28} {:12.0f} key events/s".format("frame parser", keyevents[0] / duration))
+
+
+# -----------
+# Osc messages per second with a new client per message and with pooled clients
+# -----------
+
+
+def benchmark_osc_clients(iterations):
+  receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  receiver.bind(("127.0.0.1", 0))
+  port = receiver.getsockname()[1]
+  messages = iterations * 50
+
+  try:
+    starttime = time.perf_counter()
+    for _ in range(messages):
+      pyserialoscutils.OscClientWrapper("localhost", port).send_message(
+          "/monome/grid/key", 1, 2, 1)
+    unpooled = messages / (time.perf_counter() - starttime)
+
+    starttime = time.perf_counter()
+    for _ in range(messages):
+      pyserialoscutils.get_osc_client("localhost", port).send_message(
+          "/monome/grid/key", 1, 2, 1)
+    pooled = messages / (time.perf_counter() - starttime)
+  finally:
+    pyserialoscutils.oscclientpool.invalidate("localhost", port)
+    receiver.close()
+
+  print("{:<28} {:12.0f} messages/s".format("osc client per message", unpooled))
+  print("{:<28} {:12.0f} messages/s".format("pooled osc client", pooled))
+
+
+# -----------
+# Incoming led messages per second through the route table and through pattern matching
+# -----------
+
+
+def benchmark_osc_routing(iterations):
+  device = pyserialoscdevice.SerialOscDeviceEndpoint("/dev/null")
+  device.framebuffer = pyserialoscframebuffer.LedFramebuffer(16, 8)
+  messages = iterations * 100
+
+  for (name, address) in (("routed led/set", "/monome/grid/led/set"),
+                          ("pattern matched led/set", "/monome/led/set")):
+    message = OscMessageBuilder(address)
+    for argument in (3, 4, 1):
+      message.add_arg(argument)
+    packet = message.build().dgram
+    starttime = time.perf_counter()
+    for _ in range(messages):
+      device.dispatcher.call_handlers_for_packet(packet, None)
+    print("{:<28} {:12.0f} messages/s".format(
+        name, messages / (time.perf_counter() - starttime)))
+
+
+# -----------
+# Bursts of led messages received by a device through each OSC ingress
+# -----------
+
+
+def benchmark_osc_ingress(iterations):
+  messages = [pyserialoscutils.build_message("/monome/grid/led/level/set", (x, y, (x + y) % 16)).dgram
+              for y in range(8) for x in range(16)]
+  sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  for oscingress in pyserialoscutils.OscServerWrapper.INGRESS_MODES:
+    grid = pyserialoscvirtualdevice.VirtualGrid()
+    grid.start()
+    device = start_device(grid, pyserialoscutils.find_free_port(), oscingress=oscingress)
+    try:
+      expected = 0
+      starttime = time.perf_counter()
+      for _ in range(iterations):
+        for message in messages:
+          sender.sendto(message, ("127.0.0.1", device.port))
+        expected += len(messages)
+        # One burst at a time, so the receive buffer does not overflow
+        deadline = time.perf_counter() + 1
+        while (device.metrics.oscin.counts.get("/monome/grid/led/level/set", 0) < expected
+               and time.perf_counter() < deadline):
+          time.sleep(0.0001)
+      duration = time.perf_counter() - starttime
+      received = device.metrics.oscin.counts.get("/monome/grid/led/level/set", 0)
+      print("{:<28} {:12.0f} messages/s {:8} lost".format(
+          "ingress " + oscingress, received / duration, expected - received))
+    finally:
+      device.stop()
+      grid.stop()
+  sender.close()
+
+
+# -----------
+# Led frame encoding, by concatenating bytes as it used to be done and with the preallocated encoder
+# -----------
+
+
+def encode_by_concatenation(opcode, header, values):
+  message = bytes([opcode])
+  for byte in header:
+    message += bytes([byte])
+  for value in values:
+    message += bytes([value])
+  return message
+
+
+LED_FRAMES = (
+    # name, encoder method, arguments, opcode, header bytes, payload
+    ("led off", pyserialoscprotocol.SerialFrameEncoder.add_led, (3, 4, 0), 0x10, (3, 4), ()),
+    ("led on", pyserialoscprotocol.SerialFrameEncoder.add_led, (3, 4, 1), 0x11, (3, 4), ()),
+    ("all off", pyserialoscprotocol.SerialFrameEncoder.add_all, (0,), 0x12, (), ()),
+    ("all on", pyserialoscprotocol.SerialFrameEncoder.add_all, (1,), 0x13, (), ()),
+    ("map", pyserialoscprotocol.SerialFrameEncoder.add_map, (0, 0, list(range(8))), 0x14, (0, 0), range(8)),
+    ("row", pyserialoscprotocol.SerialFrameEncoder.add_row, (0, 3, 255), 0x15, (0, 3, 255), ()),
+    ("col", pyserialoscprotocol.SerialFrameEncoder.add_col, (3, 0, 255), 0x16, (3, 0, 255), ()),
+    ("intensity", pyserialoscprotocol.SerialFrameEncoder.add_intensity, (9,), 0x17, (9,), ()),
+    ("led level", pyserialoscprotocol.SerialFrameEncoder.add_led_level, (3, 4, 9), 0x18, (3, 4, 9), ()),
+    ("all level", pyserialoscprotocol.SerialFrameEncoder.add_all_level, (9,), 0x19, (9,), ()),
+    ("map level", pyserialoscprotocol.SerialFrameEncoder.add_map_level,
+     (0, 0, bytes(range(16)) * 4), 0x1A, (0, 0), bytes(range(16)) * 4),
+    ("row level", pyserialoscprotocol.SerialFrameEncoder.add_row_level,
+     (0, 3, bytes(range(8))), 0x1B, (0, 3), bytes(range(8))),
+    ("col level", pyserialoscprotocol.SerialFrameEncoder.add_col_level,
+     (3, 0, bytes(range(8))), 0x1C, (3, 0), bytes(range(8))),
+)
+
+
+def benchmark_frame_encoders(iterations):
+  frames = iterations * 50
+  encoder = pyserialoscprotocol.SerialFrameEncoder()
+  for (name, encode, arguments, opcode, header, payload) in LED_FRAMES:
+    starttime = time.perf_counter()
+    for _ in range(frames):
+      encode_by_concatenation(opcode, header, payload)
+    concatenated = frames / (time.perf_counter() - starttime)
+
+    starttime = time.perf_counter()
+    for frame in range(frames):
+      # Batches of 64 frames per write
+      if (frame % 64 == 0):
+        encoder.reset()
+      encode(encoder, *arguments)
+    preallocated = frames / (time.perf_counter() - starttime)
+    print("{:<28} {:10.0f} frames/s concatenated {:10.0f} frames/s preallocated".format(
+        "encode " + name, concatenated, preallocated))
+
+
+# -----------
+# Key press on a virtual grid to osc arriving at the application, through the whole device
+# -----------
+
+
+def benchmark_end_to_end_latency(iterations):
+  grid = pyserialoscvirtualdevice.VirtualGrid()
+  grid.start()
+  receiver = open_receiver()
+  device = start_device(grid, receiver.getsockname()[1])
+
+  latencies = []
+  try:
+    for iteration in range(iterations):
+      time.sleep(0.001 * (iteration % 7))
+      x, y = iteration % grid.width, (iteration // grid.width) % grid.height
+      sentat = time.perf_counter()
+      if (iteration % 2):
+        grid.release(x, y)
+      else:
+        grid.press(x, y)
+      try:
+        receiver.recv(1024)
+      except socket.timeout:
+        logging.warning("Key event got lost on its way through the device")
+        continue
+      latencies.append(time.perf_counter() - sentat)
+  finally:
+    device.stop()
+    grid.stop()
+    receiver.close()
+
+  print_latencies("end-to-end key latency", latencies)
+  return latencies
+
+
+# -----------
+# Led messages per second going into a device and the serial bytes per second coming out of it
+# -----------
+
+
+def led_throughput_level(grid, message):
+  # Every pass over the grid shows the next step of a diagonal gradient
+  return (message + message // (grid.width * grid.height)) % 16
+
+
+def benchmark_led_throughput(iterations):
+  grid = pyserialoscvirtualdevice.VirtualGrid()
+  grid.start()
+  receiver = open_receiver()
+  device = start_device(grid, receiver.getsockname()[1])
+  client = pyserialoscutils.get_osc_client("localhost", device.port)
+  messages = iterations * 250
+
+  try:
+    # Whatever the device sends at startup does not count
+    time.sleep(0.1)
+    startbytes = grid.bytesreceived
+    starttime = time.perf_counter()
+    for message in range(messages):
+      client.send_message("/monome/grid/led/level/set",
+                          message % grid.width, (message // grid.width) % grid.height, led_throughput_level(grid, message))
+    sendduration = time.perf_counter() - starttime
+    # Give the last changes time to reach the grid
+    time.sleep(0.2)
+    duration = time.perf_counter() - starttime
+    serialbytes = grid.bytesreceived - startbytes
+    expected = bytearray(grid.width * grid.height)
+    for message in range(messages):
+      expected[(message // grid.width) % grid.height * grid.width + message % grid.width] = \
+          led_throughput_level(grid, message)
+    matching = sum(1 for (level, expectedlevel) in zip(grid.levels, expected) if level == expectedlevel)
+  finally:
+    device.stop()
+    grid.stop()
+    receiver.close()
+
+  print("{:<28} {:12.0f} messages/s in {:12.0f} serial bytes/s out, {}/{} leds as expected".format(
+      "led throughput", messages / sendduration, serialbytes / duration, matching, len(expected)))
+
+
+# -----------
+# How long it takes until a device is ready, alone and as part of a scan finding several at once
+# -----------
+
+
+def benchmark_startup(iterations):
+  startuptimes = []
+  for _ in range(max(1, iterations // 10)):
+    grid = pyserialoscvirtualdevice.VirtualGrid()
+    grid.start()
+    starttime = time.perf_counter()
+    device = start_device(grid, pyserialoscutils.find_free_port())
+    startuptimes.append(time.perf_counter() - starttime)
+    device.stop()
+    grid.stop()
+  print_latencies("device startup", startuptimes)
+
+  for silentports in (0, 1):
+    benchmark_detection(8, silentports)
+
+
+def benchmark_detection(count, silentports):
+  # Silent ports stand in for whatever else is connected and never answers
+  grids = [pyserialoscvirtualdevice.VirtualGrid(deviceid="v{:07d}".format(number)) for number in range(count)]
+  grids += [pyserialoscvirtualdevice.VirtualGrid(quirks=("noid",)) for _ in range(silentports)]
+  ports = [grid.start() for grid in grids]
+  serialosc = pyserialoscd.SerialOscMainEndpoint(deviceoptions={"probetimeout": 0.5})
+  serialosc.start("localhost", pyserialoscutils.find_free_port())
+  try:
+    starttime = time.perf_counter()
+    serialosc.detect_new_devices(ports)
+    duration = time.perf_counter() - starttime
+    print("{:<28} {:12.3f}ms for {} devices and {} silent ports".format(
+        "detect new devices", duration * 1000, len(serialosc.devices), silentports))
+  finally:
+    serialosc.stop()
+    for grid in grids:
+      grid.stop()
+
+
+# -----------
+# Cpu time the devices use, idle and with keys being pressed, for each engine and number of devices
+# -----------
+
+
+def start_virtual_grids(count, keyrate):
+  # The grids run in a process of their own, so their cpu time is not counted
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pyserialoscvirtualdevice.py")
+  gridprocess = subprocess.Popen([sys.executable, script, "--count", str(count), "--keyrate", str(keyrate)],
+                                 stdout=subprocess.PIPE, universal_newlines=True)
+  return gridprocess, [gridprocess.stdout.readline().strip() for _ in range(count)]
+
+
+def measure_device_cpu(count, keyrate, duration):
+  gridprocess, ports = start_virtual_grids(count, keyrate)
+  receiver = open_receiver()
+  devices = []
+  try:
+    for port in ports:
+      device = pyserialoscdevice.SerialOscDeviceEndpoint(
+          port, destinationport=receiver.getsockname()[1])
+      if (device.start("localhost", pyserialoscutils.find_free_port())):
+        devices.append(device)
+    wait_on_engine(0.5)
+    starttime = time.perf_counter()
+    startcpu = time.process_time()
+    wait_on_engine(duration)
+    return (time.process_time() - startcpu) / (time.perf_counter() - starttime) / count
+  finally:
+    for device in devices:
+      device.stop()
+    wait_on_engine(0.05)
+    gridprocess.terminate()
+    gridprocess.wait()
+    receiver.close()
+
+
+def benchmark_cpu_per_device(iterations):
+  duration = max(1, iterations / 100)
+  for engine in pyserialoscengine.ENGINES:
+    if (engine == "asyncio"):
+      loop = pyserialoscengine.use_asyncio()
+    try:
+      for count in (1, 8, 32):
+        idle = measure_device_cpu(count, 0, duration)
+        busy = measure_device_cpu(count, 50, duration)
+        print("{:<28} {:8.2f}% cpu idle {:8.2f}% cpu at 100 key events/s".format(
+            "{}, {} devices, each".format(engine, count), idle * 100, busy * 100))
+    finally:
+      if (engine == "asyncio"):
+        pyserialoscengine.loop = None
+        loop.close()
+
+
+BENCHMARKS = {
+    "keylatency": benchmark_key_latency_modes,
+    "frameparser": benchmark_frame_parser,
+    "oscclients": benchmark_osc_clients,
+    "oscrouting": benchmark_osc_routing,
+    "oscingress": benchmark_osc_ingress,
+    "encoders": benchmark_frame_encoders,
+    "endtoendlatency": benchmark_end_to_end_latency,
+    "ledthroughput": benchmark_led_throughput,
+    "startup": benchmark_startup,
+    "cpuperdevice": benchmark_cpu_per_device,
+}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.description = "Benchmarks for pyserialoscd, running against pseudo terminals and virtual grids instead of real devices (posix only)"
+  parser.add_argument("benchmarks", nargs="*",
+                      help="The benchmarks to run, all if none are given. One of: " + ", ".join(sorted(BENCHMARKS)))
+  parser.add_argument("--iterations", default=200, type=int,
+                      help="How often each measurement is repeated")
+  args = parser.parse_args()
+  for benchmark in args.benchmarks:
+    if (benchmark not in BENCHMARKS):
+      parser.error("Unknown benchmark: {}".format(benchmark))
+
+  for benchmark in (args.benchmarks or sorted(BENCHMARKS)):
+    BENCHMARKS[benchmark](args.iterations)
@@ -0,0 +1,65 @@
+import json
+import logging
+import os
+from threading import Lock
+
+CACHE_VERSION = 1
+
+# -----------
+# What we know about devices from last time, so they can be used right away after a restart
+# -----------
+
+
+class DeviceCache:
+  def __init__(self, path):
+    super().__init__()
+    self.path = path
+    # key from pyserialoscutils.serial_port_keys: id, type, size and the /sys settings of the device
+    self.__devices = {}
+    self.__lock = Lock()
+
+  def load(self):
+    try:
+      with open(self.path) as cachefile:
+        content = json.load(cachefile)
+    except FileNotFoundError:
+      return
+    except (OSError, ValueError) as e:
+      logging.warning("Ignoring device cache %s, could not read it: %s", self.path, e)
+      return
+    if (not isinstance(content, dict) or content.get("version") != CACHE_VERSION):
+      logging.warning("Ignoring device cache %s, it was written by another version", self.path)
+      return
+    with self.__lock:
+      self.__devices = content.get("devices", {})
+    logging.debug("Loaded %s devices from cache %s", len(self.__devices), self.path)
+
+  def get(self, key):
+    with self.__lock:
+      entry = self.__devices.get(key)
+      return None if entry is None else dict(entry)
+
+  def put(self, key, entry):
+    with self.__lock:
+      if (self.__devices.get(key) == entry):
+        return
+      self.__devices[key] = entry
+      self.__save()
+
+  def remove(self, key):
+    with self.__lock:
+      if (self.__devices.pop(key, None) is not None):
+        self.__save()
+
+  def __len__(self):
+    return len(self.__devices)
+
+  def __save(self):
+    # Written next to it and then renamed, so a crash never leaves half a file behind
+    temporarypath = self.path + ".tmp"
+    try:
+      with open(temporarypath, "w") as cachefile:
+        json.dump({"version": CACHE_VERSION, "devices": self.__devices}, cachefile, indent=1, sort_keys=True)
+      os.replace(temporarypath, self.path)
+    except OSError as e:
+      logging.warning("Could not write device cache %s: %s", self.path, e)
@@ -0,0 +1,241 @@
+import argparse
+import atexit
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+import time
+from threading import Lock
+
+# Set by enable() to capture into. While it is None capturing costs one global lookup per read, write or datagram
+capture = None
+
+# What a record holds
+SERIAL_IN = 0
+SERIAL_OUT = 1
+OSC_IN = 2
+OSC_OUT = 3
+# The name of a stream, before its first record. Streams are numbered from 0 in each session
+STREAM = 254
+# Starts every run of the daemon writing to the file, the payload is the wall clock time as text
+SESSION = 255
+KINDS = {SERIAL_IN: "serial in", SERIAL_OUT: "serial out", OSC_IN: "osc in",
+         OSC_OUT: "osc out", STREAM: "stream", SESSION: "session"}
+
+# Monotonic timestamp, stream number, kind and payload length, followed by the payload
+RECORD_HEADER = struct.Struct("<dHBI")
+MAGIC = b"PYSOCAP1"
+
+# -----------
+# Appends length prefixed records to a capture file, from any thread
+# -----------
+
+
+class CaptureWriter:
+  def __init__(self, path, buffersize=1 << 16):
+    super().__init__()
+    self.path = path
+    self.records = 0
+    self.__lock = Lock()
+    self.__streams = {}
+    self.__file = open(path, "ab", buffering=buffersize)
+    if (self.__file.tell() == 0):
+      self.__file.write(MAGIC)
+    self.__write_record(0, SESSION, time.strftime("%Y-%m-%dT%H:%M:%S").encode())
+
+  def record(self, streamname, kind, data):
+    with self.__lock:
+      if (self.__file is None):
+        return
+      stream = self.__streams.get(streamname)
+      if (stream is None):
+        stream = self.__streams[streamname] = len(self.__streams)
+        self.__write_record(stream, STREAM, streamname.encode())
+      self.__write_record(stream, kind, data)
+      self.records += 1
+
+  def __write_record(self, stream, kind, data):
+    self.__file.write(RECORD_HEADER.pack(time.monotonic(), stream, kind, len(data)))
+    self.__file.write(data)
+
+  def close(self):
+    with self.__lock:
+      if (self.__file is not None):
+        self.__file.close()
+        self.__file = None
+
+
+def enable(path):
+  global capture
+  capture = CaptureWriter(path)
+  # Whatever is still buffered gets written however the daemon stops
+  atexit.register(disable)
+  logging.info("Capturing serial and OSC traffic to %s", path)
+  return capture
+
+
+def disable():
+  global capture
+  if (capture is not None):
+    capture.close()
+    capture = None
+
+# -----------
+# Reads a capture file through a memory map, so even big captures are not read into memory
+# -----------
+
+
+def read_records(capturemap):
+  # Yields (timestamp, stream name, kind, payload) for every serial and OSC record, and a SESSION record
+  # for every new session. Payloads are memoryviews into the map, only valid while it is open
+  if (capturemap[0:len(MAGIC)] != MAGIC):
+    raise ValueError("Not a capture file")
+  view = memoryview(capturemap)
+  position = len(MAGIC)
+  end = len(capturemap)
+  streams = {}
+  while (position + RECORD_HEADER.size <= end):
+    timestamp, stream, kind, length = RECORD_HEADER.unpack_from(capturemap, position)
+    payloadstart = position + RECORD_HEADER.size
+    if (payloadstart + length > end):
+      # Cut off while being written
+      break
+    payload = view[payloadstart:payloadstart + length]
+    position = payloadstart + length
+    if (kind == SESSION):
+      streams = {}
+      yield (timestamp, "", kind, payload)
+    elif (kind == STREAM):
+      streams[stream] = bytes(payload).decode()
+    else:
+      yield (timestamp, streams.get(stream, str(stream)), kind, payload)
+
+
+def replay(records, send, speed=1.0):
+  # send is called with each record. speed 1 keeps the original timing, 0 goes as fast as possible
+  replayed = 0
+  starttime = None
+  for (timestamp, streamname, kind, payload) in records:
+    if (kind == SESSION):
+      # Timestamps of another session do not relate to the ones before
+      starttime = None
+      continue
+    if (speed > 0):
+      if (starttime is None):
+        starttime, firsttimestamp = time.monotonic(), timestamp
+      delay = starttime + (timestamp - firsttimestamp) / speed - time.monotonic()
+      if (delay > 0):
+        time.sleep(delay)
+    if (send(timestamp, streamname, kind, payload)):
+      replayed += 1
+  return replayed
+
+
+def summarize(records):
+  # (records, bytes, first and last timestamp) by stream name and kind
+  summary = {}
+  for (timestamp, streamname, kind, payload) in records:
+    if (kind == SESSION):
+      continue
+    count, size, first, last = summary.get((streamname, kind), (0, 0, timestamp, timestamp))
+    summary[(streamname, kind)] = (count + 1, size + len(payload), first, timestamp)
+  return summary
+
+
+def find_device_ports(host, port, timeout=0.5):
+  # Device id to OSC port of every device the running daemon has, from /serialosc/list
+  from pythonosc.osc_message import OscMessage
+  from pythonosc.osc_message_builder import OscMessageBuilder
+  receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  receiver.bind(("127.0.0.1", 0))
+  receiver.settimeout(timeout)
+  try:
+    request = OscMessageBuilder("/serialosc/list")
+    request.add_arg("127.0.0.1")
+    request.add_arg(receiver.getsockname()[1])
+    receiver.sendto(request.build().dgram, (host, port))
+    deviceports = {}
+    while (True):
+      try:
+        message = OscMessage(receiver.recv(4096))
+      except socket.timeout:
+        return deviceports
+      if (message.address == "/serialosc/device"):
+        deviceports[message.params[0]] = message.params[2]
+  finally:
+    receiver.close()
+
+
+# -----------
+# Main entry point, replays a capture against the daemon or a (virtual) device
+# -----------
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.description = "Replays a capture written by pyserialoscd --capture. By default the OSC messages the daemon got are sent to it again, with --serialport the bytes written to the devices are written to that port instead"
+  parser.add_argument("capturefile", help="The capture to replay")
+  parser.add_argument("--speed", default=1, type=float,
+                      help="1 replays with the original timing, 2 twice as fast, 0 as fast as possible")
+  parser.add_argument("--streams", nargs="*",
+                      help="Only replay these streams, e.g. osc:serialoscmain or serial:/dev/ttyACM0. --summary lists them")
+  parser.add_argument("--serialoschost", default="localhost",
+                      help="The host the daemon listens on")
+  parser.add_argument("--serialoscport", default=12002, type=int,
+                      help="The port the daemon listens on, devices are looked up through it")
+  parser.add_argument("--serialport",
+                      help="Write what was sent to the devices to this serial port, e.g. one printed by pyserialoscvirtualdevice.py")
+  parser.add_argument("--summary", action="store_true",
+                      help="Only print what is in the capture")
+  parser.add_argument("--loglevel", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                      default="WARNING", help="The output log level, e.g. ERROR, WARNING, INFO, DEBUG")
+  args = parser.parse_args()
+
+  logging.getLogger().setLevel(args.loglevel)
+
+  with open(args.capturefile, "rb") as capturefile:
+    if (os.fstat(capturefile.fileno()).st_size == 0):
+      parser.error("{} is empty".format(args.capturefile))
+    capturemap = mmap.mmap(capturefile.fileno(), 0, access=mmap.ACCESS_READ)
+
+  if (args.summary):
+    for ((streamname, kind), (count, size, first, last)) in sorted(summarize(read_records(capturemap)).items()):
+      print("{:<40} {:<10} {:8} records {:10} bytes {:10.3f} s".format(
+          streamname, KINDS[kind], count, size, last - first))
+    sys.exit(0)
+
+  streams = None if args.streams is None else set(args.streams)
+  host = "127.0.0.1" if args.serialoschost == "localhost" else args.serialoschost
+
+  if (args.serialport):
+    import serial
+    serialport = serial.Serial(args.serialport, 115200)
+
+    def send(timestamp, streamname, kind, payload):
+      if (kind != SERIAL_OUT or (streams is not None and streamname not in streams)):
+        return False
+      serialport.write(payload)
+      return True
+  else:
+    deviceports = find_device_ports(host, args.serialoscport)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    missing = set()
+
+    def send(timestamp, streamname, kind, payload):
+      if (kind != OSC_IN or (streams is not None and streamname not in streams)):
+        return False
+      name = streamname[len("osc:"):]
+      port = args.serialoscport if name == "serialoscmain" else deviceports.get(name)
+      if (port is None):
+        if (name not in missing):
+          missing.add(name)
+          logging.warning("Device %s is not known to the daemon, leaving out its messages", name)
+        return False
+      sender.sendto(payload, (host, port))
+      return True
+
+  starttime = time.perf_counter()
+  replayed = replay(read_records(capturemap), send, args.speed)
+  duration = time.perf_counter() - starttime
+  print("Replayed {} records in {:.3f} s".format(replayed, duration))
+  capturemap.close()
@@ -1,12 +1,22 @@
 import logging
 import signal
+import concurrent.futures
 import argparse
-import time
 import sys
+import os
+import time
 
 from pythonosc import dispatcher
 import pyserialoscutils
 import pyserialoscdevice
+import pyserialoscserialadapter
+import pyserialoscengine
+import pyserialoschotplug
+import pyserialoscmetrics
+import pyserialosccache
+import pyserialosctrace
+import pyserialosccapture
+import pyserialoscworker
 
 # -----------
 # The main serialoscd listener
@@ -14,24 +24,81 @@ import pyserialoscdevice
 
 
 class SerialOscMainEndpoint(pyserialoscutils.OscServerWrapper):
-  def __init__(self, onlytheseserialports=[], nottheseserialports=[]):
+  def __init__(self, onlytheseserialports=[], nottheseserialports=[], deviceoptions={}, maxprobes=8, devicecache=None, deviceworkers=0):
     super().__init__("serialoscmain")
     # Binding handling of incoming requests
     self.dispatcher.map("/serialosc/list", self.list_devices)
     self.dispatcher.map("/serialosc/notify", self.notify_next_change)
+    self.dispatcher.map("/serialosc/stats", self.send_stats)
+    self.dispatcher.map("/serialosc/trace", self.dump_trace)
     self.devices = []
     self.notifytargets = []
     self.onlytheseserialports = onlytheseserialports
     self.nottheseserialports = nottheseserialports
+    self.deviceoptions = deviceoptions
+    self.cachedserialports = None
+    self.metricsfilewriter = None
+    # Where /serialosc/trace and SIGUSR1 dump the trace buffer to, if tracing is on
+    self.tracefile = None
+    # Devices are probed in parallel, so one port that never answers does not hold up the others
+    self.probepool = concurrent.futures.ThreadPoolExecutor(maxprobes)
+    self.probing = {}
+    self.backoff = pyserialoscutils.PortBackoff()
+    # Devices found in the cache are started right away and checked while they already run
+    self.devicecache = devicecache
+    self.devicekeys = {}
+    self.validating = {}
+    # With deviceworkers set, devices run in that many worker processes rather than in this one
+    self.workerpool = None
+    if (deviceworkers > 0):
+      self.workerpool = pyserialoscworker.DeviceWorkerPool(deviceworkers, deviceoptions)
 
   def list_devices(self, requestpath, targethost, targetport):
     logging.debug("list requested via %s for %s:%s",
                   requestpath, targethost, targetport)
 
     for device in self.devices:
-      pyserialoscutils.OscClientWrapper(targethost, targetport).send_message(
+      pyserialoscutils.get_osc_client(targethost, targetport).send_message(
           "/serialosc/device", device.id, device.type, device.port)
 
+  def send_stats(self, requestpath, targethost, targetport):
+    logging.debug("stats requested via %s for %s:%s",
+                  requestpath, targethost, targetport)
+
+    # One message per value: device id, metric name, label values (like the address), value
+    client = pyserialoscutils.get_osc_client(targethost, targetport)
+    for (deviceid, samples) in self.collect_metrics():
+      for (name, labels, value) in samples:
+        client.send_message("/serialosc/stats", deviceid, name,
+                            *[labelvalue for (label, labelvalue) in labels], value)
+
+  def dump_trace(self, requestpath, targethost, targetport):
+    logging.debug("trace dump requested via %s for %s:%s",
+                  requestpath, targethost, targetport)
+    client = pyserialoscutils.get_osc_client(targethost, targetport)
+    if (pyserialosctrace.tracer is None or not self.tracefile):
+      logging.warning("Trace dump requested, but tracing is off. Start with --tracerecords to turn it on")
+      client.send_message("/serialosc/trace", "", 0)
+      return
+    try:
+      records = pyserialosctrace.tracer.dump(self.tracefile)
+    except OSError as e:
+      logging.warning("Could not dump trace to %s: %s", self.tracefile, e)
+      records = 0
+    # Where the dump went and how many records it has
+    client.send_message("/serialosc/trace", self.tracefile, records)
+
+  def collect_metrics(self):
+    return [(device.id, device.get_metrics()) for device in list(self.devices)]
+
+  def get_prometheus_text(self):
+    return pyserialoscmetrics.format_prometheus(self.collect_metrics())
+
+  def start_metrics_file(self, path, interval):
+    self.metricsfilewriter = pyserialoscmetrics.MetricsFileWriter(
+        path, interval, self.get_prometheus_text)
+    self.metricsfilewriter.start()
+
   def notify_next_change(self, requestpath, targethost, targetport):
     logging.debug("notification for next device requested via %s for %s:%s",
                   requestpath, targethost, targetport)
@@ -41,7 +108,7 @@ class SerialOscMainEndpoint(pyserialoscutils.OscServerWrapper):
     logging.debug("Registering device %s", device.id)
     self.devices.append(device)
     for notifytarget in self.notifytargets:
-      pyserialoscutils.OscClientWrapper(
+      pyserialoscutils.get_osc_client(
           notifytarget[0], notifytarget[1]).send_message("/serialosc/add", device.id)
     self.notifytargets = []
 
@@ -49,14 +116,23 @@ class SerialOscMainEndpoint(pyserialoscutils.OscServerWrapper):
     logging.debug("Unregistering device %s", device.id)
     self.devices.remove(device)
     for notifytarget in self.notifytargets:
-      pyserialoscutils.OscClientWrapper(
+      pyserialoscutils.get_osc_client(
           notifytarget[0], notifytarget[1]).send_message("/serialosc/remove", device.id)
     self.notifytargets = []
 
   def stop(self):
-    for device in self.devices:
+    if (self.metricsfilewriter is not None):
+      self.metricsfilewriter.stop()
+    self.probepool.shutdown(wait=True)
+    for (device, future) in list(self.probing.values()):
+      device.stop()
+    self.probing = {}
+    self.validating = {}
+    for device in list(self.devices):
       self.unregisterdevice(device)
       device.stop()
+    if (self.workerpool is not None):
+      self.workerpool.stop()
     super().stop()
 
   def get_device_serialportlist(self):
@@ -66,9 +142,26 @@ class SerialOscMainEndpoint(pyserialoscutils.OscServerWrapper):
 
     return resultlist
 
-  def remove_dead_devices(self):
-    for device in self.devices:
-      if (device.serialport not in pyserialoscutils.list_serial_ports()):
+  def update_devices(self, rescan=True):
+    # One enumeration of the serial ports per call at most, and none if nothing could have changed
+    if (rescan or self.cachedserialports is None):
+      self.cachedserialports = pyserialoscutils.list_serial_ports() + self.list_named_serial_ports()
+      self.backoff.forget_missing(self.cachedserialports)
+    self.remove_dead_devices(self.cachedserialports)
+    return self.detect_new_devices(self.cachedserialports)
+
+  def list_named_serial_ports(self):
+    # Ports asked for by name are used even if they are not enumerated, like the pseudo terminals of virtual grids
+    return [serialport for serialport in (self.onlytheseserialports or [])
+            if os.path.exists(serialport)]
+
+  def remove_dead_devices(self, currentports=None):
+    if (currentports is None):
+      currentports = pyserialoscutils.list_serial_ports()
+    goneports = set(self.get_device_serialportlist()).difference(currentports)
+
+    for device in list(self.devices):
+      if (device.serialport in goneports):
         logging.warning(
             "Device no longer listed as serial port: %s. Removing it", device.serialport)
         self.unregisterdevice(device)
@@ -78,30 +171,133 @@ class SerialOscMainEndpoint(pyserialoscutils.OscServerWrapper):
             "Detected dead device: %s. Removing it.", device.friendlyname)
         self.unregisterdevice(device)
 
-  def detect_new_devices(self):
-    currentports = pyserialoscutils.list_serial_ports()
+  def detect_new_devices(self, currentports=None):
+    # Returns False if a new port could not be opened or is still being probed, so it is worth trying again
+    if (currentports is None):
+      currentports = pyserialoscutils.list_serial_ports()
+    currentports = set(currentports)
 
     if (self.onlytheseserialports):
-      currentports = list(
-          set(currentports).intersection(self.onlytheseserialports))
+      currentports = currentports.intersection(self.onlytheseserialports)
     elif (self.nottheseserialports):
-      currentports = list(
-          set(currentports).difference(self.nottheseserialports))
-
-    for serialport in currentports:
-      if (serialport not in self.get_device_serialportlist()):
-        # Device
-        device = pyserialoscdevice.SerialOscDeviceEndpoint(
-            serialport, destinationport=pyserialoscutils.find_free_port())
-        logging.info("Detected new device: %s. Adding it. If it has just been plugged in, please wait a few seconds for it to initialize before pressing any buttons.", serialport)
-
-        devicehost = self.host
-        deviceport = pyserialoscutils.find_free_port()
-        if (device.start(devicehost, deviceport)):
-          serialosc.registerdevice(device)
-        else:
-          logging.error("Could not open device endpoint %s:%s at serialport %s, skipping",
-                        devicehost, deviceport, serialport)
+      currentports = currentports.difference(self.nottheseserialports)
+
+    newports = currentports.difference(self.get_device_serialportlist()).difference(self.probing)
+    newports = [serialport for serialport in sorted(newports) if not self.backoff.is_waiting(serialport)]
+    if (self.devicecache is not None and newports):
+      self.devicekeys.update(pyserialoscutils.serial_port_keys(newports))
+    for serialport in newports:
+      device = self.create_device(serialport)
+      if (self.start_cached_device(device)):
+        continue
+      logging.info("Detected new device: %s. Adding it. If it has just been plugged in, please wait a few seconds for it to initialize before pressing any buttons.", serialport)
+      future = self.probepool.submit(device.probe)
+      self.probing[serialport] = (device, future)
+      if (pyserialoscengine.is_asyncio()):
+        # The loop must not wait for the probes, so they get started once they are done
+        future.add_done_callback(
+            lambda future: pyserialoscengine.loop.call_soon_threadsafe(self.start_probed_devices))
+
+    allstarted = self.start_probed_devices()
+    if (not pyserialoscengine.is_asyncio() and self.probing):
+      # Every probe gives up after its timeout, the extra second is in case opening the port hangs as well.
+      # Devices get started as soon as their probe is done, without waiting for the slowest one
+      deadline = time.monotonic() + max(device.probetimeout for (device, future) in self.probing.values()) + 1
+      while (self.probing and time.monotonic() < deadline):
+        concurrent.futures.wait([future for (device, future) in self.probing.values()],
+                                timeout=deadline - time.monotonic(),
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+        allstarted = self.start_probed_devices() and allstarted
+    return allstarted and not self.probing
+
+  def create_device(self, serialport):
+    if (self.workerpool is not None):
+      return self.workerpool.create_device(serialport, pyserialoscutils.find_free_port())
+    return pyserialoscdevice.SerialOscDeviceEndpoint(
+        serialport, destinationport=pyserialoscutils.find_free_port(), **self.deviceoptions)
+
+  def start_cached_device(self, device):
+    cacheentry = None
+    if (self.devicecache is not None):
+      cacheentry = self.devicecache.get(self.devicekeys.get(device.serialport))
+    if (cacheentry is None):
+      return False
+    logging.info("Detected known device: %s. Adding it as %s from the cache", device.serialport, cacheentry["id"])
+    try:
+      started = device.start_from_cache(self.host, pyserialoscutils.find_free_port(), cacheentry)
+    except (KeyError, TypeError, IndexError) as e:
+      logging.warning("Ignoring cache entry for %s, Exception was %s", device.serialport, e)
+      started = False
+    if (not started):
+      device.stop()
+      return False
+    self.registerdevice(device)
+    device.onsettingschanged = self.remember_device
+    future = self.probepool.submit(device.validate)
+    self.validating[device.serialport] = (device, future)
+    if (pyserialoscengine.is_asyncio()):
+      future.add_done_callback(
+          lambda future: pyserialoscengine.loop.call_soon_threadsafe(self.finish_validations))
+    return True
+
+  def finish_validations(self):
+    for (serialport, (device, future)) in list(self.validating.items()):
+      if (not future.done()):
+        continue
+      del self.validating[serialport]
+      if (device not in self.devices):
+        continue
+      if (future.exception() is None and future.result()):
+        logging.debug("Device %s on %s is what the cache said", device.id, serialport)
+        continue
+      # Probed like any new device on the next look at the ports
+      logging.warning("Device on %s is not %s as cached, removing it to detect it again", serialport, device.id)
+      self.devicecache.remove(self.devicekeys.get(serialport))
+      self.unregisterdevice(device)
+      device.stop()
+
+  def remember_device(self, device):
+    if (self.devicecache is not None and device.serialport in self.devicekeys):
+      self.devicecache.put(self.devicekeys[device.serialport], device.get_cache_entry())
+
+  def apply_remembered_settings(self, device):
+    # A device the cache got wrong before still gets its settings back, as long as it is the same one
+    if (self.devicecache is None):
+      return
+    cacheentry = self.devicecache.get(self.devicekeys.get(device.serialport))
+    if (cacheentry is not None and cacheentry.get("id") == device.id):
+      try:
+        device.apply_settings(cacheentry)
+      except (KeyError, TypeError) as e:
+        logging.warning("Ignoring cached settings for %s, Exception was %s", device.serialport, e)
+
+  def start_probed_devices(self):
+    # Starting happens here rather than in the probe threads, as it needs the event loop
+    self.finish_validations()
+    allstarted = True
+    for (serialport, (device, future)) in list(self.probing.items()):
+      if (not future.done()):
+        continue
+      del self.probing[serialport]
+      if (future.exception() is not None or not future.result()):
+        logging.warning("No device found at serialport %s", serialport)
+        self.backoff.failed(serialport)
+        allstarted = False
+        continue
+
+      self.apply_remembered_settings(device)
+      devicehost = self.host
+      deviceport = pyserialoscutils.find_free_port()
+      if (device.start(devicehost, deviceport)):
+        self.backoff.succeeded(serialport)
+        self.registerdevice(device)
+        device.onsettingschanged = self.remember_device
+        self.remember_device(device)
+      else:
+        logging.error("Could not open device endpoint %s:%s at serialport %s, skipping",
+                      devicehost, deviceport, serialport)
+        allstarted = False
+    return allstarted
 
 # -----------
 # Cleanup
@@ -133,18 +329,91 @@ if __name__ == "__main__":
                       default="localhost", help="The ip/hostname for the main serialosc server to listen on")
   parser.add_argument("--serialoscport", default=12002, type=int,
                       help="The UDP port that main serialosc server will use.")
+  parser.add_argument("--ledfps", default=60, type=float,
+                      help="How many times per second changed LEDs are sent to each device.")
+  parser.add_argument("--serialbaudrate", default=115200, type=int,
+                      help="The baud rate of the serial ports. LED updates are sent less often, or without levels, when they would not fit through")
+  parser.add_argument("--writequeuedepth", default=256, type=int,
+                      help="How many pending serial commands are kept per device before the oldest LED commands are dropped. Queries and settings are never dropped")
+  parser.add_argument("--serialreadmode", choices=pyserialoscserialadapter.SerialListener.READ_MODES,
+                      default="blocking", help="Whether to wait for serial data to arrive (blocking) or to check for it every 20ms (poll)")
+  parser.add_argument("--keybundlewindow", type=float,
+                      help="If set, key events read within this many microseconds are sent as one OSC bundle, timetagged when they were read. 0 bundles what is read at once.")
+  parser.add_argument("--encoderdeltawindow", default=5000, type=float,
+                      help="Turns of an arc encoder within this many microseconds are summed up and sent as one /enc/delta. 0 sends every turn on its own")
+  parser.add_argument("--tiltrate", default=60, type=float,
+                      help="At most this many /tilt messages per second and sensor. 0 sends every value")
+  parser.add_argument("--tiltdeadband", default=0, type=int,
+                      help="Tilt values that differ by no more than this on every axis from the last one sent are left out")
+  parser.add_argument("--tiltsmoothing", default=0, type=float,
+                      help="Between 0 and 1: how much each tilt value is smoothed with the ones before it. 0 sends the values as they are")
+  parser.add_argument("--oscingress", choices=pyserialoscutils.OscServerWrapper.INGRESS_MODES, default="pythonosc",
+                      help="How devices receive OSC: one datagram at a time through pythonosc, or batched, taking everything waiting at once with a leaner decoder")
+  parser.add_argument("--deviceworkers", default=0, type=int,
+                      help="If set, devices run in up to this many worker processes, one per device as long as there are enough. A crashed worker is restarted without affecting the others. 0 runs them all in this process. Not with --engine asyncio")
+  parser.add_argument("--engine", choices=pyserialoscengine.ENGINES, default="threads",
+                      help="Whether every device and server runs in its own threads, or everything runs on one asyncio event loop (linux/macOS only)")
+  parser.add_argument("--hotplug", choices=("auto",) + pyserialoschotplug.METHODS, default="auto",
+                      help="How to notice devices being plugged in or out. auto uses inotify or netlink where available, poll looks for changes every second")
+  parser.add_argument("--probetimeout", default=2, type=float,
+                      help="How many seconds a device gets to say what it is. Ports without an answer are tried again later, waiting longer each time")
+  parser.add_argument("--cachefile", default=os.path.join(os.path.expanduser("~"), ".pyserialoscd-cache.json"),
+                      help="Where to remember devices and their /sys settings between runs, so known devices are available right away. An empty value turns this off")
+  parser.add_argument("--subscriptiontimeout", default=60, type=float,
+                      help="Seconds a /sys/subscribe lasts unless it is sent again. 0 keeps subscriptions until /sys/unsubscribe")
+  parser.add_argument("--metricsfile",
+                      help="If set, the metrics of all devices are written to this file in the prometheus text format, e.g. for the node exporter's textfile collector")
+  parser.add_argument("--metricsinterval", default=10, type=float,
+                      help="How many seconds to wait between writes of the metrics file")
+  parser.add_argument("--tracerecords", default=0, type=int,
+                      help="If set, the last this many LED commands and device events are kept in memory, to be written to --tracefile on /serialosc/trace or SIGUSR1. Costs nothing when not set")
+  parser.add_argument("--tracefile", default="pyserialoscd-trace.bin",
+                      help="Where trace dumps are written to. Print them with pyserialosctrace.py")
+  parser.add_argument("--capture",
+                      help="If set, all serial and OSC traffic is appended to this file, to be replayed with pyserialosccapture.py")
   parser.add_argument("--loglevel", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
                       default="INFO", help="The output log level, e.g. ERROR, WARNING, INFO, DEBUG")
   args = parser.parse_args()
 
   logging.getLogger().setLevel(args.loglevel)
 
+  if (args.engine == "asyncio"):
+    if (args.deviceworkers > 0):
+      # Starting a device in a worker waits for the worker to answer, which would hold up the whole loop
+      parser.error("--deviceworkers cannot be combined with --engine asyncio, the workers run their devices with threads")
+    if (os.name != "posix"):
+      parser.error("The asyncio engine needs serial ports that can be watched by the event loop, which is only possible on linux/macOS")
+    pyserialoscengine.use_asyncio()
+
   # Main server
   serialoschost = args.serialoschost
   serialoscport = args.serialoscport
 
+  deviceoptions = {"ledfps": args.ledfps,
+                   "writequeuedepth": args.writequeuedepth,
+                   "serialreadmode": args.serialreadmode,
+                   "keybundlewindow": None if args.keybundlewindow is None else args.keybundlewindow / 1000000,
+                   "probetimeout": args.probetimeout,
+                   "baudrate": args.serialbaudrate,
+                   "subscriptiontimeout": args.subscriptiontimeout,
+                   "encoderdeltawindow": args.encoderdeltawindow / 1000000 or None,
+                   "tiltrate": args.tiltrate,
+                   "tiltdeadband": args.tiltdeadband,
+                   "tiltsmoothing": args.tiltsmoothing,
+                   "oscingress": args.oscingress}
+
+  if (args.capture):
+    # Before anything is started, so the capture has everything from the first probe on
+    pyserialosccapture.enable(args.capture)
+
+  devicecache = None
+  if (args.cachefile):
+    devicecache = pyserialosccache.DeviceCache(args.cachefile)
+    devicecache.load()
+
   serialosc = SerialOscMainEndpoint(
-      args.onlytheseserialports, args.nottheseserialports)
+      args.onlytheseserialports, args.nottheseserialports, deviceoptions, devicecache=devicecache,
+      deviceworkers=args.deviceworkers)
   if (not serialosc.start(serialoschost, serialoscport)):
     logging.error("Could not start serialosc main server at %s:%s.\nMaybe the original serialoscd is running?\nYou can also specify a specific port using --serialoscport", serialoschost, serialoscport)
     sys.exit(1)
@@ -152,7 +421,37 @@ if __name__ == "__main__":
   print("pyserialoscd is now listening at {}:{}".format(
       serialoschost, serialoscport))
   print("Press CTRL-C to stop (if that does not work for some reason please kill python)")
+
+  if (args.metricsfile):
+    serialosc.start_metrics_file(args.metricsfile, args.metricsinterval)
+
+  if (args.tracerecords > 0):
+    tracer = pyserialosctrace.enable(args.tracerecords)
+    serialosc.tracefile = args.tracefile
+    if (hasattr(signal, "SIGUSR1")):
+      signal.signal(signal.SIGUSR1, lambda signalnumber, frame: tracer.dump(args.tracefile))
+
+  hotplug = pyserialoschotplug.HotplugMonitor(
+      pyserialoschotplug.METHODS if args.hotplug == "auto" else [args.hotplug])
+  hotplug.start()
+  # Ports that failed to open and freshly plugged devices get another look on the next tick
+  rescan = [True]
+
+  def check_devices(changed=False):
+    rescannow = rescan[0] or changed or not hotplug.is_event_driven()
+    allstarted = serialosc.update_devices(rescannow)
+    rescan[0] = changed or not allstarted
+
+  if (pyserialoscengine.is_asyncio()):
+    if (hotplug.is_event_driven()):
+      def on_hotplug():
+        if (hotplug.drain()):
+          pyserialoscengine.loop.call_later(
+              hotplug.settletime, check_devices, True)
+      pyserialoscengine.loop.add_reader(hotplug.fileno(), on_hotplug)
+    pyserialoscengine.run_forever(1, check_devices, serialosc.stop)
+    sys.exit(0)
+
+  check_devices()
   while True:
-    serialosc.detect_new_devices()
-    serialosc.remove_dead_devices()
-    time.sleep(1)
+    check_devices(hotplug.wait(1))
@@ -3,6 +3,9 @@ from pythonosc import dispatcher
 import pyserialoscutils
 import pyserialoscsender
 import pyserialoscserialadapter
+import pyserialoscframebuffer
+import pyserialoscmetrics
+import pyserialoscanimation
 
 # -----------
 # Each device will be represented by one endpoint
@@ -10,136 +13,416 @@ import pyserialoscserialadapter
 
 
 class SerialOscDeviceEndpoint(pyserialoscutils.OscServerWrapper):
-  def __init__(self, serialport, messageprefix="/monome", destinationhost="localhost", destinationport=12222):
-    super().__init__("unknown")
+  def __init__(self, serialport, messageprefix="/monome", destinationhost="localhost", destinationport=12222, ledfps=60, writequeuedepth=256, serialreadmode="blocking", keybundlewindow=None, probetimeout=2, baudrate=115200, subscriptiontimeout=60, encoderdeltawindow=None, tiltrate=60, tiltdeadband=0, tiltsmoothing=0, oscingress="pythonosc"):
+    super().__init__("unknown", oscingress)
     self.messageprefix = messageprefix
     self.dispatcher.map("/sys/host", self.set_destination_host)
     self.dispatcher.map("/sys/port", self.set_destination_port)
     self.dispatcher.map("/sys/prefix", self.set_message_prefix)
     self.dispatcher.map("/sys/rotation", self.set_rotation)
+    self.dispatcher.map("/sys/subscribe", self.subscribe)
+    self.dispatcher.map("/sys/unsubscribe", self.unsubscribe)
     self.dispatcher.map("/info", self.get_info)
     self.dispatcher.map("/sys/info", self.get_info)
     self.serialport = serialport
+    self.metrics = pyserialoscmetrics.DeviceMetrics()
+    self.dispatcher.addresscounter = self.metrics.oscin
     self.__messagesender = pyserialoscsender.SerialOscDeviceMessageSender(
-      self.messageprefix, destinationhost, destinationport)
+      self.messageprefix, destinationhost, destinationport, keybundlewindow, self.metrics, subscriptiontimeout,
+      encoderdeltawindow, pyserialoscsender.TiltDecimator(tiltrate, tiltdeadband, tiltsmoothing))
     self.__serialadapter = pyserialoscserialadapter.SerialAdapter(
-      serialport, self.__messagesender)
+      serialport, self.__messagesender, writequeuedepth, serialreadmode, self.metrics, baudrate)
+    self.__messagesender.traceindex = self.__serialadapter.traceindex
     self.id = "unknown"
     self.type = "unknown"
     self.size = [0, 0]
     self.rotation = 0
+    self.framebuffer = None
+    # Rings of an arc, none for a grid
+    self.rings = 0
+    self.ringbuffer = None
+    # How many seconds the device gets to answer what it is
+    self.probetimeout = probetimeout
+    self.probed = False
+    # Called with the device whenever a /sys setting changes, so it can be remembered
+    self.onsettingschanged = None
+    self.__ledflusher = pyserialoscframebuffer.LedFlusher(
+      self.flush_leds, ledfps)
+    self.__ledpacer = pyserialoscframebuffer.LedPacer(ledfps)
+    # Quads last sent without their levels, sent again once there is room
+    self.__degradedquads = set()
+    # Animations uploaded by the application, rendered on every LED flush
+    self.animations = pyserialoscanimation.AnimationPlayer()
+    # led messages by address below the prefix, with the fewest arguments they need
+    self.__routes = [
+      (address, pyserialoscutils.OscRoute(handler, minarguments))
+      for (address, handler, minarguments) in (
+        ("/grid/led/set", self.set_led, 3),
+        ("/grid/led/all", self.set_led_all, 1),
+        ("/grid/led/map", self.set_led_map, 3),
+        ("/grid/led/row", self.set_led_row, 3),
+        ("/grid/led/col", self.set_led_col, 3),
+        ("/grid/led/intensity", self.set_led_intensity, 1),
+        ("/grid/led/level/set", self.set_led_level, 3),
+        ("/grid/led/level/all", self.set_led_level_all, 1),
+        ("/grid/led/level/map", self.set_led_level_map, 3),
+        ("/grid/led/level/row", self.set_led_level_row, 3),
+        ("/grid/led/level/col", self.set_led_level_col, 3))]
+    self.__routes.append(("/grid/led/level/frame", pyserialoscutils.OscRoute(
+      self.set_led_level_frame, 1, pyserialoscutils.OscRoute.BLOB_TYPES)))
+    self.__routes += [
+      (address, pyserialoscutils.OscRoute(handler, minarguments))
+      for (address, handler, minarguments) in (
+        ("/ring/set", self.set_ring_led, 3),
+        ("/ring/all", self.set_ring_all, 2),
+        ("/ring/map", self.set_ring_map, 2),
+        ("/ring/range", self.set_ring_range, 4),
+        ("/tilt/set", self.set_tilt, 2))]
+    # Animations are named, a scroll also names the animation it scrolls. Everything after the names is numbers,
+    # only frames can also come as a blob
+    nametypes = pyserialoscutils.OscRoute.NAME_TYPES
+    self.__routes.append(("/anim/frame", pyserialoscutils.OscRoute(
+      self.add_animation_frame, 2,
+      pyserialoscutils.OscRoute.BLOB_TYPES + pyserialoscutils.OscRoute.NUMBER_TYPES, (nametypes,))))
+    self.__routes += [
+      (address, pyserialoscutils.OscRoute(
+        handler, minarguments, pyserialoscutils.OscRoute.NUMBER_TYPES, (nametypes,) * names))
+      for (address, handler, minarguments, names) in (
+        ("/anim/fade", self.define_animation_fade, 4, 1),
+        ("/anim/ramp", self.define_animation_ramp, 3, 1),
+        ("/anim/scroll", self.define_animation_scroll, 3, 2),
+        ("/anim/delete", self.delete_animation, 1, 1),
+        ("/anim/start", self.start_animation, 1, 1),
+        ("/anim/loop", self.loop_animation, 1, 1),
+        ("/anim/stop", self.stop_animation, 0, 0))]
+    self.compile_routes()
 
   def is_alive(self):
     return self.__serialadapter.is_alive()
 
-  def start(self, ip, port):
+  def get_write_queue_stats(self):
+    return self.__serialadapter.get_write_queue_stats()
+
+  def get_metrics(self):
+    queuedepth, droppedcommands, mergedcommands = self.get_write_queue_stats()
+    targetfps, effectivefps, backlog, skippedframes, degradedframes = self.get_led_output_stats()
+    return self.metrics.samples(self.__serialadapter.get_parser_resyncs(),
+                                droppedcommands, mergedcommands, queuedepth,
+                                effectivefps, backlog, skippedframes, degradedframes)
+
+  def probe(self):
+    # Opens the port and asks the device what it is. Does not need the event loop, so it can run in any thread
+    if (not self.__serialadapter.start()):
+      return False
+    if (not self.update_device_metadata()):
+      self.__serialadapter.stop()
+      return False
+    self.probed = True
+    return True
+
+  def start_from_cache(self, ip, port, cacheentry):
+    # Trusts what the cache says about the device, validate() checks it once the device is running
     if (not self.__serialadapter.start()):
       return False
-    self.update_device_metadata()
-    return super().start(ip, port)
+    self.set_device_metadata(cacheentry["id"], cacheentry["type"], cacheentry["size"],
+                             cacheentry.get("rings", 0))
+    self.apply_settings(cacheentry)
+    self.probed = True
+    return self.start(ip, port)
+
+  def validate(self):
+    # True if the device still says what we think it is. Blocks, so better not called on the event loop
+    devicemetadata = self.__serialadapter.query_device_metadata(self.probetimeout)
+    return (devicemetadata is not None and devicemetadata[0] == self.id
+            and list(devicemetadata[2]) == self.size)
+
+  def start(self, ip, port):
+    if (not self.probed and not self.probe()):
+      return False
+    self.__serialadapter.start_listening()
+    self.__ledflusher.start()
+    if (not super().start(ip, port)):
+      self.__ledflusher.stop()
+      self.__serialadapter.stop()
+      self.probed = False
+      return False
+    return True
 
   def stop(self):
+    self.__ledflusher.stop()
     self.__serialadapter.stop()
+    self.probed = False
     super().stop()
 
   def update_device_metadata(self):
-    devicemetadata = self.__serialadapter.get_device_metadata()
-    self.id = devicemetadata[0]
+    devicemetadata = self.__serialadapter.get_device_metadata(self.probetimeout)
+    if (devicemetadata is None):
+      return False
+    devicetype, devicecount = devicemetadata[1]
+    self.set_device_metadata(devicemetadata[0], devicetype, devicemetadata[2],
+                             devicecount if devicetype == "encoder" else 0)
+    return True
+
+  def set_device_metadata(self, deviceid, devicetype, size, rings=0):
+    self.id = deviceid
     self.friendlyname = self.id
-    self.type = devicemetadata[1][0]
-    self.size = [devicemetadata[2][0], devicemetadata[2][1]]
+    self.type = devicetype
+    self.size = [size[0], size[1]]
+    self.framebuffer = pyserialoscframebuffer.LedFramebuffer(
+      self.size[0], self.size[1])
+    self.framebuffer.set_rotation(self.rotation)
+    self.rings = rings
+    self.ringbuffer = pyserialoscframebuffer.RingFramebuffer(rings)
+
+  def get_cache_entry(self):
+    return {"id": self.id, "type": self.type, "size": list(self.size), "rings": self.rings,
+            "prefix": self.messageprefix, "rotation": self.rotation,
+            "destinationhost": self.__messagesender.destinationhost,
+            "destinationport": self.__messagesender.destinationport}
+
+  def apply_settings(self, settings):
+    # settings as in get_cache_entry, the metadata has to be known already for the rotation
+    self.__messagesender.set_destination(
+      settings["destinationhost"], settings["destinationport"])
+    self.set_message_prefix("/sys/prefix", settings["prefix"])
+    self.set_rotation("/sys/rotation", settings["rotation"])
+
+  def settings_changed(self):
+    if (self.onsettingschanged is not None):
+      self.onsettingschanged(self)
+
+  def flush_leds(self):
+    if (self.__ledpacer.should_skip(self.__serialadapter.get_output_backlog())):
+      return
+    finishedanimation = self.animations.render(self.framebuffer)
+    if (finishedanimation is not None):
+      self.__messagesender.send_prefix_message_to_destination("/anim/done", finishedanimation)
+    changedquads = [(offsetx, offsety, levels, pyserialoscframebuffer.is_mono_quad(levels))
+                    for (offsetx, offsety, levels) in self.framebuffer.pop_changed_quads()]
+    framebytes = sum(pyserialoscframebuffer.MAP_FRAME_BYTES if mono else pyserialoscframebuffer.MAP_LEVEL_FRAME_BYTES
+                     for (offsetx, offsety, levels, mono) in changedquads)
+    # Even at the lowest frame rate this does not fit through the link, so levels are left out
+    degrade = framebytes > self.__serialadapter.get_output_budget(self.__ledpacer.mininterval)
+    for (offsetx, offsety, levels, mono) in changedquads:
+      if (mono):
+        self.__serialadapter.set_grid_led_map(
+          offsetx, offsety, pyserialoscframebuffer.levels_to_bitmaps(levels))
+        self.__degradedquads.discard((offsetx, offsety))
+      elif (degrade):
+        self.__serialadapter.set_grid_led_map(
+          offsetx, offsety, pyserialoscframebuffer.levels_to_bitmaps(levels, pyserialoscframebuffer.HALF_LEVEL))
+        self.__degradedquads.add((offsetx, offsety))
+      else:
+        self.__serialadapter.set_grid_led_map_level(offsetx, offsety, levels)
+        self.__degradedquads.discard((offsetx, offsety))
+    if (not degrade and self.__degradedquads and len(self.__degradedquads) * pyserialoscframebuffer.MAP_LEVEL_FRAME_BYTES
+        <= self.__serialadapter.get_output_budget(self.__ledpacer.mininterval)):
+      self.framebuffer.resend_quads(self.__degradedquads)
+      self.__degradedquads.clear()
+    for (ring, levels) in self.ringbuffer.pop_changed_rings():
+      if (levels.count(levels[0]) == len(levels)):
+        self.__serialadapter.set_ring_all_level(ring, levels[0])
+      else:
+        self.__serialadapter.set_ring_map_level(ring, levels)
+    self.__ledpacer.frame_sent(degrade)
+
+  def get_led_output_stats(self):
+    # Target and effective frames per second, seconds of output the serial link is behind, skipped and degraded frames
+    return (1.0 / self.__ledpacer.interval, self.__ledpacer.effective_fps(),
+            self.__serialadapter.get_output_backlog(),
+            self.__ledpacer.skippedframes, self.__ledpacer.degradedframes)
 
   # receiving messages for the endpoint
   def set_destination_port(self, requestpath, newport):
     logging.debug(
       "new destination port for device %s requested - %s", self.id, newport)
-    self.__messagesender.destinationport = newport
+    self.__messagesender.set_destination(
+      self.__messagesender.destinationhost, newport)
+    self.settings_changed()
 
   def set_destination_host(self, requestpath, newhost):
     logging.debug("new host for device %s requested - %s",
             self.id, newhost)
-    self.__messagesender.destinationhost = newhost
+    self.__messagesender.set_destination(
+      newhost, self.__messagesender.destinationport)
+    self.settings_changed()
 
   def set_message_prefix(self, requestpath, newmessageprefix):
     logging.debug("new message prefix for device %s requested - %s",
             self.id, newmessageprefix)
     self.messageprefix = newmessageprefix
     self.__messagesender.messageprefix = newmessageprefix
+    self.compile_routes()
+    self.settings_changed()
 
   def set_rotation(self, requestpath, newrotation):
     logging.debug("new rotation for device %s requested - %s",
             self.id, newrotation)
+    if (newrotation not in pyserialoscutils.ROTATIONS):
+      logging.error(
+        "Only rotations in increments of 90 are allowed (i.e. 0, 90, 180, 270). Got %s. Ignoring rotation.", newrotation)
+      return
     self.rotation = newrotation
+    self.framebuffer.set_rotation(newrotation)
+    self.__serialadapter.set_rotation(pyserialoscutils.rotation_tables(
+      self.size[0], self.size[1], newrotation))
+    self.settings_changed()
+
+  def subscribe(self, requestpath, host, port, prefix=None):
+    logging.debug("subscription of %s:%s with prefix %s to device %s requested",
+            host, port, prefix, self.id)
+    self.__messagesender.subscribe(host, port, prefix)
+
+  def unsubscribe(self, requestpath, host, port):
+    logging.debug("end of subscription of %s:%s to device %s requested",
+            host, port, self.id)
+    self.__messagesender.unsubscribe(host, port)
+
+  def get_rotated_size(self):
+    if (self.rotation in (90, 270)):
+      return [self.size[1], self.size[0]]
+    return self.size
 
   def get_info(self, requestpath, destinationhost="", destinationport=""):
     logging.debug("info requested for device %s to targethost %s and targetport %s",
             self.id, destinationhost, destinationport)
+    rotatedsize = self.get_rotated_size()
     self.__messagesender.send_info(
-      self.id, self.size[0], self.size[1], self.rotation, destinationhost, destinationport)
+      self.id, rotatedsize[0], rotatedsize[1], self.rotation, destinationhost, destinationport)
 
   # receiving messages for the device
+  def compile_routes(self):
+    self.dispatcher.set_routes({self.messageprefix + address: route
+                                for (address, route) in self.__routes})
+    # For the batched ingress: grid led messages, and those among them that set every led
+    self.__gridledaddresses = frozenset(self.messageprefix + address for (address, route) in self.__routes
+                                        if address.startswith("/grid/led/") and address != "/grid/led/intensity")
+    self.__allgridledaddresses = frozenset(self.messageprefix + address
+                                           for address in ("/grid/led/all", "/grid/led/level/all"))
+
+  def handle_osc_batch(self, messages, client_address):
+    # Grid led messages before the last one setting all leds would be overwritten by it anyway, so they are left out
+    first = 0
+    for index in range(len(messages) - 1, 0, -1):
+      message = messages[index]
+      if (message.address in self.__allgridledaddresses and len(message.params) >= 1
+          and type(message.params[0]) in pyserialoscutils.OscRoute.NUMBER_TYPES):
+        first = index
+        break
+    if (first):
+      gridledaddresses = self.__gridledaddresses
+      kept = []
+      for message in messages[0:first]:
+        if (message.address not in gridledaddresses):
+          kept.append(message)
+        elif (self.dispatcher.addresscounter is not None):
+          self.dispatcher.addresscounter.count(message.address)
+      messages = kept + messages[first:]
+    self.dispatcher.dispatch_messages(messages, client_address)
+
   def default_osc_handler(self, source, *osc_arguments):
+    # Only addresses that are not exactly as in the route table end up here
     messagepath = osc_arguments[0]
     parameters = osc_arguments[1:]
     if (not messagepath.startswith(self.messageprefix + "/")):
       logging.debug("Message path %s does not fit set message prefix %s. Ignoring it",
               messagepath, self.messageprefix)
       return
-    elif (messagepath.endswith("/led/all")):
-      newstate = osc_arguments[1]
-      self.__serialadapter.set_grid_led_all(newstate)
-    elif (messagepath.endswith("/led/set")):
-      x = parameters[0]
-      y = parameters[1]
-      newstate = parameters[2]
-      self.__serialadapter.set_grid_led(x, y, newstate)
-    elif (messagepath.endswith("/led/map")):
-      offsetx = parameters[0]
-      offsety = parameters[1]
-      bitmaparray = parameters[2:]
-      self.__serialadapter.set_grid_led_map(
-        offsetx, offsety, bitmaparray)
-    elif (messagepath.endswith("/led/row")):
-      offsetx = parameters[0]
-      offsety = parameters[1]
-      bitmaparray = parameters[2]
-      self.__serialadapter.set_grid_led_row(
-        offsetx, offsety, bitmaparray)
-    elif (messagepath.endswith("/led/col")):
-      offsetx = parameters[0]
-      offsety = parameters[1]
-      bitmaparray = parameters[2]
-      self.__serialadapter.set_grid_led_column(
-        offsetx, offsety, bitmaparray)
-    elif (messagepath.endswith("/led/intensity")):
-      newlevel = parameters[0]
-      self.__serialadapter.set_grid_intensity(newlevel)
-    elif (messagepath.endswith("/led/level/set")):
-      x = parameters[0]
-      y = parameters[1]
-      newlevel = parameters[2]
-      self.__serialadapter.set_grid_led_level(x, y, newlevel)
-    elif (messagepath.endswith("/led/level/all")):
-      newlevel = parameters[0]
-      self.__serialadapter.set_grid_led_level(x, y, newlevel)
-    elif (messagepath.endswith("/led/level/map")):
-      offsetx = parameters[0]
-      offsety = parameters[1]
-      levelarray = parameters[2:]
-      self.__serialadapter.set_grid_led_map_level(
-        offsetx, offsety, levelarray)
-    elif (messagepath.endswith("/led/level/row")):
-      offsetx = parameters[0]
-      offsety = parameters[1]
-      bitmaparray = parameters[2:]
-      self.__serialadapter.set_grid_led_row_level(
-        offsetx, offsety, levelarray)
-    elif (messagepath.endswith("/led/level/col")):
-      offsetx = parameters[0]
-      offsety = parameters[1]
-      bitmaparray = parameters[2:]
-      self.__serialadapter.set_grid_led_column_level(
-        offsetx, offsety, levelarray)
-    else:
-      logging.warn(
-        "Got unknown OSC device request %s with parameters: %s", messagepath, parameters)
+    for (address, route) in self.__routes:
+      if (address.startswith("/grid/") and messagepath.endswith(address[len("/grid"):])):
+        route(messagepath, *parameters)
+        return
+    logging.warn(
+      "Got unknown OSC device request %s with parameters: %s", messagepath, parameters)
+
+  def set_led_all(self, requestpath, newstate, *ignored):
+    self.framebuffer.set_all_level(
+      pyserialoscframebuffer.state_to_level(newstate))
+
+  def set_led(self, requestpath, x, y, newstate, *ignored):
+    self.framebuffer.set_led_level(
+      x, y, pyserialoscframebuffer.state_to_level(newstate))
+
+  def set_led_map(self, requestpath, offsetx, offsety, *bitmaparray):
+    self.framebuffer.set_map_level(
+      offsetx, offsety, pyserialoscframebuffer.bitmaps_to_levels(bitmaparray[0:8]))
+
+  def set_led_row(self, requestpath, offsetx, offsety, *bitmaparray):
+    self.framebuffer.set_row_level(
+      offsetx, offsety, pyserialoscframebuffer.bitmaps_to_levels(bitmaparray))
+
+  def set_led_col(self, requestpath, offsetx, offsety, *bitmaparray):
+    self.framebuffer.set_col_level(
+      offsetx, offsety, pyserialoscframebuffer.bitmaps_to_levels(bitmaparray))
+
+  def set_led_intensity(self, requestpath, newlevel, *ignored):
+    self.__serialadapter.set_grid_intensity(int(newlevel))
+
+  def set_led_level(self, requestpath, x, y, newlevel, *ignored):
+    self.framebuffer.set_led_level(x, y, newlevel)
+
+  def set_led_level_all(self, requestpath, newlevel, *ignored):
+    self.framebuffer.set_all_level(newlevel)
+
+  def set_led_level_map(self, requestpath, offsetx, offsety, *levelarray):
+    self.framebuffer.set_map_level(offsetx, offsety, levelarray)
+
+  def set_led_level_row(self, requestpath, offsetx, offsety, *levelarray):
+    self.framebuffer.set_row_level(offsetx, offsety, levelarray)
+
+  def set_led_level_col(self, requestpath, offsetx, offsety, *levelarray):
+    self.framebuffer.set_col_level(offsetx, offsety, levelarray)
+
+  def set_led_level_frame(self, requestpath, levels, *ignored):
+    self.framebuffer.set_frame_level(levels)
+
+  def set_tilt(self, requestpath, sensor, newstate, *ignored):
+    self.__messagesender.set_tilt_enabled(int(sensor), newstate)
+    self.__serialadapter.set_tilt(int(sensor), newstate)
+
+  def set_ring_led(self, requestpath, ring, x, newlevel, *ignored):
+    self.ringbuffer.set_led_level(ring, x, newlevel)
+
+  def set_ring_all(self, requestpath, ring, newlevel, *ignored):
+    self.ringbuffer.set_all_level(ring, newlevel)
+
+  def set_ring_map(self, requestpath, ring, *levelarray):
+    self.ringbuffer.set_map_level(ring, levelarray)
+
+  def set_ring_range(self, requestpath, ring, first, last, newlevel, *ignored):
+    self.ringbuffer.set_range_level(ring, first, last, newlevel)
+
+  def add_animation_frame(self, requestpath, name, *levelarray):
+    levels = levelarray[0]
+    if (type(levels) not in pyserialoscutils.OscRoute.BLOB_TYPES):
+      if (any(type(level) in pyserialoscutils.OscRoute.BLOB_TYPES for level in levelarray)):
+        logging.warning("Ignoring frame for animation %s, expected one blob or only numbers", name)
+        return
+      levels = pyserialoscframebuffer.clamp_levels(levelarray)
+    self.animations.add_frame(str(name), levels)
+
+  def define_animation_fade(self, requestpath, name, fromlevel, tolevel, frames, *ignored):
+    self.animations.define(str(name), pyserialoscanimation.Fade(fromlevel, tolevel, frames))
+
+  def define_animation_ramp(self, requestpath, name, fromlevel, tolevel, *ignored):
+    self.animations.define(str(name), pyserialoscanimation.Ramp(fromlevel, tolevel))
+
+  def define_animation_scroll(self, requestpath, name, source, dx, dy=0, *ignored):
+    # Scrolls the first frame of another animation
+    sequence = self.animations.animations.get(str(source))
+    if (not isinstance(sequence, pyserialoscanimation.FrameSequence) or not sequence.frames):
+      logging.warning("Cannot scroll animation %s, it has no frames", source)
+      return
+    self.animations.define(str(name), pyserialoscanimation.Scroll(sequence.frames[0], dx, dy))
+
+  def delete_animation(self, requestpath, name, *ignored):
+    self.animations.delete(str(name))
+
+  def start_animation(self, requestpath, name, fps=pyserialoscanimation.DEFAULT_FPS, *ignored):
+    self.animations.start(str(name), fps)
+
+  def loop_animation(self, requestpath, name, fps=pyserialoscanimation.DEFAULT_FPS, *ignored):
+    self.animations.start(str(name), fps, loop=True)
+
+  def stop_animation(self, requestpath, *ignored):
+    self.animations.stop()
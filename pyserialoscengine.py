@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import signal
+
+ENGINES = ("threads", "asyncio")
+
+# With the asyncio engine this is the one event loop everything runs on, otherwise every part runs its own thread
+loop = None
+
+# -----------
+# Receives osc on the event loop and hands it to the dispatcher, like the blocking server does in its thread
+# -----------
+
+
+class OscDatagramProtocol(asyncio.DatagramProtocol):
+  def __init__(self, dispatcher):
+    super().__init__()
+    self.dispatcher = dispatcher
+
+  def datagram_received(self, data, client_address):
+    try:
+      self.dispatcher.call_handlers_for_packet(data, client_address)
+    except Exception as e:
+      logging.warning("Could not handle OSC packet from %s, Exception was %s",
+                      client_address, e)
+
+
+def use_asyncio():
+  global loop
+  loop = asyncio.new_event_loop()
+  asyncio.set_event_loop(loop)
+  return loop
+
+
+def is_asyncio():
+  return loop is not None
+
+
+def call_periodically(interval, callback):
+  # Returns a function that stops the calls again
+  handle = None
+  stopped = False
+
+  def tick():
+    nonlocal handle
+    if (stopped):
+      return
+    nextcall = loop.time() + interval
+    try:
+      callback()
+    except Exception as e:
+      logging.warning("Periodic call of %s failed, Exception was %s", callback, e)
+    handle = loop.call_at(max(nextcall, loop.time()), tick)
+
+  def stop():
+    nonlocal stopped
+    stopped = True
+    if (handle is not None):
+      handle.cancel()
+
+  handle = loop.call_soon(tick)
+  return stop
+
+
+def run_forever(interval, periodiccallback, stopcallback):
+  call_periodically(interval, periodiccallback)
+
+  def shutdown():
+    try:
+      stopcallback()
+    finally:
+      loop.stop()
+
+  loop.add_signal_handler(signal.SIGINT, shutdown)
+  loop.add_signal_handler(signal.SIGTERM, shutdown)
+  try:
+    loop.run_forever()
+  finally:
+    loop.close()
@@ -0,0 +1,356 @@
+import logging
+import time
+from threading import Thread, Lock, Event
+import pyserialoscengine
+import pyserialoscutils
+
+QUAD_SIZE = 8
+QUAD_CELLS = QUAD_SIZE * QUAD_SIZE
+MAX_LEVEL = 15
+
+# Each mono bitmap byte expands to 8 levels, least significant bit first
+BITMAP_LEVELS = [bytes(MAX_LEVEL if (bitmap >> bit) & 1 else 0 for bit in range(QUAD_SIZE))
+                 for bitmap in range(256)]
+
+# Maps every byte to a valid level
+CLAMPED_LEVELS = bytes(min(byte, MAX_LEVEL) for byte in range(256))
+
+# Leds on each ring of an arc
+RING_SIZE = 64
+
+# Levels from here on show as on when a quad has to be sent without levels
+HALF_LEVEL = 8
+
+# Serial bytes for one quad, sent as on/off or with levels
+MAP_FRAME_BYTES = 11
+MAP_LEVEL_FRAME_BYTES = 67
+
+# -----------
+# A shadow copy of the led levels of a device, so only changed quads get sent
+# -----------
+
+
+class LedFramebuffer:
+  def __init__(self, width, height):
+    super().__init__()
+    # Levels are kept the way the device is oriented, the set_* methods take application coordinates
+    self.width = width
+    self.height = height
+    self.lock = Lock()
+    self.__levels = bytearray(width * height)
+    # We do not know what the device currently shows, so the first flush sends every quad
+    self.__sentlevels = bytearray(b"\xff" * (width * height))
+    self.__dirty = True
+    self.__quadoffsets = [(offsetx, offsety)
+                          for offsety in range(0, height, QUAD_SIZE)
+                          for offsetx in range(0, width, QUAD_SIZE)]
+    self.set_rotation(0)
+
+  def set_rotation(self, rotation):
+    tables = pyserialoscutils.rotation_tables(self.width, self.height, rotation)
+    with self.lock:
+      self.rotation = rotation
+      self.__tables = tables
+      self.appwidth = tables.appwidth
+      self.appheight = tables.appheight
+
+  def set_led_level(self, x, y, level):
+    x, y = int(x), int(y)
+    if (x < 0 or x >= self.appwidth or y < 0 or y >= self.appheight):
+      return
+    with self.lock:
+      self.__levels[self.__tables.ledindices[y * self.appwidth + x]] = clamp_level(level)
+      self.__dirty = True
+
+  def set_all_level(self, level):
+    with self.lock:
+      self.__levels[:] = bytes([clamp_level(level)]) * len(self.__levels)
+      self.__dirty = True
+
+  def set_map_level(self, offsetx, offsety, levels):
+    offsetx, offsety = quad_offset(offsetx), quad_offset(offsety)
+    levels = clamp_levels(levels[0:QUAD_CELLS])
+    with self.lock:
+      if (self.rotation == 0):
+        for row in range(QUAD_SIZE):
+          self.__write_row(offsetx, offsety + row,
+                           levels[row * QUAD_SIZE:(row + 1) * QUAD_SIZE])
+      elif ((offsetx, offsety) in self.__tables.quadpermutations):
+        deviceoffsetx, deviceoffsety, quadorder = self.__tables.quadpermutations[(
+            offsetx, offsety)]
+        levels = bytes(quadorder(levels.ljust(QUAD_CELLS, b"\x00")))
+        for row in range(QUAD_SIZE):
+          self.__write_row(deviceoffsetx, deviceoffsety + row,
+                           levels[row * QUAD_SIZE:(row + 1) * QUAD_SIZE])
+      else:
+        # A quad sticking out of the grid, only happens for sizes that are no multiple of 8
+        for (index, level) in enumerate(levels):
+          self.__write_rotated(offsetx + index % QUAD_SIZE,
+                               offsety + index // QUAD_SIZE, level)
+      self.__dirty = True
+
+  def set_row_level(self, offsetx, y, levels):
+    offsetx, y = quad_offset(offsetx), int(y)
+    levels = clamp_levels(levels)
+    with self.lock:
+      if (self.rotation == 0):
+        self.__write_row(offsetx, y, levels)
+      else:
+        for (index, level) in enumerate(levels):
+          self.__write_rotated(offsetx + index, y, level)
+      self.__dirty = True
+
+  def set_col_level(self, x, offsety, levels):
+    x, offsety = int(x), quad_offset(offsety)
+    if (x < 0 or x >= self.appwidth or offsety < 0 or offsety >= self.appheight):
+      return
+    levels = clamp_levels(levels[0:self.appheight - offsety])
+    with self.lock:
+      if (self.rotation == 0):
+        start = offsety * self.width + x
+        self.__levels[start:start + len(levels) * self.width:self.width] = levels
+      else:
+        for (index, level) in enumerate(levels):
+          self.__write_rotated(x, offsety + index, level)
+      self.__dirty = True
+
+  def set_frame_level(self, levels):
+    # levels is a bytes-like object with one byte per led, row by row, copied without looking at each led
+    levels = memoryview(levels)
+    if (len(levels) != len(self.__levels)):
+      logging.warning("Ignoring frame of %s levels, expected %s for %sx%s",
+                      len(levels), len(self.__levels), self.appwidth, self.appheight)
+      return
+    if (len(levels) and max(levels) > MAX_LEVEL):
+      levels = memoryview(levels.tobytes().translate(CLAMPED_LEVELS))
+    with self.lock:
+      if (self.rotation == 0):
+        self.__levels[:] = levels
+      else:
+        self.__levels[:] = bytes(self.__tables.frameorder(levels))
+      self.__dirty = True
+
+  def resend_quads(self, quadoffsets):
+    # For quads the device does not show as they are, e.g. because they had to be sent without levels
+    with self.lock:
+      for (offsetx, offsety) in quadoffsets:
+        for y in range(offsety, min(offsety + QUAD_SIZE, self.height)):
+          start = y * self.width + offsetx
+          end = start + min(QUAD_SIZE, self.width - offsetx)
+          self.__sentlevels[start:end] = b"\xff" * (end - start)
+      self.__dirty = True
+
+  def __write_rotated(self, x, y, level):
+    if (0 <= x < self.appwidth and 0 <= y < self.appheight):
+      self.__levels[self.__tables.ledindices[y * self.appwidth + x]] = level
+
+  def pop_changed_quads(self):
+    changedquads = []
+    with self.lock:
+      if (not self.__dirty):
+        return changedquads
+      for (offsetx, offsety) in self.__quadoffsets:
+        if (self.__quad_changed(offsetx, offsety)):
+          changedquads.append(
+              (offsetx, offsety, self.__read_quad(offsetx, offsety)))
+      self.__dirty = False
+    return changedquads
+
+  def __write_row(self, offsetx, y, levels):
+    if (y < 0 or y >= self.height or offsetx < 0 or offsetx >= self.width):
+      return
+    count = min(len(levels), self.width - offsetx)
+    start = y * self.width + offsetx
+    self.__levels[start:start + count] = levels[0:count]
+
+  def __quad_changed(self, offsetx, offsety):
+    changed = False
+    rowlength = min(QUAD_SIZE, self.width - offsetx)
+    for y in range(offsety, min(offsety + QUAD_SIZE, self.height)):
+      start = y * self.width + offsetx
+      end = start + rowlength
+      if (self.__levels[start:end] != self.__sentlevels[start:end]):
+        self.__sentlevels[start:end] = self.__levels[start:end]
+        changed = True
+    return changed
+
+  def __read_quad(self, offsetx, offsety):
+    quad = bytearray(QUAD_CELLS)
+    rowlength = min(QUAD_SIZE, self.width - offsetx)
+    for row in range(min(QUAD_SIZE, self.height - offsety)):
+      start = (offsety + row) * self.width + offsetx
+      quad[row * QUAD_SIZE:row * QUAD_SIZE + rowlength] = \
+          self.__levels[start:start + rowlength]
+    return bytes(quad)
+
+# -----------
+# A shadow copy of the rings of an arc, so only changed rings get sent
+# -----------
+
+
+class RingFramebuffer:
+  def __init__(self, rings):
+    super().__init__()
+    self.rings = rings
+    self.lock = Lock()
+    self.__levels = [bytearray(RING_SIZE) for _ in range(rings)]
+    # Nothing is known about what the rings show, so the first flush sends all of them
+    self.__sentlevels = [None] * rings
+    self.__changed = set(range(rings))
+
+  def set_led_level(self, ring, x, level):
+    ring = int(ring)
+    if (0 <= ring < self.rings):
+      with self.lock:
+        self.__levels[ring][int(x) % RING_SIZE] = clamp_level(level)
+        self.__changed.add(ring)
+
+  def set_all_level(self, ring, level):
+    ring = int(ring)
+    if (0 <= ring < self.rings):
+      with self.lock:
+        self.__levels[ring][:] = bytes([clamp_level(level)]) * RING_SIZE
+        self.__changed.add(ring)
+
+  def set_map_level(self, ring, levels):
+    ring = int(ring)
+    if (0 <= ring < self.rings):
+      levels = clamp_levels(levels[0:RING_SIZE])
+      with self.lock:
+        self.__levels[ring][0:len(levels)] = levels
+        self.__changed.add(ring)
+
+  def set_range_level(self, ring, first, last, level):
+    # Clockwise from first to last, across the top if last comes before first, as with the original serialosc
+    ring = int(ring)
+    if (0 <= ring < self.rings):
+      first, last = int(first) % RING_SIZE, int(last) % RING_SIZE
+      level = clamp_level(level)
+      with self.lock:
+        for x in range(first, first + (last - first) % RING_SIZE + 1):
+          self.__levels[ring][x % RING_SIZE] = level
+        self.__changed.add(ring)
+
+  def pop_changed_rings(self):
+    changedrings = []
+    with self.lock:
+      for ring in sorted(self.__changed):
+        levels = bytes(self.__levels[ring])
+        if (levels != self.__sentlevels[ring]):
+          self.__sentlevels[ring] = levels
+          changedrings.append((ring, levels))
+      self.__changed.clear()
+    return changedrings
+
+# -----------
+# Keeps led frames from piling up on a slow serial link, and measures how many get through
+# -----------
+
+
+class LedPacer:
+  def __init__(self, fps, minfps=15):
+    super().__init__()
+    self.interval = 1.0 / fps
+    # Below this rate frames are sent without levels instead of even less often
+    self.mininterval = 1.0 / min(fps, minfps)
+    self.skippedframes = 0
+    self.degradedframes = 0
+    self.__averageinterval = self.interval
+    self.__lastframeat = None
+
+  def should_skip(self, backlogseconds):
+    # Still busy with the last frame, so this one waits. The framebuffer keeps the latest state meanwhile
+    if (backlogseconds > self.interval):
+      self.skippedframes += 1
+      return True
+    return False
+
+  def frame_sent(self, degraded):
+    now = time.monotonic()
+    if (self.__lastframeat is not None):
+      self.__averageinterval = self.__averageinterval * 0.9 + (now - self.__lastframeat) * 0.1
+    self.__lastframeat = now
+    if (degraded):
+      self.degradedframes += 1
+
+  def effective_fps(self):
+    return 1.0 / self.__averageinterval
+
+# -----------
+# Periodically pushes the framebuffer to the device
+# -----------
+
+
+class LedFlusher:
+  def __init__(self, flushcallback, fps):
+    super().__init__()
+    self.__flushcallback = flushcallback
+    self.interval = 1.0 / fps
+    self.running = False
+    self.__stopevent = Event()
+
+  def start(self):
+    self.running = True
+    if (pyserialoscengine.is_asyncio()):
+      self.__stopflushing = pyserialoscengine.call_periodically(
+        self.interval, self.__flushcallback)
+      return
+    self.__stopevent.clear()
+    self.__flush_thread = Thread(target=self.flushloop)
+    self.__flush_thread.start()
+
+  def stop(self):
+    if (not self.running):
+      return
+    self.running = False
+    if (pyserialoscengine.is_asyncio()):
+      self.__stopflushing()
+      return
+    self.__stopevent.set()
+    self.__flush_thread.join()
+
+  def flushloop(self):
+    nextflush = time.monotonic()
+    while (self.running):
+      try:
+        self.__flushcallback()
+      except Exception as e:
+        logging.warning("Could not flush leds, Exception was %s", e)
+      nextflush = max(nextflush + self.interval, time.monotonic())
+      self.__stopevent.wait(nextflush - time.monotonic())
+
+
+def clamp_level(level):
+  return min(max(int(level), 0), MAX_LEVEL)
+
+
+def clamp_levels(levels):
+  return bytes(clamp_level(level) for level in levels)
+
+
+def quad_offset(offset):
+  # Offsets are rounded down to a multiple of the quad size, as with the original serialosc
+  return int(offset) - int(offset) % QUAD_SIZE
+
+
+def state_to_level(state):
+  return MAX_LEVEL if state else 0
+
+
+def bitmaps_to_levels(bitmaps):
+  return b"".join(BITMAP_LEVELS[int(bitmap) & 0xFF] for bitmap in bitmaps)
+
+
+def is_mono_quad(levels):
+  return not levels.translate(None, b"\x00\x0f")
+
+
+def levels_to_bitmaps(levels, threshold=1):
+  bitmaps = []
+  for row in range(0, len(levels), QUAD_SIZE):
+    bitmap = 0
+    for bit, level in enumerate(levels[row:row + QUAD_SIZE]):
+      if (level >= threshold):
+        bitmap |= 1 << bit
+    bitmaps.append(bitmap)
+  return bitmaps
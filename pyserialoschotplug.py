@@ -0,0 +1,115 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import socket
+import time
+
+# inotify flags, from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+NETLINK_KOBJECT_UEVENT = 15
+
+METHODS = ("inotify", "netlink", "poll")
+
+# -----------
+# Tells us when serial ports might have come or gone, so we do not have to scan for them all the time
+# -----------
+
+
+class HotplugMonitor:
+  def __init__(self, methods=METHODS, settletime=0.05, path="/dev"):
+    super().__init__()
+    self.methods = methods
+    self.path = path
+    # Plugging in causes several events in a row (node created, permissions set), so we wait for them to settle
+    self.settletime = settletime
+    self.method = "poll"
+    self.__fd = None
+    self.__netlinksocket = None
+
+  def start(self):
+    for method in self.methods:
+      try:
+        if (method == "inotify"):
+          self.__fd = open_inotify(self.path)
+        elif (method == "netlink"):
+          self.__netlinksocket = open_uevent_socket()
+          self.__fd = self.__netlinksocket.fileno()
+        self.method = method
+        break
+      except (OSError, AttributeError) as e:
+        logging.debug("Hotplug detection using %s not available: %s", method, e)
+    logging.info("Detecting serial port changes using %s", self.method)
+    return self.method
+
+  def stop(self):
+    if (self.__netlinksocket is not None):
+      self.__netlinksocket.close()
+    elif (self.__fd is not None):
+      os.close(self.__fd)
+    self.__fd = None
+    self.__netlinksocket = None
+    self.method = "poll"
+
+  def fileno(self):
+    return self.__fd
+
+  def is_event_driven(self):
+    return self.__fd is not None
+
+  def wait(self, timeout):
+    # True if something changed (or might have, when polling), False if the timeout passed quietly
+    if (self.__fd is None):
+      time.sleep(timeout)
+      return True
+    if (not select.select([self.__fd], [], [], timeout)[0]):
+      return False
+    time.sleep(self.settletime)
+    return self.drain()
+
+  def drain(self):
+    changed = False
+    while (True):
+      try:
+        if (self.__netlinksocket is not None):
+          changed = is_tty_uevent(
+              self.__netlinksocket.recv(65536, socket.MSG_DONTWAIT)) or changed
+        else:
+          changed = len(os.read(self.__fd, 65536)) > 0 or changed
+      except BlockingIOError:
+        return changed
+
+
+def open_inotify(path):
+  libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+  fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+  if (fd < 0):
+    raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+  watch = libc.inotify_add_watch(fd, path.encode(),
+                                 IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO)
+  if (watch < 0):
+    os.close(fd)
+    raise OSError(ctypes.get_errno(), "inotify_add_watch failed for " + path)
+  return fd
+
+
+def open_uevent_socket():
+  netlinksocket = socket.socket(
+      socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+  try:
+    # Group 1 gets the kernel's uevents
+    netlinksocket.bind((0, 1))
+  except OSError:
+    netlinksocket.close()
+    raise
+  netlinksocket.setblocking(False)
+  return netlinksocket
+
+
+def is_tty_uevent(message):
+  return b"\x00SUBSYSTEM=tty\x00" in message or message.endswith(b"\x00SUBSYSTEM=tty")
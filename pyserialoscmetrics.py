@@ -0,0 +1,187 @@
+import bisect
+import logging
+import os
+from threading import Thread, Event, Lock
+import pyserialoscengine
+
+# Upper bounds in seconds, from well below a serial round trip to something clearly broken
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# Addresses are counted one by one up to this many, anything after that as "other"
+MAX_ADDRESSES = 64
+
+PROMETHEUS_PREFIX = "pyserialosc_"
+
+# Everything a device reports, as name, prometheus type and description
+METRICS = (
+    ("osc_messages_in_total", "counter", "OSC messages received by the device, by address"),
+    ("osc_messages_out_total", "counter", "OSC messages sent by the device, by address below the prefix"),
+    ("serial_bytes_in_total", "counter", "Bytes read from the serial port"),
+    ("serial_bytes_out_total", "counter", "Bytes written to the serial port"),
+    ("serial_write_seconds", "histogram", "Time spent in each write to the serial port"),
+    ("key_latency_seconds", "histogram", "Time from reading a key event from the serial port to sending its OSC message"),
+    ("parser_resyncs_total", "counter", "Unknown bytes skipped while reading from the serial port"),
+    ("dropped_commands_total", "counter", "LED commands dropped because the write queue was full"),
+    ("merged_commands_total", "counter", "LED commands replaced by a newer one before being written"),
+    ("write_queue_depth", "gauge", "LED commands waiting to be written"),
+    ("led_effective_fps", "gauge", "LED frames per second that actually go out, at most the configured rate"),
+    ("serial_backlog_seconds", "gauge", "How long the serial link needs for everything written so far, at its baud rate"),
+    ("led_frames_skipped_total", "counter", "LED frames left out because the serial link was still busy"),
+    ("led_frames_degraded_total", "counter", "LED frames sent without levels because they did not fit through the serial link"),
+    ("worker_restarts_total", "counter", "Times the worker process running the device was restarted after it crashed"),
+)
+
+# -----------
+# Counters and histograms. Plain values are updated without locks, each only by one thread (or the event loop),
+# and readers may see them a moment late. Addresses are counted from several threads, so they take a lock
+# -----------
+
+
+class Histogram:
+  def __init__(self, bounds=LATENCY_BUCKETS):
+    super().__init__()
+    self.bounds = bounds
+    # One more bucket for everything above the last bound
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.sum = 0.0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.count += 1
+    self.sum += value
+
+  def samples(self, name):
+    samples = []
+    cumulative = 0
+    for (bound, count) in zip(self.bounds, self.counts):
+      cumulative += count
+      samples.append((name + "_bucket", (("le", repr(bound)),), cumulative))
+    samples.append((name + "_bucket", (("le", "+Inf"),), cumulative + self.counts[-1]))
+    samples.append((name + "_sum", (), self.sum))
+    samples.append((name + "_count", (), self.count))
+    return samples
+
+
+class AddressCounter:
+  def __init__(self, maxaddresses=MAX_ADDRESSES):
+    super().__init__()
+    self.maxaddresses = maxaddresses
+    self.counts = {}
+    self.__lock = Lock()
+
+  def count(self, address, increment=1):
+    # Keys from the serial listener and /sys/info replies from the OSC server both count outgoing messages
+    with self.__lock:
+      counts = self.counts
+      if (address not in counts and len(counts) >= self.maxaddresses):
+        # Whoever sends to a device decides on the addresses, so there is a limit to how many get their own counter
+        address = "other"
+      counts[address] = counts.get(address, 0) + increment
+
+  def samples(self, name):
+    with self.__lock:
+      counts = dict(self.counts)
+    return [(name, (("address", address),), count)
+            for (address, count) in sorted(counts.items())]
+
+
+class DeviceMetrics:
+  def __init__(self):
+    super().__init__()
+    self.oscin = AddressCounter()
+    self.oscout = AddressCounter()
+    self.serialbytesin = 0
+    self.serialbytesout = 0
+    self.writedurations = Histogram()
+    self.keylatency = Histogram()
+
+  def samples(self, parserresyncs=0, droppedcommands=0, mergedcommands=0, queuedepth=0,
+              effectivefps=0, backlog=0, skippedframes=0, degradedframes=0):
+    # The counts kept elsewhere are passed in, so there is only one place they are counted
+    samples = self.oscin.samples("osc_messages_in_total")
+    samples += self.oscout.samples("osc_messages_out_total")
+    samples.append(("serial_bytes_in_total", (), self.serialbytesin))
+    samples.append(("serial_bytes_out_total", (), self.serialbytesout))
+    samples += self.writedurations.samples("serial_write_seconds")
+    samples += self.keylatency.samples("key_latency_seconds")
+    samples.append(("parser_resyncs_total", (), parserresyncs))
+    samples.append(("dropped_commands_total", (), droppedcommands))
+    samples.append(("merged_commands_total", (), mergedcommands))
+    samples.append(("write_queue_depth", (), queuedepth))
+    samples.append(("led_effective_fps", (), effectivefps))
+    samples.append(("serial_backlog_seconds", (), backlog))
+    samples.append(("led_frames_skipped_total", (), skippedframes))
+    samples.append(("led_frames_degraded_total", (), degradedframes))
+    return samples
+
+
+def format_prometheus(devicesamples):
+  # devicesamples are (device id, samples) tuples, one for each device
+  lines = []
+  for (name, metrictype, description) in METRICS:
+    lines.append("# HELP {}{} {}".format(PROMETHEUS_PREFIX, name, description))
+    lines.append("# TYPE {}{} {}".format(PROMETHEUS_PREFIX, name, metrictype))
+    for (deviceid, samples) in devicesamples:
+      for (samplename, labels, value) in samples:
+        if (samplename != name and samplename.rpartition("_")[0] != name):
+          continue
+        labeltext = ",".join('{}="{}"'.format(label, escape_label(labelvalue))
+                             for (label, labelvalue) in (("device", deviceid),) + labels)
+        lines.append("{}{}{{{}}} {}".format(PROMETHEUS_PREFIX, samplename, labeltext, value))
+  return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# -----------
+# Periodically writes the metrics to a file, for a prometheus node exporter to pick up
+# -----------
+
+
+class MetricsFileWriter:
+  def __init__(self, path, interval, collect):
+    super().__init__()
+    # collect returns the text to write
+    self.path = path
+    self.interval = interval
+    self.__collect = collect
+    self.running = False
+    self.__stopevent = Event()
+
+  def start(self):
+    self.running = True
+    if (pyserialoscengine.is_asyncio()):
+      self.__stopwriting = pyserialoscengine.call_periodically(
+        self.interval, self.write)
+      return
+    self.__stopevent.clear()
+    self.__write_thread = Thread(target=self.writeloop, daemon=True)
+    self.__write_thread.start()
+
+  def stop(self):
+    if (not self.running):
+      return
+    self.running = False
+    if (pyserialoscengine.is_asyncio()):
+      self.__stopwriting()
+      return
+    self.__stopevent.set()
+    self.__write_thread.join()
+
+  def write(self):
+    # Written next to it and then renamed, so the file is never read half written
+    temporarypath = self.path + ".tmp"
+    with open(temporarypath, "w") as metricsfile:
+      metricsfile.write(self.__collect())
+    os.replace(temporarypath, self.path)
+
+  def writeloop(self):
+    while (self.running):
+      try:
+        self.write()
+      except Exception as e:
+        logging.warning("Could not write metrics to %s, Exception was %s", self.path, e)
+      self.__stopevent.wait(self.interval)
@@ -0,0 +1,230 @@
+import logging
+import struct
+
+# Payload length of every frame a device can send, by opcode
+DEVICE_FRAME_LENGTHS = {
+    0x00: 2,   # device info: type, number of quads
+    0x01: 32,  # device id
+    0x02: 3,   # grid offset: grid number, x, y
+    0x03: 2,   # grid size: x, y
+    0x04: 2,   # device address: address, type
+    0x0F: 8,   # firmware version
+    0x20: 2,   # key up: x, y
+    0x21: 2,   # key down: x, y
+    0x50: 2,   # encoder delta: encoder, signed delta
+    0x51: 1,   # encoder key up: encoder
+    0x52: 1,   # encoder key down: encoder
+    0x80: 1,   # active tilt sensors, one bit each
+    0x81: 7,   # tilt: sensor, x, y, z as signed 16 bit values
+}
+
+# Payload length of every frame we send to a device, by opcode
+HOST_FRAME_LENGTHS = {
+    0x00: 0,   # request device info
+    0x01: 0,   # request device id
+    0x05: 0,   # request grid size
+    0x0F: 0,   # request firmware version
+    0x10: 2,   # led off: x, y
+    0x11: 2,   # led on: x, y
+    0x12: 0,   # all off
+    0x13: 0,   # all on
+    0x14: 10,  # map: x, y, 8 bitmaps
+    0x15: 3,   # row: x, y, bitmap
+    0x16: 3,   # col: x, y, bitmap
+    0x17: 1,   # intensity
+    0x18: 3,   # led level: x, y, level
+    0x19: 1,   # all level
+    0x1A: 66,  # map level: x, y, 64 levels
+    0x1B: 10,  # row level: x, y, 8 levels
+    0x1C: 10,  # col level: x, y, 8 levels
+    0x82: 1,   # tilt enable: sensor
+    0x83: 1,   # tilt disable: sensor
+    0x90: 3,   # ring set: ring, led, level
+    0x91: 2,   # ring all: ring, level
+    0x92: 33,  # ring map: ring, 64 levels, two per byte
+    0x93: 4,   # ring range: ring, first led, last led, level
+}
+
+# Leds on each ring of an arc
+RING_SIZE = 64
+
+# x, y and z of a tilt frame, after the sensor number
+TILT_VALUES = struct.Struct(">hhh")
+
+# -----------
+# Turns a stream of bytes from the device into frames, however the bytes are chunked
+# -----------
+
+
+class SerialFrameParser:
+  def __init__(self, framelengths=DEVICE_FRAME_LENGTHS):
+    super().__init__()
+    self.framelengths = framelengths
+    self.__buffer = bytearray()
+    self.__payloadlengths = [None] * 256
+    self.__callbacks = [None] * 256
+    self.resyncs = 0
+
+  def register(self, opcode, callback, payloadlength=None):
+    # Callbacks get the buffer and the offset of the payload, which is only valid during the call
+    if (payloadlength is None):
+      payloadlength = self.framelengths[opcode]
+    self.__payloadlengths[opcode] = payloadlength
+    self.__callbacks[opcode] = callback
+
+  def pending_bytes(self):
+    return len(self.__buffer)
+
+  def reset(self):
+    self.__buffer.clear()
+
+  def feed(self, data):
+    buffer = self.__buffer
+    buffer += data
+    payloadlengths = self.__payloadlengths
+    callbacks = self.__callbacks
+    end = len(buffer)
+    position = 0
+    try:
+      while (position < end):
+        opcode = buffer[position]
+        payloadlength = payloadlengths[opcode]
+        if (payloadlength is None):
+          # Not the start of a frame we know, so try again from the next byte
+          logging.debug("Skipping unknown serial byte %s", opcode)
+          self.resyncs += 1
+          position += 1
+          continue
+        payloadstart = position + 1
+        if (payloadstart + payloadlength > end):
+          break
+        position = payloadstart + payloadlength
+        callbacks[opcode](buffer, payloadstart)
+    finally:
+      # Whatever is left is the start of a frame that has not fully arrived yet
+      del buffer[0:position]
+
+# -----------
+# Encodes frames for the device into one reusable buffer, so a whole batch goes out in a single write
+# -----------
+
+
+class SerialFrameEncoder:
+  FRAME_1 = struct.Struct("B")
+  FRAME_2 = struct.Struct("BB")
+  FRAME_3 = struct.Struct("BBB")
+  FRAME_4 = struct.Struct("BBBB")
+
+  def __init__(self, capacity=1024):
+    super().__init__()
+    self.__buffer = bytearray(capacity)
+    self.length = 0
+
+  def reset(self):
+    self.length = 0
+
+  def encoded(self):
+    # Only valid until the next frame is added
+    return memoryview(self.__buffer)[0:self.length]
+
+  def __reserve(self, count):
+    position = self.length
+    if (position + count > len(self.__buffer)):
+      # A new buffer rather than resizing, in case a view of the old one is still around
+      buffer = bytearray(max(len(self.__buffer) * 2, position + count))
+      buffer[0:position] = self.__buffer[0:position]
+      self.__buffer = buffer
+    self.length = position + count
+    return position
+
+  def __put(self, position, values, count):
+    values = values[0:count]
+    self.__buffer[position:position + len(values)] = values
+    if (len(values) < count):
+      self.__buffer[position + len(values):position + count] = bytes(count - len(values))
+
+  def add_raw(self, data):
+    position = self.__reserve(len(data))
+    self.__buffer[position:position + len(data)] = data
+
+  def add_led(self, x, y, state):
+    position = self.__reserve(3)
+    self.FRAME_3.pack_into(self.__buffer, position, 0x11 if state else 0x10, x, y)
+
+  def add_all(self, state):
+    position = self.__reserve(1)
+    self.FRAME_1.pack_into(self.__buffer, position, 0x13 if state else 0x12)
+
+  def add_map(self, offsetx, offsety, bitmaps):
+    position = self.__reserve(11)
+    self.FRAME_3.pack_into(self.__buffer, position, 0x14, offsetx, offsety)
+    self.__put(position + 3, bitmaps, 8)
+
+  def add_row(self, offsetx, y, bitmap):
+    position = self.__reserve(4)
+    self.FRAME_4.pack_into(self.__buffer, position, 0x15, offsetx, y, bitmap)
+
+  def add_col(self, x, offsety, bitmap):
+    position = self.__reserve(4)
+    self.FRAME_4.pack_into(self.__buffer, position, 0x16, x, offsety, bitmap)
+
+  def add_intensity(self, intensity):
+    position = self.__reserve(2)
+    self.FRAME_2.pack_into(self.__buffer, position, 0x17, intensity)
+
+  def add_led_level(self, x, y, level):
+    position = self.__reserve(4)
+    self.FRAME_4.pack_into(self.__buffer, position, 0x18, x, y, level)
+
+  def add_all_level(self, level):
+    position = self.__reserve(2)
+    self.FRAME_2.pack_into(self.__buffer, position, 0x19, level)
+
+  def add_map_level(self, offsetx, offsety, levels):
+    position = self.__reserve(67)
+    self.FRAME_3.pack_into(self.__buffer, position, 0x1A, offsetx, offsety)
+    self.__put(position + 3, levels, 64)
+
+  def add_row_level(self, offsetx, y, levels):
+    position = self.__reserve(11)
+    self.FRAME_3.pack_into(self.__buffer, position, 0x1B, offsetx, y)
+    self.__put(position + 3, levels, 8)
+
+  def add_col_level(self, x, offsety, levels):
+    position = self.__reserve(11)
+    self.FRAME_3.pack_into(self.__buffer, position, 0x1C, x, offsety)
+    self.__put(position + 3, levels, 8)
+
+  def add_tilt_set(self, sensor, state):
+    position = self.__reserve(2)
+    self.FRAME_2.pack_into(self.__buffer, position, 0x82 if state else 0x83, sensor)
+
+  def add_ring_set(self, ring, x, level):
+    position = self.__reserve(4)
+    self.FRAME_4.pack_into(self.__buffer, position, 0x90, ring, x, level)
+
+  def add_ring_all(self, ring, level):
+    position = self.__reserve(3)
+    self.FRAME_3.pack_into(self.__buffer, position, 0x91, ring, level)
+
+  def add_ring_map(self, ring, levels):
+    # Two levels per byte, the first one in the upper half
+    position = self.__reserve(34)
+    self.FRAME_2.pack_into(self.__buffer, position, 0x92, ring)
+    self.__put(position + 2, pack_levels(levels[0:RING_SIZE]), RING_SIZE // 2)
+
+  def add_ring_range(self, ring, first, last, level):
+    position = self.__reserve(5)
+    self.FRAME_4.pack_into(self.__buffer, position, 0x93, ring, first, last)
+    self.FRAME_1.pack_into(self.__buffer, position + 4, level)
+
+
+def pack_levels(levels):
+  if (len(levels) % 2):
+    levels = bytes(levels) + b"\x00"
+  return bytes((levels[index] << 4) | (levels[index + 1] & 0x0F)
+               for index in range(0, len(levels), 2))
+
+
+def unpack_levels(packed):
+  return bytes(level for byte in packed for level in (byte >> 4, byte & 0x0F))
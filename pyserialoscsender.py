@@ -1,32 +1,174 @@
 import pyserialoscutils
+import pyserialoscmetrics
+import pyserialosctrace
 import logging
+import time
+from threading import Lock
+
+# -----------
+# Tilt sensors send all the time, so only some of their values are passed on
+# -----------
+class TiltDecimator():
+  def __init__(self, maxrate=None, deadband=0, smoothing=0):
+    super().__init__()
+    # At most this many values per second and sensor, None for all of them
+    self.mininterval = 1.0 / maxrate if maxrate else 0
+    # Values closer than this on every axis to the last one passed on are left out
+    self.deadband = deadband
+    # 0 passes values as they are, towards 1 each new value counts less against the ones before
+    self.smoothing = smoothing
+    self.droppedvalues = 0
+    # By sensor: smoothed values, and the last values passed on with when they were
+    self.__smoothed = {}
+    self.__passed = {}
+
+  def filter(self, n, x, y, z):
+    # The values to send, or None. Every value goes into the smoothing, even those that are not sent
+    if (self.smoothing):
+      previous = self.__smoothed.get(n)
+      if (previous is not None):
+        x, y, z = (value * (1 - self.smoothing) + before * self.smoothing
+                   for (value, before) in zip((x, y, z), previous))
+      self.__smoothed[n] = (x, y, z)
+      x, y, z = round(x), round(y), round(z)
+    now = time.monotonic()
+    passed = self.__passed.get(n)
+    if (passed is not None):
+      (lastx, lasty, lastz), passedat = passed
+      tooearly = now - passedat < self.mininterval
+      tooclose = self.deadband and max(abs(x - lastx), abs(y - lasty), abs(z - lastz)) <= self.deadband
+      if (tooearly or tooclose):
+        self.droppedvalues += 1
+        return None
+    self.__passed[n] = ((x, y, z), now)
+    return (x, y, z)
+
+  def reset(self, n):
+    self.__smoothed.pop(n, None)
+    self.__passed.pop(n, None)
 
 # -----------
 # We will need to send osc to the target
 # -----------
 class SerialOscDeviceMessageSender():
-  def __init__(self, messageprefix, destinationhost, destinationport):
+  def __init__(self, messageprefix, destinationhost, destinationport, keybundlewindow=None, metrics=None, subscriptiontimeout=60, encoderdeltawindow=None, tiltdecimator=None):
     super().__init__()
+    self.metrics = metrics if metrics is not None else pyserialoscmetrics.DeviceMetrics()
+    # Which device trace records of this sender belong to
+    self.traceindex = 0
     self.messageprefix = messageprefix
     self.destinationhost = destinationhost
     self.destinationport = destinationport
+    # None sends every key on its own, otherwise keys read within this many seconds go out as one bundle
+    self.keybundlewindow = keybundlewindow
+    self.__batch = None
+    self.__batchtimetag = 0
+    # When the data for the current batch was read, for the key latency
+    self.__batchreadat = None
+    # None sends every encoder delta on its own, otherwise deltas of an encoder within this many seconds are summed up
+    self.encoderdeltawindow = encoderdeltawindow
+    # Summed up deltas not sent yet, by encoder
+    self.__deltas = {}
+    self.tiltdecimator = tiltdecimator if tiltdecimator is not None else TiltDecimator()
+    # Sensors switched on with /tilt/set, replaced as a whole
+    self.tiltsensors = frozenset()
+    # Latest tilt values by sensor, sent after everything else read at the same time
+    self.__tilts = {}
+    # Further destinations getting the same events: (host, port): (prefix or None for ours, monotonic expiry time).
+    # Replaced as a whole, so sending never sees it half changed
+    self.subscribers = {}
+    # Seconds a subscription lasts unless renewed, 0 for forever
+    self.subscriptiontimeout = subscriptiontimeout
+    self.__subscriberslock = Lock()
+
+  # Called by the serial listener around everything decoded from one read
+  def begin_batch(self, timetag):
+    self.__batchreadat = time.perf_counter()
+    if (self.keybundlewindow is not None):
+      self.__batch = []
+      self.__batchtimetag = timetag
+
+  def end_batch(self):
+    self.flush_enc_deltas()
+    batch = self.__batch
+    readat = self.__batchreadat
+    self.__batch = None
+    self.__batchreadat = None
+    if (batch):
+      bundles = {}
+      for (host, port, prefix) in self.get_destinations():
+        bundle = bundles.get(prefix)
+        if (bundle is None):
+          bundle = bundles[prefix] = pyserialoscutils.build_bundle(
+            [(prefix + path, osc_arguments) for (path, osc_arguments) in batch], self.__batchtimetag)
+        pyserialoscutils.get_osc_client(host, port).send(bundle)
+        for (path, osc_arguments) in batch:
+          self.metrics.oscout.count(path)
+      sentat = time.perf_counter()
+      for _ in batch:
+        self.metrics.keylatency.observe(sentat - readat)
+    # Keys go first, tilt waits for them
+    self.flush_tilts()
+
+  def set_destination(self, destinationhost, destinationport):
+    # The client for the old destination stays in the pool, others may send there as well. Idle ones get dropped
+    self.destinationhost = destinationhost
+    self.destinationport = destinationport
+
+  def subscribe(self, host, port, prefix=None):
+    # Subscribing again renews the subscription, and changes the prefix
+    expiresat = time.monotonic() + self.subscriptiontimeout if self.subscriptiontimeout else None
+    with self.__subscriberslock:
+      subscribers = dict(self.subscribers)
+      subscribers[(pyserialoscutils.map_localhost_to_ip4(host), port)] = (prefix, expiresat)
+      self.subscribers = subscribers
+
+  def unsubscribe(self, host, port):
+    with self.__subscriberslock:
+      subscribers = dict(self.subscribers)
+      if (subscribers.pop((pyserialoscutils.map_localhost_to_ip4(host), port), None) is not None):
+        self.subscribers = subscribers
+
+  def get_destinations(self):
+    # (host, port, prefix) of everyone getting events, starting with the destination set through /sys/host and /sys/port
+    destinations = [(self.destinationhost, self.destinationport, self.messageprefix)]
+    subscribers = self.subscribers
+    if (not subscribers):
+      return destinations
+    now = time.monotonic()
+    for ((host, port), (prefix, expiresat)) in subscribers.items():
+      if (expiresat is not None and expiresat < now):
+        logging.info("Subscription of %s:%s ran out", host, port)
+        self.unsubscribe(host, port)
+        continue
+      destinations.append((host, port, self.messageprefix if prefix is None else prefix))
+    return destinations
 
   # sending messages
   def send_prefix_message_to_destination(self, path, *osc_arguments):
-    pyserialoscutils.OscClientWrapper(self.destinationhost, self.destinationport).send_message(self.messageprefix + path, *osc_arguments)
+    # Encoded once per prefix, however many destinations there are
+    messages = {}
+    for (host, port, prefix) in self.get_destinations():
+      message = messages.get(prefix)
+      if (message is None):
+        message = messages[prefix] = pyserialoscutils.build_message(prefix + path, osc_arguments)
+      pyserialoscutils.get_osc_client(host, port).send(message)
+      self.metrics.oscout.count(path)
 
   def send_message_to_destination(self, path, *osc_arguments):
-    pyserialoscutils.OscClientWrapper(self.destinationhost, self.destinationport).send_message(path, *osc_arguments)
+    pyserialoscutils.get_osc_client(self.destinationhost, self.destinationport).send_message(path, *osc_arguments)
+    self.metrics.oscout.count(path)
 
   def send_message_to_specific_endpoint(self, host, port, path, *osc_arguments):
-    pyserialoscutils.OscClientWrapper(host, port).send_message(path, *osc_arguments)
+    pyserialoscutils.get_osc_client(host, port).send_message(path, *osc_arguments)
+    self.metrics.oscout.count(path)
 
   def send_info(self, id, sizex, sizey, rotation, destinationhost = "", destinationport = ""):
     if(destinationhost == ""):
-        destinationhost = self.destinationport
+        destinationhost = self.destinationhost
     if(destinationport == ""):
         destinationport = self.destinationport
-    logging.debug("Sending info with  targethost {} and targetport {}".format(destinationhost, destinationport))
+    logging.debug("Sending info with targethost %s and targetport %s", destinationhost, destinationport)
     self.send_message_to_specific_endpoint(destinationhost, destinationport, "/sys/id", id)
     self.send_message_to_specific_endpoint(destinationhost, destinationport, "/sys/size", sizex, sizey)
     self.send_message_to_specific_endpoint(destinationhost, destinationport, "/sys/host", self.destinationhost)
@@ -34,15 +176,83 @@ class SerialOscDeviceMessageSender():
     self.send_message_to_specific_endpoint(destinationhost, destinationport, "/sys/prefix", self.messageprefix)
     self.send_message_to_specific_endpoint(destinationhost, destinationport, "/sys/rotation", rotation)
 
+  def send_event(self, path, *osc_arguments):
+    # Into the open bundle if there is one, otherwise right away
+    if (self.__batch is not None):
+      self.__batch.append((path, osc_arguments))
+    else:
+      self.send_prefix_message_to_destination(path, *osc_arguments)
+      if (self.__batchreadat is not None):
+        self.metrics.keylatency.observe(time.perf_counter() - self.__batchreadat)
+
   def send_grid_key(self, x, y, state):
-    logging.debug("Device with prefix {} sending key x {}, y {}, state {}".format(self.messageprefix, x, y, state))
-    self.send_prefix_message_to_destination("/grid/key", x, y, state)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.FROM_DEVICE, 0x21 if state else 0x20, x, y)
+    self.send_event("/grid/key", x, y, state)
+
+  def set_tilt_enabled(self, n, state):
+    if (state):
+      self.tiltsensors = self.tiltsensors | {n}
+    else:
+      self.tiltsensors = self.tiltsensors - {n}
+      self.tiltdecimator.reset(n)
 
   def send_tilt(self, n, x, y, z):
-    logging.debug("Device with prefix {} sending tilt n {}, x {}, y {}, z {}".format(self.messageprefix, n, x, y, z))
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.FROM_DEVICE, 0x81, n, x, y, z)
+    if (n not in self.tiltsensors):
+      return
+    values = self.tiltdecimator.filter(n, x, y, z)
+    if (values is None):
+      return
+    if (self.__batchreadat is not None):
+      # Only the latest values of a sensor are sent once the batch ends
+      self.__tilts[n] = values
+    else:
+      self.send_prefix_message_to_destination("/tilt", n, *values)
+
+  def flush_tilts(self):
+    tilts = self.__tilts
+    if (not tilts):
+      return
+    self.__tilts = {}
+    for (n, values) in sorted(tilts.items()):
+      self.send_prefix_message_to_destination("/tilt", n, *values)
 
   def send_arc(self, n, d):
-    logging.debug("Device with prefix {} sending arc n {}, d {}".format(self.messageprefix, n, d))
-  
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.FROM_DEVICE, 0x50, n, d)
+    if (self.encoderdeltawindow):
+      # Sent by flush_enc_deltas once the serial listener closes the batch
+      self.__deltas[n] = self.__deltas.get(n, 0) + d
+    else:
+      self.send_event("/enc/delta", n, d)
+
   def send_enc(self, n, state):
-    logging.debug("Device with prefix {} sending encoder n {}, state {}".format(self.messageprefix, n, state))
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.FROM_DEVICE, 0x52 if state else 0x51, n)
+    # Turns before the press still arrive before it
+    self.flush_enc_deltas(n)
+    self.send_event("/enc/key", n, state)
+
+  def has_pending_deltas(self):
+    return bool(self.__deltas)
+
+  def flush_enc_deltas(self, n=None):
+    if (not self.__deltas):
+      return
+    if (n is None):
+      deltas = sorted(self.__deltas.items())
+      self.__deltas = {}
+    elif (n in self.__deltas):
+      deltas = [(n, self.__deltas.pop(n))]
+    else:
+      return
+    for (encoder, delta) in deltas:
+      # Turning back and forth within the window adds up to nothing
+      if (delta):
+        self.send_event("/enc/delta", encoder, delta)
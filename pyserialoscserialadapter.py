@@ -1,8 +1,17 @@
 import logging
-from threading import Thread
+import os
+import struct
+from collections import OrderedDict
+from itertools import count
+from threading import Thread, Condition
 import serial
 import time
 import pyserialoscsender
+import pyserialoscprotocol
+import pyserialoscengine
+import pyserialoscmetrics
+import pyserialosctrace
+import pyserialosccapture
 import serial.serialutil
 
 # -----------
@@ -11,139 +20,500 @@ import serial.serialutil
 
 
 class SerialListener:
-  def __init__(self, serial, messagesender):
+  READ_MODES = ("blocking", "poll")
+  DEVICE_TYPES = [None, "led-grid", "key-grid", "digital-out", "digital-in",
+                  "encoder", "analog-in", "analog-out", "tilt", "led-ring"]
+  GRID_TYPES = ("led-grid", "key-grid")
+  SUPPORTED_TYPES = ("led-grid", "encoder")
+
+  def __init__(self, serial, messagesender, readmode="blocking", metrics=None):
     super().__init__()
     self.__serial = serial
+    self.metrics = metrics if metrics is not None else pyserialoscmetrics.DeviceMetrics()
     self.running = False
+    self.readmode = readmode
+    # Poll mode sleeps this long between polls, blocking mode wakes up this often to check for stop
     self.interval = 0.02
+    self.readtimeout = 0.1
     self.__messagesender = messagesender
+    self.__process_thread = None
+    self.capturestream = "serial:{}".format(serial.port)
+    self.deviceinfo = None
+    self.deviceid = None
+    self.gridsize = None
+    self.gridoffset = None
+    self.deviceaddr = None
+    self.firmwareversion = None
+    self.tiltstates = None
+    # RotationTables for the keys, None if the device is not rotated
+    self.rotation = None
+    self.parser = pyserialoscprotocol.SerialFrameParser()
+    self.parser.register(0x00, self.process_device_info)
+    self.parser.register(0x01, self.process_device_id)
+    self.parser.register(0x02, self.process_grid_offset)
+    self.parser.register(0x03, self.process_grid_size)
+    self.parser.register(0x04, self.process_device_addr)
+    self.parser.register(0x0F, self.process_device_firmware_version)
+    self.parser.register(0x20, self.process_key_up)
+    self.parser.register(0x21, self.process_key_down)
+    self.parser.register(0x50, self.process_encoder_delta)
+    self.parser.register(0x51, self.process_encoder_key_up)
+    self.parser.register(0x52, self.process_encoder_key_down)
+    self.parser.register(0x80, self.process_tilt_states)
+    self.parser.register(0x81, self.process_tilt)
 
   def start(self):
-    logging.debug("Start listening on port %s", self.__serial.port)
     self.running = True
+    if (pyserialoscengine.is_asyncio()):
+      logging.debug("Start listening on port %s on the event loop",
+                    self.__serial.port)
+      self.__serial.timeout = 0
+      self.__bundlehandle = None
+      pyserialoscengine.loop.add_reader(
+        self.__serial.fileno(), self.on_readable)
+      return
+    logging.debug("Start listening on port %s in %s mode",
+                  self.__serial.port, self.readmode)
+    if (self.readmode == "blocking"):
+      self.__serial.timeout = self.readtimeout
     self.__process_thread = Thread(target=self.messagereadloop)
     self.__process_thread.start()
 
   def stop(self):
     logging.debug("Stop listening on port %s", self.__serial.port)
+    wasrunning = self.running
     self.running = False
-    self.__process_thread.join()
+    if (pyserialoscengine.is_asyncio()):
+      if (wasrunning):
+        self.stop_reading_on_loop()
+    elif (self.__process_thread is not None):
+      self.__process_thread.join()
+
+  def stop_reading_on_loop(self):
+    pyserialoscengine.loop.remove_reader(self.__serial.fileno())
+    if (self.__bundlehandle is not None):
+      self.__bundlehandle.cancel()
+      self.end_bundle_on_loop()
+
+  def on_readable(self):
+    try:
+      data = self.__serial.read(self.__serial.in_waiting or 1)
+    except (serial.serialutil.SerialException, OSError) as e:
+      logging.warn("Could not read from serial, Exception was %s", e)
+      self.running = False
+      self.stop_reading_on_loop()
+      return
+    if (not data):
+      return
+    self.count_received(data)
+    if (self.__bundlehandle is not None):
+      self.parser.feed(data)
+      return
+    self.__messagesender.begin_batch(time.time())
+    self.parser.feed(data)
+    window = self.batch_window()
+    if (window):
+      # Instead of waiting for the window to pass, the batch is closed by a timer on the loop
+      self.__bundlehandle = pyserialoscengine.loop.call_later(
+        window, self.end_bundle_on_loop)
+    else:
+      self.__messagesender.end_batch()
+
+  def count_received(self, data):
+    self.metrics.serialbytesin += len(data)
+    capture = pyserialosccapture.capture
+    if (capture is not None):
+      capture.record(self.capturestream, pyserialosccapture.SERIAL_IN, data)
+
+  def end_bundle_on_loop(self):
+    self.__bundlehandle = None
+    self.__messagesender.end_batch()
 
   def messagereadloop(self):
     while(self.running == True):
       try:
-        while (self.__serial.in_waiting > 0):
-          firstbyte = self.__serial.read()
-          self.dispatchmessage(firstbyte)
-        time.sleep(self.interval)
-      except (serial.serialutil.SerialException, AttributeError) as e:
+        if (self.readmode == "blocking"):
+          data = self.read_available_blocking()
+        else:
+          data = self.read_available_polling()
+        if (data):
+          self.process_data(data)
+      except (serial.serialutil.SerialException, AttributeError, OSError) as e:
         logging.warn("Could not read from serial, Exception was %s", e)
         self.running = False
 
-  def dispatchmessage(self, firstbyte):
-    # we're receiving device info
-    if (firstbyte == b"\x00"):
-      self.process_device_info()
-    elif (firstbyte == b"\x01"):
-      self.process_device_id()
-    elif (firstbyte == b"\x02"):
-      self.process_grid_offset()
-    elif (firstbyte == b"\x03"):
-      self.process_grid_size()
-    elif (firstbyte == b"\x04"):
-      self.process_device_addr()
-    elif (firstbyte == b"\x0F"):
-      self.process_device_firmware_version()
-    elif (firstbyte == b"\x20"):
-      self.process_key_up()
-    elif (firstbyte == b"\x21"):
-      self.process_key_down()
+  def process_data(self, data):
+    self.__messagesender.begin_batch(time.time())
+    try:
+      self.parser.feed(data)
+      window = self.batch_window()
+      if (window):
+        self.collect_bundle_window(time.perf_counter() + window)
+    finally:
+      self.__messagesender.end_batch()
+
+  def batch_window(self):
+    # Seconds to keep the batch open after the first read: the key bundle window, or longer while encoder deltas are being summed up
+    window = self.__messagesender.keybundlewindow or 0
+    if (self.__messagesender.has_pending_deltas()):
+      window = max(window, self.__messagesender.encoderdeltawindow)
+    return window
+
+  def collect_bundle_window(self, deadline):
+    # Anything else arriving within the window ends up in the same bundle. Reads wait for it until the deadline,
+    # so the thread only wakes up when there is something to read
+    readtimeout = self.__serial.timeout
+    try:
+      while (True):
+        remaining = deadline - time.perf_counter()
+        if (remaining <= 0):
+          break
+        self.__serial.timeout = remaining
+        data = self.read_available_blocking()
+        if (data):
+          self.parser.feed(data)
+    finally:
+      self.__serial.timeout = readtimeout
+
+  def read_available_blocking(self):
+    # Blocks until the first byte arrives, then takes everything else that is waiting
+    data = self.__serial.read(1)
+    if (data):
+      waiting = self.__serial.in_waiting
+      if (waiting > 0):
+        data += self.__serial.read(waiting)
+      self.count_received(data)
+    return data
+
+  def read_available_polling(self):
+    waiting = self.__serial.in_waiting
+    if (waiting > 0):
+      data = self.__serial.read(waiting)
+      self.count_received(data)
+      return data
+    time.sleep(self.interval)
+    return b""
+
+  def clear_device_metadata(self):
+    self.deviceinfo = None
+    self.deviceid = None
+    self.gridsize = None
+
+  def get_device_metadata(self):
+    # None until the device has answered all our queries. Only grids answer the size query
+    if (self.deviceinfo is None or self.deviceid is None):
+      return None
+    if (self.deviceinfo[0] not in self.GRID_TYPES):
+      return (self.deviceid, self.deviceinfo, (0, 0))
+    if (self.gridsize is None):
+      return None
+    return (self.deviceid, self.deviceinfo, self.gridsize)
+
+  def read_device_metadata(self, timeout=None):
+    # Used before the listener is started, while the device answers our queries. None if it does not answer in time
+    self.clear_device_metadata()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    # Reads wake up regularly, so something that never answers cannot keep us waiting
+    self.__serial.timeout = self.readtimeout
+    while (self.get_device_metadata() is None):
+      if (deadline is not None and time.monotonic() > deadline):
+        logging.warning("No answer from the device on %s within %s seconds",
+                        self.__serial.port, timeout)
+        return None
+      self.parser.feed(self.read_available_blocking())
+    return self.get_device_metadata()
+
+  def process_key_up(self, payload, offset):
+    if (self.rotation is None):
+      self.__messagesender.send_grid_key(payload[offset], payload[offset + 1], 0)
     else:
-      logging.warn(
-        "Unknown serial message received: %s. Ignoring by flushing rest. Might cause instability.", firstbyte)
-      self.__serial.flush()
+      x, y = self.rotation.rotate_key(payload[offset], payload[offset + 1])
+      self.__messagesender.send_grid_key(x, y, 0)
+
+  def process_key_down(self, payload, offset):
+    if (self.rotation is None):
+      self.__messagesender.send_grid_key(payload[offset], payload[offset + 1], 1)
+    else:
+      x, y = self.rotation.rotate_key(payload[offset], payload[offset + 1])
+      self.__messagesender.send_grid_key(x, y, 1)
+
+  def process_encoder_delta(self, payload, offset):
+    delta = payload[offset + 1]
+    self.__messagesender.send_arc(payload[offset], delta - 256 if delta >= 128 else delta)
+
+  def process_encoder_key_up(self, payload, offset):
+    self.__messagesender.send_enc(payload[offset], 0)
+
+  def process_encoder_key_down(self, payload, offset):
+    self.__messagesender.send_enc(payload[offset], 1)
+
+  def process_tilt_states(self, payload, offset):
+    self.tiltstates = payload[offset]
 
-  def process_key_up(self):
-    payload = self.__serial.read(2)
-    x = payload[0]
-    y = payload[1]
-    self.__messagesender.send_grid_key(x, y, 0)
-
-  def process_key_down(self):
-    payload = self.__serial.read(2)
-    x = payload[0]
-    y = payload[1]
-    self.__messagesender.send_grid_key(x, y, 1)
-
-  def process_device_id(self):
-    self.read_device_id
-    # Maybe want to push this back to osc
-
-  def process_device_info(self):
-    self.read_device_info
-    # Maybe want to push this back to osc
-
-  def process_grid_offset(self):
-    payload = self.__serial.read(3)
-    gridnumber = payload[0]
-    xoffset = payload[1]
-    yoffset = payload[2]
-    return(gridnumber, xoffset, yoffset)
-
-  def process_grid_size(self):
-    payload = self.__serial.read(2)
-    xsize = payload[0]
-    ysize = payload[1]
-    return(xsize, ysize)
-
-  def process_device_addr(self):
-    payload = self.__serial.read(2)
-    gridaddr = payload[0]
-    gridtype = payload[1]
-    return(gridaddr, gridtype)
-
-  def process_device_firmware_version(self):
-    versionbytes = self.__serial.read(0)
-    return string_from_bytes(versionbytes)
-
-  def read_device_info(self):
-    payload = self.__serial.read(2)
-
-    # second is device type
-    typelist = [None, "led-grid", "key-grid", "digital-out", "digital-in",
-          "encoder", "analog-in", "analog-out", "tilt", "led-ring"]
-    actualtype = typelist[payload[0]]
+  def process_tilt(self, payload, offset):
+    x, y, z = pyserialoscprotocol.TILT_VALUES.unpack_from(payload, offset + 1)
+    self.__messagesender.send_tilt(payload[offset], x, y, z)
+
+  def process_device_id(self, payload, offset):
+    self.deviceid = string_from_bytes(bytes(payload[offset:offset + 32]))
+    logging.debug("Cleaned ID is '%s'", self.deviceid)
+
+  def process_device_info(self, payload, offset):
+    # first is device type
+    typenumber = payload[offset]
+    actualtype = self.DEVICE_TYPES[typenumber] if typenumber < len(
+        self.DEVICE_TYPES) else None
     logging.info("Device type is %s", actualtype)
 
-    if (actualtype not in typelist[1:2]):
+    if (actualtype not in self.SUPPORTED_TYPES):
       logging.warn(
-        "Device-Type probably not supported: %s. Only grids are supported for now", actualtype)
+        "Device-Type probably not supported: %s. Only grids and arcs are supported for now", actualtype)
 
-    # third is the number of devices/quads (e.g. 64 buttons per device/quad)
-    devicecount = payload[1]
+    # second is the number of devices/quads (e.g. 64 buttons per device/quad), or of encoders on an arc
+    devicecount = payload[offset + 1]
     logging.debug("Device count is %s", devicecount)
 
-    return(actualtype, devicecount)
+    self.deviceinfo = (actualtype, devicecount)
+
+  def process_grid_offset(self, payload, offset):
+    gridnumber = payload[offset]
+    xoffset = payload[offset + 1]
+    yoffset = payload[offset + 2]
+    self.gridoffset = (gridnumber, xoffset, yoffset)
+
+  def process_grid_size(self, payload, offset):
+    xsize = payload[offset]
+    ysize = payload[offset + 1]
+    self.gridsize = (xsize, ysize)
+
+  def process_device_addr(self, payload, offset):
+    gridaddr = payload[offset]
+    gridtype = payload[offset + 1]
+    self.deviceaddr = (gridaddr, gridtype)
+
+  def process_device_firmware_version(self, payload, offset):
+    self.firmwareversion = string_from_bytes(bytes(payload[offset:offset + 8]))
+
+
+# -----------
+# Keeps track of how much written data the serial link still has to get through, given its baud rate
+# -----------
+class SerialBandwidthBudget:
+  # A start bit, 8 data bits and a stop bit for every byte
+  BITS_PER_BYTE = 10
+
+  def __init__(self, baudrate):
+    super().__init__()
+    self.bytespersecond = baudrate / self.BITS_PER_BYTE
+    # Replaced as a whole by the one thread writing, so readers always see a matching pair
+    self.__backlog = (0.0, time.monotonic())
+
+  def consume(self, count):
+    self.__backlog = (self.backlog_bytes() + count, time.monotonic())
+
+  def backlog_bytes(self):
+    backlog, updatedat = self.__backlog
+    return max(0.0, backlog - (time.monotonic() - updatedat) * self.bytespersecond)
+
+  def backlog_seconds(self):
+    return self.backlog_bytes() / self.bytespersecond
+
+  def available_bytes(self, seconds):
+    # What can be written now and still be through the link within that many seconds
+    return self.bytespersecond * seconds - self.backlog_bytes()
+
 
-  def read_device_id(self):
-    readid = self.__serial.read(32)
-    cleanedid = string_from_bytes(readid)
-    logging.debug("Cleaned ID is '%s'", cleanedid)
-    return cleanedid
+# -----------
+# This is writing to the device, so a slow device does not block osc handling
+# -----------
+class SerialWriter:
+  # Commands writing to these areas are superseded by a later command to the whole grid
+  REGION_COMMANDS = ("led", "map", "row", "col")
+  # Never dropped when the queue is full: queries and settings, which nothing later would make up for
+  KEPT_COMMANDS = ("unique", "intensity", "tilt")
+
+  def __init__(self, serial, maxqueuedepth=256, metrics=None, budget=None):
+    super().__init__()
+    self.__serial = serial
+    self.metrics = metrics if metrics is not None else pyserialoscmetrics.DeviceMetrics()
+    self.budget = budget if budget is not None else SerialBandwidthBudget(115200)
+    self.maxqueuedepth = maxqueuedepth
+    self.running = False
+    self.droppedcommands = 0
+    self.mergedcommands = 0
+    self.__pending = OrderedDict()
+    self.__condition = Condition()
+    self.__uniquekeys = count()
+    self.__write_thread = None
+    self.__unwritten = b""
+    self.__drainscheduled = False
+    self.__waitingforwritable = False
+    self.__encoder = pyserialoscprotocol.SerialFrameEncoder()
+    self.capturestream = "serial:{}".format(serial.port)
+
+  def start(self):
+    logging.debug("Start writing to port %s", self.__serial.port)
+    self.running = True
+    if (pyserialoscengine.is_asyncio()):
+      return
+    self.__write_thread = Thread(target=self.messagewriteloop)
+    self.__write_thread.start()
+
+  def stop(self):
+    logging.debug("Stop writing to port %s", self.__serial.port)
+    with self.__condition:
+      wasrunning = self.running
+      self.running = False
+      self.__condition.notify()
+    if (pyserialoscengine.is_asyncio()):
+      if (wasrunning):
+        # Write what is pending as long as the port takes it without blocking
+        self.drain_on_loop()
+        if (self.__waitingforwritable):
+          pyserialoscengine.loop.remove_writer(self.__serial.fileno())
+    elif (self.__write_thread is not None):
+      self.__write_thread.join()
+
+  def queue_depth(self):
+    return len(self.__pending)
+
+  def write(self, encode, arguments, key=None):
+    # encode is a SerialFrameEncoder method, called with the arguments once the command is written.
+    # Commands with the same key write the same leds, so only the newest one is kept
+    if (key is None):
+      key = ("unique", next(self.__uniquekeys))
+    with self.__condition:
+      if (key[0] == "all"):
+        self.__remove_region_commands()
+      if (key in self.__pending):
+        del self.__pending[key]
+        self.mergedcommands += 1
+      elif (len(self.__pending) >= self.maxqueuedepth):
+        self.__drop_oldest()
+      self.__pending[key] = (encode, arguments)
+      self.__condition.notify()
+    if (pyserialoscengine.is_asyncio() and not self.__drainscheduled and not self.__waitingforwritable):
+      self.__drainscheduled = True
+      pyserialoscengine.loop.call_soon_threadsafe(self.drain_on_loop)
+
+  def __drop_oldest(self):
+    # The oldest led command goes. If there are only queries and settings, the queue gets longer instead
+    for key in self.__pending:
+      if (key[0] not in self.KEPT_COMMANDS):
+        del self.__pending[key]
+        self.droppedcommands += 1
+        return
+
+  def __remove_region_commands(self):
+    for key in [key for key in self.__pending if key[0] in self.REGION_COMMANDS]:
+      del self.__pending[key]
+      self.mergedcommands += 1
+
+  def flush(self):
+    # On the event loop nothing else gets written while the caller blocks, so write right away
+    if (pyserialoscengine.is_asyncio()):
+      self.drain_on_loop()
+
+  def take_pending(self):
+    with self.__condition:
+      pending = self.__pending
+      self.__pending = OrderedDict()
+    return pending
+
+  def encode(self, pending):
+    encoder = self.__encoder
+    encoder.reset()
+    for (encode, arguments) in pending.values():
+      length = encoder.length
+      try:
+        encode(encoder, *arguments)
+      except (struct.error, TypeError, ValueError) as e:
+        # Only this command is lost, not everything written after it
+        logging.warning("Dropping serial command %s%s, Exception was %s", encode.__name__, arguments, e)
+        encoder.length = length
+        self.droppedcommands += 1
+    return encoder.encoded()
+
+  def drain_on_loop(self):
+    # The port is non-blocking, so whatever it does not take now is written once it is writable again
+    self.__drainscheduled = False
+    pending = self.take_pending()
+    try:
+      if (pending and not self.__unwritten):
+        encoded = self.encode(pending)
+        try:
+          written = self.write_to_port(encoded)
+        except BlockingIOError:
+          written = 0
+        self.__unwritten = bytes(encoded[written:])
+      elif (pending):
+        self.__unwritten += self.encode(pending)
+      while (self.__unwritten):
+        written = self.write_to_port(self.__unwritten)
+        self.__unwritten = self.__unwritten[written:]
+    except BlockingIOError:
+      if (not self.__waitingforwritable and self.running):
+        self.__waitingforwritable = True
+        pyserialoscengine.loop.add_writer(
+          self.__serial.fileno(), self.drain_on_loop)
+      return
+    except OSError as e:
+      logging.warn("Could not write to serial, Exception was %s", e)
+      self.running = False
+    if (self.__waitingforwritable):
+      self.__waitingforwritable = False
+      pyserialoscengine.loop.remove_writer(self.__serial.fileno())
+
+  def write_to_port(self, data):
+    # Non-blocking on the event loop, so it may take only part of the data
+    startedat = time.perf_counter()
+    written = os.write(self.__serial.fileno(), data)
+    self.count_written(data[0:written], time.perf_counter() - startedat)
+    return written
+
+  def count_written(self, data, duration):
+    self.metrics.writedurations.observe(duration)
+    self.metrics.serialbytesout += len(data)
+    self.budget.consume(len(data))
+    capture = pyserialosccapture.capture
+    if (capture is not None):
+      capture.record(self.capturestream, pyserialosccapture.SERIAL_OUT, data)
+
+  def messagewriteloop(self):
+    # Keeps going until stopped and everything still pending has been written
+    while (True):
+      with self.__condition:
+        while (self.running and not self.__pending):
+          self.__condition.wait()
+        if (not self.__pending):
+          return
+      try:
+        encoded = self.encode(self.take_pending())
+        startedat = time.perf_counter()
+        self.__serial.write(encoded)
+        self.count_written(encoded, time.perf_counter() - startedat)
+      except (serial.serialutil.SerialException, OSError) as e:
+        logging.warn("Could not write to serial, Exception was %s", e)
+        self.running = False
+        return
 
 
 # -----------
 # This is triggering commands on the device
 # -----------
 class SerialAdapter:
-  def __init__(self, serialport, messagesender):
+  def __init__(self, serialport, messagesender, writequeuedepth=256, readmode="blocking", metrics=None, baudrate=115200):
     super().__init__()
     logging.debug("Initializing serial port %s", serialport)
     self.serialport = serialport
+    # Which device trace records of this port belong to
+    self.traceindex = pyserialosctrace.device_index(serialport)
     self.__serial = serial.Serial()
     self.__serial.port = self.serialport
-    self.__serial.baudrate = 115200
-    self.__listener = SerialListener(self.__serial, messagesender)
+    self.__serial.baudrate = baudrate
+    self.budget = SerialBandwidthBudget(baudrate)
+    self.__listener = SerialListener(self.__serial, messagesender, readmode, metrics)
+    self.__writer = SerialWriter(self.__serial, writequeuedepth, metrics, self.budget)
 
   def start(self):
     logging.info("Opening serial port %s", self.serialport)
@@ -152,7 +522,7 @@ class SerialAdapter:
       self.__serial.open()
       # Flush any remaining fragments
       self.__serial.flush()
-      self.__listener.start()
+      self.__writer.start()
     except serial.serialutil.SerialException as e:
       logging.warn("Could not open port %s, Exception was %s",
              self.serialport, e)
@@ -160,148 +530,172 @@ class SerialAdapter:
 
     return True
 
+  def start_listening(self):
+    # Only once the metadata has been read, so the listener does not take the replies
+    self.__listener.start()
+
   def stop(self):
     logging.info("Closing serial port %s", self.serialport)
     self.__listener.stop()
+    self.__writer.stop()
     if (self.__serial.isOpen()):
       self.__serial.close()
 
   def is_alive(self):
-    return self.__serial.isOpen() and self.__listener.running
+    return self.__serial.isOpen() and self.__listener.running and self.__writer.running
 
-  def get_device_metadata(self):
-    # FIXME: Exception handling if it's not supported?
-    self.request_device_information()
-    self.__serial.read()
-    device_info = self.__listener.read_device_info()
+  def set_rotation(self, rotationtables):
+    self.__listener.rotation = rotationtables if rotationtables.rotation else None
 
-    # FIXME: Exception handling if it's not supported?
-    self.request_device_id()
-    self.__serial.read()
-    device_id = self.__listener.read_device_id()
+  def get_write_queue_stats(self):
+    return (self.__writer.queue_depth(), self.__writer.droppedcommands, self.__writer.mergedcommands)
 
-    self.request_device_size()
-    self.__serial.read()
-    grid_size = self.__listener.process_grid_size()
+  def get_output_backlog(self):
+    # Seconds until everything written so far has gone through the serial link
+    return self.budget.backlog_seconds()
+
+  def get_output_budget(self, seconds):
+    return self.budget.available_bytes(seconds)
+
+  def get_parser_resyncs(self):
+    return self.__listener.parser.resyncs
 
-    return (device_id, device_info, grid_size)
+  def get_device_metadata(self, timeout=None):
+    self.request_device_information()
+    self.request_device_id()
+    self.request_device_size()
+    self.__writer.flush()
+    try:
+      return self.__listener.read_device_metadata(timeout)
+    except (serial.serialutil.SerialException, OSError) as e:
+      logging.warn("Could not read from serial, Exception was %s", e)
+      return None
 
   # device calls
+  def query_device_metadata(self, timeout):
+    # For a device that is already running: the listener takes the answers, we just wait for them
+    self.__listener.clear_device_metadata()
+    self.request_device_information()
+    self.request_device_id()
+    self.request_device_size()
+    deadline = time.monotonic() + timeout
+    while (time.monotonic() < deadline):
+      devicemetadata = self.__listener.get_device_metadata()
+      if (devicemetadata is not None):
+        return devicemetadata
+      time.sleep(0.01)
+    return None
+
   def set_grid_led(self, x, y, newstate):
-    logging.debug("set grid led for device on %s requested for %s:%s to state %s",
-            self.serialport, x, y, newstate)
-    if (newstate):
-      message = b'\x11'
-    else:
-      message = b'\x10'
-    message += int_to_byte(x)
-    message += int_to_byte(y)
-    self.__serial.write(message)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x11 if newstate else 0x10, x, y)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_led, (x, y, newstate), ("led", x, y))
 
   def set_grid_led_all(self, newstate):
-    logging.debug(
-      "set all grid leds for device on %s requested to state %s", self.serialport, newstate)
-    if (newstate):
-      self.__serial.write(b'\x13')
-    else:
-      self.__serial.write(b'\x12')
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x13 if newstate else 0x12)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_all, (newstate,), ("all",))
 
   def set_grid_led_map(self, offsetx, offsety, bitmaparray):
-    logging.debug("set map grid leds for device on %s requested for offset %s, %s to state-bitmap %s",
-            self.serialport, offsetx, offsety, bitmaparray)
-    message = b'\x14'
-    message += int_to_byte(offsetx)
-    message += int_to_byte(offsety)
-    for bitmap in bitmaparray[0:8]:
-      message += int_to_byte(bitmap)
-    self.__serial.write(message)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x14, offsetx, offsety)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_map,
+      (offsetx, offsety, bitmaparray), ("map", offsetx, offsety))
 
   def set_grid_led_row(self, offsetx, offsety, bitmap):
-    logging.debug("set row grid leds for device on %s requested for offsetx %s, y %s to state-bitmap %s",
-            self.serialport, offsetx, offsety, bitmap)
-    message = b'\x15'
-    message += int_to_byte(offsetx)
-    message += int_to_byte(offsety)
-    message += int_to_byte(bitmap)
-    self.__serial.write(message)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x15, offsetx, offsety, bitmap)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_row,
+      (offsetx, offsety, bitmap), ("row", offsetx, offsety))
 
   def set_grid_led_column(self, offsetx, offsety, bitmap):
-    logging.debug("set column grid leds for device on %s requested for x %s, offsety %s to states %s",
-            self.serialport, offsetx, offsety, bitmap)
-    message = b'\x16'
-    message += int_to_byte(offsetx)
-    message += int_to_byte(offsety)
-    message += int_to_byte(bitmap)
-    self.__serial.write(message)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x16, offsetx, offsety, bitmap)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_col,
+      (offsetx, offsety, bitmap), ("col", offsetx, offsety))
 
   def set_grid_intensity(self, newintensity):
-    logging.debug("set intensity for device on %s requested to %s",
-            self.serialport, newintensity)
-    message = b'\x17'
-    message += int_to_byte(newintensity)
-    self.__serial.write(message)
+    newintensity = min(max(int(newintensity), 0), 15)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x17, newintensity)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_intensity,
+      (newintensity,), ("intensity",))
 
   def set_grid_led_level(self, x, y, newlevel):
-    logging.debug("set grid led level for device on %s requested for %s:%s to state %s",
-            self.serialport, x, y, newlevel)
-    message = b'\x18'
-    message += int_to_byte(x)
-    message += int_to_byte(y)
-    message += int_to_byte(newlevel)
-    self.__serial.write(message)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x18, x, y, newlevel)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_led_level,
+      (x, y, newlevel), ("led", x, y))
 
   def set_grid_led_all_level(self, newlevel):
-    logging.debug(
-      "set all grid led levels for device on %s requested to state %s", self.serialport, newlevel)
-    message = b'\x19'
-    message += int_to_byte(newlevel)
-    self.__serial.write(message)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x19, newlevel)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_all_level, (newlevel,), ("all",))
 
   def set_grid_led_map_level(self, offsetx, offsety, levelarray):
-    logging.debug("set all grid led levels for device on %s requested for offset %s, %s to state-bitmap %s",
-            self.serialport, offsetx, offsety, levelarray)
-    message = b'\x1A'
-    message += int_to_byte(offsetx)
-    message += int_to_byte(offsety)
-    for level in levelarray[0:64]:
-      message += int_to_byte(level)
-    self.__serial.write(message)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x1A, offsetx, offsety)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_map_level,
+      (offsetx, offsety, levelarray), ("map", offsetx, offsety))
 
   def set_grid_led_row_level(self, offsetx, offsety, levelarray):
-    logging.debug("set row grid led levels for device on %s requested for offsetx %s, y %s to levels %s",
-            self.serialport, offsetx, offsety, levelarray)
-    message = b'\x1B'
-    message += int_to_byte(offsetx)
-    message += int_to_byte(offsety)
-    for level in levelarray[0:8]:
-      message += int_to_byte(level)
-    self.__serial.write(message)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x1B, offsetx, offsety)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_row_level,
+      (offsetx, offsety, levelarray), ("row", offsetx, offsety))
 
   def set_grid_led_column_level(self, offsetx, offsety, levelarray):
-    logging.debug("set column grid led levels for device on %s requested for x %s, offsety %s to state-bitmap %s",
-            self.serialport, offsetx, offsety, levelarray)
-    message = b'\x1C'
-    message += int_to_byte(offsetx)
-    message += int_to_byte(offsety)
-    for level in levelarray[0:8]:
-      message += int_to_byte(level)
-    self.__serial.write(message)
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x1C, offsetx, offsety)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_col_level,
+      (offsetx, offsety, levelarray), ("col", offsetx, offsety))
+
+  def set_tilt(self, sensor, newstate):
+    if (not 0 <= sensor <= 255):
+      logging.warning("Ignoring tilt sensor %s, there are at most 256", sensor)
+      return
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x82 if newstate else 0x83, sensor)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_tilt_set,
+      (sensor, newstate), ("tilt", sensor))
+
+  def set_ring_all_level(self, ring, newlevel):
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x91, ring, newlevel)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_ring_all,
+      (ring, newlevel), ("ring", ring))
+
+  def set_ring_map_level(self, ring, levelarray):
+    tracer = pyserialosctrace.tracer
+    if (tracer is not None):
+      tracer.record(self.traceindex, pyserialosctrace.TO_DEVICE, 0x92, ring)
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_ring_map,
+      (ring, levelarray), ("ring", ring))
 
   def request_device_information(self):
     logging.debug("Requesting info for device on %s", self.serialport)
-    self.__serial.write(b"\x00")
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_raw, (b"\x00",))
 
   def request_device_id(self):
     logging.debug("Requesting id for device on %s", self.serialport)
-    self.__serial.write(b"\x01")
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_raw, (b"\x01",))
 
   def request_device_size(self):
     logging.debug("Requesting size for adapter %s", self.serialport)
-    self.__serial.write(b"\x05")
-
-
-def int_to_byte(integernumber):
-  return bytes([integernumber])
+    self.__writer.write(pyserialoscprotocol.SerialFrameEncoder.add_raw, (b"\x05",))
 
 
 def string_from_bytes(bytes):
@@ -1,7 +1,834 @@
+import asyncio
+import mmap
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import pytest
+from pythonosc.osc_bundle import OscBundle
+from pythonosc.osc_bundle_builder import OscBundleBuilder
+from pythonosc.osc_message import OscMessage
+from pythonosc.osc_message_builder import OscMessageBuilder
 import pyserialoscd
 import pyserialoscdevice
 import pyserialoscutils
 import pyserialoscserialadapter
+import pyserialoscanimation
+import pyserialoscbenchmark
+import pyserialosccache
+import pyserialosccapture
+import pyserialoscengine
+import pyserialoscframebuffer
+import pyserialoschotplug
+import pyserialoscmetrics
+import pyserialoscprotocol
+import pyserialoscsender
+import pyserialosctrace
+import pyserialoscvirtualdevice
+import pyserialoscworker
+
+# -----------
+# Fixtures. Whatever they start is stopped after the test, devices before the virtual devices behind them
+# -----------
+
+@pytest.fixture
+def receiver():
+  # Stands in for the application
+  receiver = pyserialoscbenchmark.open_receiver()
+  yield receiver
+  receiver.close()
+
+@pytest.fixture
+def virtual_device():
+  # Starts a virtual grid or arc behind a pseudo terminal
+  devices = []
+
+  def start(device):
+    device.start()
+    devices.append(device)
+    return device
+  yield start
+  for device in devices:
+    device.stop()
+
+@pytest.fixture
+def device_endpoint():
+  # Starts a device endpoint for a serial port, listening on a free port
+  devices = []
+
+  def start(serialport, **options):
+    device = pyserialoscdevice.SerialOscDeviceEndpoint(serialport, **options)
+    devices.append(device)
+    assert device.start("localhost", pyserialoscutils.find_free_port())
+    return device
+  yield start
+  for device in devices:
+    device.stop()
+
+@pytest.fixture
+def main_endpoint():
+  # Starts a main endpoint on a free port
+  endpoints = []
+
+  def start(**options):
+    serialosc = pyserialoscd.SerialOscMainEndpoint(**options)
+    endpoints.append(serialosc)
+    serialosc.start("localhost", pyserialoscutils.find_free_port())
+    return serialosc
+  yield start
+  for serialosc in endpoints:
+    serialosc.stop()
 
 def test_answer():
   assert True
+
+def test_framebuffer_only_flushes_changed_quads():
+  framebuffer = pyserialoscframebuffer.LedFramebuffer(16, 8)
+  assert len(framebuffer.pop_changed_quads()) == 2
+
+  for x in range(16):
+    for y in range(8):
+      framebuffer.set_led_level(x, y, 0)
+  framebuffer.set_led_level(9, 3, 15)
+  changedquads = framebuffer.pop_changed_quads()
+  assert [(offsetx, offsety) for (offsetx, offsety, _) in changedquads] == [(8, 0)]
+  assert changedquads[0][2][3 * 8 + 1] == 15
+  assert framebuffer.pop_changed_quads() == []
+
+def test_framebuffer_mono_quads():
+  levels = pyserialoscframebuffer.bitmaps_to_levels([1, 0, 0, 0, 0, 0, 0, 128])
+  assert pyserialoscframebuffer.is_mono_quad(levels)
+  assert pyserialoscframebuffer.levels_to_bitmaps(levels) == [1, 0, 0, 0, 0, 0, 0, 128]
+  assert not pyserialoscframebuffer.is_mono_quad(bytes([7]) * 64)
+
+class FakeSerial:
+  def __init__(self):
+    self.port = "fake"
+    self.written = b""
+
+  def write(self, data):
+    self.written += data
+    return len(data)
+
+def test_serialwriter_merges_superseded_commands():
+  encoder = pyserialoscprotocol.SerialFrameEncoder
+  fakeserial = FakeSerial()
+  writer = pyserialoscserialadapter.SerialWriter(fakeserial, maxqueuedepth=2)
+  writer.write(encoder.add_led, (0, 0, 1), ("led", 0, 0))
+  writer.write(encoder.add_led, (0, 0, 0), ("led", 0, 0))
+  assert writer.queue_depth() == 1 and writer.mergedcommands == 1
+  writer.write(encoder.add_row, (0, 1, 255), ("row", 0, 1))
+  writer.write(encoder.add_intensity, (15,), ("intensity",))
+  assert writer.queue_depth() == 2 and writer.droppedcommands == 1
+  writer.write(encoder.add_all, (0,), ("all",))
+  assert writer.queue_depth() == 2
+
+  writer.start()
+  writer.stop()
+  assert fakeserial.written == b"\x17\x0f\x12"
+
+def test_serialwriter_drops_commands_that_do_not_encode():
+  encoder = pyserialoscprotocol.SerialFrameEncoder
+  fakeserial = FakeSerial()
+  writer = pyserialoscserialadapter.SerialWriter(fakeserial)
+  writer.start()
+  writer.write(encoder.add_intensity, (300,), ("intensity",))
+  writer.write(encoder.add_led, (1, 2, 1), ("led", 1, 2))
+  writer.stop()
+  assert fakeserial.written == b"\x11\x01\x02"
+  assert writer.droppedcommands == 1
+
+def test_serialwriter_keeps_queries_when_full():
+  encoder = pyserialoscprotocol.SerialFrameEncoder
+  fakeserial = FakeSerial()
+  writer = pyserialoscserialadapter.SerialWriter(fakeserial, maxqueuedepth=2)
+  writer.write(encoder.add_raw, (b"\x00",))
+  writer.write(encoder.add_intensity, (7,), ("intensity",))
+  writer.write(encoder.add_led, (1, 1, 1), ("led", 1, 1))
+  assert writer.queue_depth() == 3 and writer.droppedcommands == 0
+  writer.write(encoder.add_led, (2, 2, 1), ("led", 2, 2))
+  assert writer.queue_depth() == 3 and writer.droppedcommands == 1
+
+  writer.start()
+  writer.stop()
+  assert fakeserial.written == b"\x00\x17\x07\x11\x02\x02"
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_blocking_listener_reads_keys():
+  latencies = pyserialoscbenchmark.benchmark_key_latency("blocking", 5)
+  assert len(latencies) == 5
+
+def test_frameparser_handles_chunks_and_resyncs():
+  keys = []
+  parser = pyserialoscprotocol.SerialFrameParser()
+  parser.register(0x21, lambda payload, offset: keys.append(
+      (payload[offset], payload[offset + 1])))
+  parser.register(0x20, lambda payload, offset: None)
+
+  data = b"\x21\x01\x02\xee\x21\x03\x04\x20\x00\x00\x21\x05"
+  for position in range(len(data)):
+    parser.feed(data[position:position + 1])
+  assert keys == [(1, 2), (3, 4)]
+  assert parser.resyncs == 1
+  assert parser.pending_bytes() == 2
+
+  parser.feed(b"\x06")
+  assert keys[-1] == (5, 6)
+  assert parser.pending_bytes() == 0
+
+def test_oscclientpool_reuses_and_evicts_clients():
+  pool = pyserialoscutils.OscClientPool(maxclients=2)
+  first = pool.get("localhost", 10001)
+  assert pool.get("127.0.0.1", 10001) is first
+  pool.get("localhost", 10002)
+  pool.get("localhost", 10003)
+  assert len(pool) == 2
+  assert pool.get("localhost", 10001) is not first
+  pool.invalidate("localhost", 10001)
+  assert len(pool) == 1
+
+def test_sender_bundles_keys_of_one_read(receiver):
+  sender = pyserialoscsender.SerialOscDeviceMessageSender(
+      "/monome", "localhost", receiver.getsockname()[1], keybundlewindow=0)
+  readtime = time.time()
+  sender.begin_batch(readtime)
+  sender.send_grid_key(1, 2, 1)
+  sender.send_grid_key(3, 4, 1)
+  sender.end_batch()
+  bundle = OscBundle(receiver.recv(1024))
+  assert [message.params for message in bundle] == [[1, 2, 1], [3, 4, 1]]
+  assert abs(bundle.timestamp - readtime) < 0.001
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+@pytest.mark.parametrize("oscingress", pyserialoscutils.OscServerWrapper.INGRESS_MODES)
+def test_asyncio_engine_runs_device_on_one_loop(oscingress, virtual_device, receiver):
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid())
+  loop = pyserialoscengine.use_asyncio()
+  try:
+    device = pyserialoscdevice.SerialOscDeviceEndpoint(
+        grid.port, destinationport=receiver.getsockname()[1], oscingress=oscingress)
+    deviceport = pyserialoscutils.find_free_port()
+    assert device.start("localhost", deviceport)
+    assert device.size == [16, 8]
+    loop.run_until_complete(asyncio.sleep(0.1))
+
+    pyserialoscutils.get_osc_client("localhost", deviceport).send_message(
+        "/monome/grid/led/set", 3, 1, 1)
+    grid.press(5, 6)
+    loop.run_until_complete(asyncio.sleep(0.2))
+
+    assert grid.level(3, 1) == 15 and grid.level(4, 1) == 0
+    assert OscMessage(receiver.recv(1024)).params == [5, 6, 1]
+    device.stop()
+    loop.run_until_complete(asyncio.sleep(0.05))
+  finally:
+    pyserialoscengine.loop = None
+    loop.close()
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs inotify")
+def test_hotplug_notices_new_device_nodes():
+  with tempfile.TemporaryDirectory() as devicedirectory:
+    hotplug = pyserialoschotplug.HotplugMonitor(["inotify"], path=devicedirectory)
+    assert hotplug.start() == "inotify"
+    try:
+      assert not hotplug.wait(0.01)
+      open(os.path.join(devicedirectory, "ttyACM0"), "w").close()
+      assert hotplug.wait(1)
+      assert not hotplug.wait(0.01)
+    finally:
+      hotplug.stop()
+
+class FakeDevice:
+  def __init__(self, serialport, alive=True):
+    self.serialport = serialport
+    self.id = serialport
+    self.friendlyname = serialport
+    self.alive = alive
+    self.stopped = False
+
+  def is_alive(self):
+    return self.alive
+
+  def stop(self):
+    self.stopped = True
+
+def test_remove_dead_devices_removes_all_of_them():
+  serialosc = pyserialoscd.SerialOscMainEndpoint()
+  unplugged = [FakeDevice("/dev/ttyACM0"), FakeDevice("/dev/ttyACM1")]
+  dead = FakeDevice("/dev/ttyACM2", alive=False)
+  serialosc.devices = unplugged + [dead, FakeDevice("/dev/ttyACM3")]
+  serialosc.remove_dead_devices(["/dev/ttyACM2", "/dev/ttyACM3"])
+  assert serialosc.get_device_serialportlist() == ["/dev/ttyACM3"]
+  assert all(device.stopped for device in unplugged)
+
+def build_osc_message(address, *osc_arguments):
+  message = OscMessageBuilder(address)
+  for argument in osc_arguments:
+    message.add_arg(argument)
+  return message.build().dgram
+
+def test_device_routes_follow_prefix():
+  device = pyserialoscdevice.SerialOscDeviceEndpoint("/dev/null")
+  device.framebuffer = pyserialoscframebuffer.LedFramebuffer(16, 8)
+  device.framebuffer.pop_changed_quads()
+  assert "/monome/grid/led/level/all" in device.dispatcher.routes
+
+  device.dispatcher.call_handlers_for_packet(
+      build_osc_message("/monome/grid/led/level/all", 5), None)
+  assert [quad[2][0] for quad in device.framebuffer.pop_changed_quads()] == [5, 5]
+
+  device.set_message_prefix("/sys/prefix", "/other")
+  assert "/monome/grid/led/set" not in device.dispatcher.routes
+  device.dispatcher.call_handlers_for_packet(
+      build_osc_message("/other/grid/led/set", 1, 1, 1), None)
+  device.dispatcher.call_handlers_for_packet(
+      build_osc_message("/other/grid/led/set", "1", 1, 1), None)
+  device.dispatcher.call_handlers_for_packet(
+      build_osc_message("/other/led/level/row", 8, 1, 1, 2), None)
+  changedquads = device.framebuffer.pop_changed_quads()
+  assert changedquads[0][2][9] == 15
+  assert changedquads[1][2][8:10] == bytes([1, 2])
+
+def test_device_takes_led_coordinates_as_floats():
+  # Max sends numbers as floats
+  device = pyserialoscdevice.SerialOscDeviceEndpoint("/dev/null")
+  device.framebuffer = pyserialoscframebuffer.LedFramebuffer(16, 8)
+  device.framebuffer.pop_changed_quads()
+  for (address, arguments) in (("/monome/grid/led/set", (1.0, 2.0, 1.0)),
+                               ("/monome/grid/led/level/set", (2.0, 2.0, 7.0)),
+                               ("/monome/grid/led/row", (8.0, 3.0, 3.0)),
+                               ("/monome/grid/led/col", (4.0, 0.0, 16.0)),
+                               ("/monome/grid/led/level/row", (8.0, 5.0, 1.0, 2.0))):
+    device.dispatcher.call_handlers_for_packet(build_osc_message(address, *arguments), None)
+  changedquads = device.framebuffer.pop_changed_quads()
+  assert changedquads[0][2][2 * 8 + 1:2 * 8 + 3] == bytes([15, 7])
+  assert changedquads[0][2][4 * 8 + 4] == 15
+  assert changedquads[1][2][3 * 8:3 * 8 + 3] == bytes([15, 15, 0])
+  assert changedquads[1][2][5 * 8:5 * 8 + 2] == bytes([1, 2])
+
+def test_frameencoder_batches_frames():
+  encoder = pyserialoscprotocol.SerialFrameEncoder(capacity=4)
+  encoder.add_led(1, 2, 1)
+  encoder.add_map(8, 0, [1, 2])
+  encoder.add_map_level(0, 0, bytes(range(16)) * 4)
+  encoder.add_intensity(7)
+  encoded = bytes(encoder.encoded())
+  assert encoded[0:14] == b"\x11\x01\x02\x14\x08\x00\x01\x02" + bytes(6)
+  assert encoded[14:17] == b"\x1a\x00\x00" and encoded[17:81] == bytes(range(16)) * 4
+  assert encoded[81:] == b"\x17\x07"
+  encoder.reset()
+  encoder.add_all_level(3)
+  assert bytes(encoder.encoded()) == b"\x19\x03"
+
+def test_device_takes_whole_frames_as_blob():
+  device = pyserialoscdevice.SerialOscDeviceEndpoint("/dev/null")
+  device.framebuffer = pyserialoscframebuffer.LedFramebuffer(16, 16)
+  device.framebuffer.pop_changed_quads()
+
+  frame = bytearray(16 * 16)
+  frame[9 * 16 + 10] = 20
+  device.dispatcher.call_handlers_for_packet(
+      build_osc_message("/monome/grid/led/level/frame", bytes(frame)), None)
+  changedquads = device.framebuffer.pop_changed_quads()
+  assert [(offsetx, offsety) for (offsetx, offsety, _) in changedquads] == [(8, 8)]
+  assert changedquads[0][2][1 * 8 + 2] == 15
+
+  device.dispatcher.call_handlers_for_packet(
+      build_osc_message("/monome/grid/led/level/frame", bytes(16)), None)
+  assert device.framebuffer.pop_changed_quads() == []
+
+@pytest.mark.parametrize("rotation", pyserialoscutils.ROTATIONS)
+def test_rotated_leds_match_rotated_keys(rotation):
+  tables = pyserialoscutils.rotation_tables(16, 8, rotation)
+  appmap = [[(x * 3 + y) % 16 for x in range(tables.appwidth)]
+            for y in range(tables.appheight)]
+
+  # Whole quads, single leds and whole frames all end up in the same place
+  bymap = pyserialoscframebuffer.LedFramebuffer(16, 8)
+  byled = pyserialoscframebuffer.LedFramebuffer(16, 8)
+  byframe = pyserialoscframebuffer.LedFramebuffer(16, 8)
+  for framebuffer in (bymap, byled, byframe):
+    framebuffer.set_rotation(rotation)
+  for offsety in range(0, tables.appheight, 8):
+    for offsetx in range(0, tables.appwidth, 8):
+      bymap.set_map_level(offsetx, offsety, [appmap[offsety + row][offsetx + column]
+                                             for row in range(8) for column in range(8)])
+  for y in range(tables.appheight):
+    for x in range(tables.appwidth):
+      byled.set_led_level(x, y, appmap[y][x])
+  byframe.set_frame_level(bytes(level for row in appmap for level in row))
+
+  quads = bymap.pop_changed_quads()
+  assert quads == byled.pop_changed_quads() == byframe.pop_changed_quads()
+
+  # A key pressed on the device comes out where the application put the led
+  devicelevels = {(offsetx + index % 8, offsety + index // 8): level
+                  for (offsetx, offsety, levels) in quads for (index, level) in enumerate(levels)}
+  for ((x, y), level) in devicelevels.items():
+    appx, appy = tables.rotate_key(x, y)
+    assert appmap[appy][appx] == level
+  assert pyserialoscutils.rotate_map([[devicelevels[(x, y)] for x in range(16)] for y in range(8)],
+                                     rotation) == appmap
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_virtual_grid_with_quirks_gets_through_startup(virtual_device, device_endpoint):
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid(8, 8, "m0000042", quirks=("mono", "splitreplies", "noise")))
+  device = device_endpoint(grid.port, destinationport=pyserialoscutils.find_free_port())
+  assert device.id == "m0000042" and device.size == [8, 8]
+  device.set_led("/monome/grid/led/set", 2, 2, 1)
+  time.sleep(0.1)
+  assert grid.level(2, 2) == 15
+  # A mono grid ignores anything sent as levels
+  device.set_led_level("/monome/grid/led/level/set", 1, 2, 7)
+  time.sleep(0.1)
+  assert grid.ignoredframes == 1
+  assert (grid.level(1, 2), grid.level(2, 2)) == (0, 15)
+
+def test_histogram_buckets_are_cumulative():
+  histogram = pyserialoscmetrics.Histogram((0.001, 0.01))
+  for value in (0.0005, 0.001, 0.005, 2):
+    histogram.observe(value)
+  assert histogram.samples("latency")[0:3] == [("latency_bucket", (("le", "0.001"),), 2),
+                                               ("latency_bucket", (("le", "0.01"),), 3),
+                                               ("latency_bucket", (("le", "+Inf"),), 4)]
+
+def test_address_counter_counts_from_several_threads():
+  counter = pyserialoscmetrics.AddressCounter()
+
+  def count(prefix):
+    for index in range(2000):
+      counter.count("{}/{}".format(prefix, index % 50))
+  threads = [threading.Thread(target=count, args=(prefix,)) for prefix in ("/a", "/b")]
+  for thread in threads:
+    thread.start()
+  while (any(thread.is_alive() for thread in threads)):
+    counter.samples("osc_messages_out_total")
+  for thread in threads:
+    thread.join()
+  assert sum(value for (name, labels, value) in counter.samples("osc_messages_out_total")) == 4000
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_main_endpoint_reports_device_stats(virtual_device, receiver, main_endpoint):
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid())
+  serialosc = main_endpoint(onlytheseserialports=[grid.port])
+  serialosc.detect_new_devices([grid.port])
+  device = serialosc.devices[0]
+  device.set_destination_port("/sys/port", receiver.getsockname()[1])
+  pyserialoscutils.get_osc_client("localhost", device.port).send_message(
+      "/monome/grid/led/set", 3, 1, 1)
+  grid.press(5, 6)
+  assert OscMessage(receiver.recv(1024)).params == [5, 6, 1]
+  time.sleep(0.1)
+
+  text = serialosc.get_prometheus_text()
+  assert 'pyserialosc_osc_messages_in_total{device="m0000001",address="/monome/grid/led/set"} 1' in text
+  assert 'pyserialosc_key_latency_seconds_count{device="m0000001"} 1' in text
+
+  serialosc.send_stats("/serialosc/stats", "localhost", receiver.getsockname()[1])
+  stats = {}
+  while (True):
+    params = OscMessage(receiver.recv(1024)).params
+    stats[tuple(params[1:-1])] = params[-1]
+    if (params[1] == "led_frames_degraded_total"):
+      break
+  assert stats[("osc_messages_out_total", "/grid/key")] == 1
+  assert stats[("serial_bytes_in_total",)] > 3
+  assert stats[("serial_bytes_out_total",)] > 0
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_silent_port_does_not_hold_up_detection(virtual_device, main_endpoint):
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid())
+  silent = virtual_device(pyserialoscvirtualdevice.VirtualGrid(quirks=("noid",)))
+  ports = [grid.port, silent.port]
+  serialosc = main_endpoint(deviceoptions={"probetimeout": 0.3})
+  starttime = time.monotonic()
+  assert not serialosc.detect_new_devices(ports)
+  assert time.monotonic() - starttime < 1
+  assert [device.serialport for device in serialosc.devices] == [grid.port]
+
+  # The silent port is left alone for a while
+  assert serialosc.backoff.is_waiting(silent.port)
+  assert serialosc.detect_new_devices(ports)
+  assert not serialosc.probing
+  serialosc.backoff.forget_missing([grid.port])
+  assert silent.port not in serialosc.backoff
+
+def wait_for_validations(serialosc):
+  deadline = time.monotonic() + 2
+  while (serialosc.validating and time.monotonic() < deadline):
+    time.sleep(0.05)
+    serialosc.finish_validations()
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_device_cache_restores_devices_and_settings(tmp_path, virtual_device, main_endpoint):
+  cachepath = str(tmp_path / "cache.json")
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid())
+  devicecache = pyserialosccache.DeviceCache(cachepath)
+  serialosc = main_endpoint(devicecache=devicecache)
+  serialosc.detect_new_devices([grid.port])
+  grid.replydelay = 0.2
+  serialosc.devices[0].set_rotation("/sys/rotation", 90)
+  serialosc.devices[0].set_message_prefix("/sys/prefix", "/cached")
+  serialosc.stop()
+
+  devicecache = pyserialosccache.DeviceCache(cachepath)
+  devicecache.load()
+  serialosc = main_endpoint(devicecache=devicecache)
+  starttime = time.monotonic()
+  serialosc.detect_new_devices([grid.port])
+  # Registered before the slow device could have answered a single query
+  assert time.monotonic() - starttime < 0.2
+  device = serialosc.devices[0]
+  assert (device.id, device.rotation, device.messageprefix) == ("m0000001", 90, "/cached")
+  grid.replydelay = 0
+  wait_for_validations(serialosc)
+  assert serialosc.devices == [device] and not serialosc.validating
+  serialosc.stop()
+
+  # A different device behind the same port is noticed and probed instead
+  grid.deviceid = "m0000002"
+  serialosc = main_endpoint(devicecache=devicecache)
+  serialosc.detect_new_devices([grid.port])
+  wait_for_validations(serialosc)
+  assert serialosc.devices == []
+  serialosc.detect_new_devices([grid.port])
+  assert [(device.id, device.rotation) for device in serialosc.devices] == [("m0000002", 0)]
+
+def test_bandwidth_budget_drains_at_baud_rate():
+  budget = pyserialoscserialadapter.SerialBandwidthBudget(10000)
+  budget.consume(500)
+  assert 0.45 < budget.backlog_seconds() <= 0.5
+  assert budget.available_bytes(1) < 600
+  pacer = pyserialoscframebuffer.LedPacer(50)
+  assert pacer.should_skip(budget.backlog_seconds()) and pacer.skippedframes == 1
+  assert not pacer.should_skip(0.01)
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_slow_link_gets_leds_without_levels(virtual_device, device_endpoint):
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid(8, 8))
+  # 1200 baud takes 120 bytes per second, less than one level map at 15 frames per second
+  device = device_endpoint(grid.port, baudrate=1200)
+  device.set_led_level_map("/monome/grid/led/level/map", 0, 0, *([3, 12] * 32))
+  time.sleep(0.2)
+  assert (grid.level(0, 0), grid.level(1, 0)) == (0, 15)
+  targetfps, effectivefps, backlog, skippedframes, degradedframes = device.get_led_output_stats()
+  assert degradedframes == 1 and skippedframes > 0
+
+def test_sender_fans_out_to_subscribers():
+  receivers = [pyserialoscbenchmark.open_receiver() for _ in range(3)]
+  ports = [receiver.getsockname()[1] for receiver in receivers]
+  sender = pyserialoscsender.SerialOscDeviceMessageSender("/monome", "localhost", ports[0], subscriptiontimeout=0.2)
+  try:
+    sender.subscribe("localhost", ports[1])
+    sender.subscribe("localhost", ports[2], "/other")
+    sender.send_grid_key(1, 2, 1)
+    messages = [OscMessage(receiver.recv(1024)) for receiver in receivers]
+    assert [(message.address, message.params) for message in messages] == [
+        ("/monome/grid/key", [1, 2, 1]), ("/monome/grid/key", [1, 2, 1]), ("/other/grid/key", [1, 2, 1])]
+
+    # Whoever else sends to a destination keeps its pooled client
+    client = pyserialoscutils.get_osc_client("localhost", ports[1])
+    sender.unsubscribe("127.0.0.1", ports[1])
+    assert [port for (host, port, prefix) in sender.get_destinations()] == [ports[0], ports[2]]
+    assert pyserialoscutils.get_osc_client("127.0.0.1", ports[1]) is client
+    time.sleep(0.3)
+    assert [port for (host, port, prefix) in sender.get_destinations()] == [ports[0]]
+  finally:
+    for receiver in receivers:
+      receiver.close()
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_arc_sums_up_deltas_and_sends_only_changed_rings(virtual_device, receiver, device_endpoint):
+  arc = virtual_device(pyserialoscvirtualdevice.VirtualArc(2, "m0000100"))
+  device = device_endpoint(arc.port, destinationport=receiver.getsockname()[1], encoderdeltawindow=0.05)
+  assert (device.type, device.rings) == ("encoder", 2)
+  for delta in (1, 2, -1, 3):
+    arc.turn(1, delta)
+  arc.push(1)
+  messages = [OscMessage(receiver.recv(1024)) for _ in range(2)]
+  assert [(message.address, message.params) for message in messages] == [
+      ("/monome/enc/delta", [1, 5]), ("/monome/enc/key", [1, 1])]
+
+  device.set_ring_map("/monome/ring/map", 0, *range(16), *range(16), *range(16), *range(16))
+  device.set_ring_range("/monome/ring/range", 1, 62, 1, 9)
+  time.sleep(0.1)
+  assert [arc.level(0, x) for x in (0, 5, 31, 63)] == [0, 5, 15, 15]
+  assert [arc.level(1, x) for x in (61, 62, 63, 0, 1, 2)] == [0, 9, 9, 9, 9, 0]
+  framesreceived = arc.framesreceived
+  device.set_ring_led("/monome/ring/set", 0, 5, 5)
+  device.set_ring_all("/monome/ring/all", 1, 4)
+  time.sleep(0.1)
+  # Ring 0 did not change, ring 1 went out as one level for the whole ring
+  assert arc.framesreceived == framesreceived + 1
+  assert arc.level(1, 30) == 4
+
+class ScriptedSerial:
+  # Hands out one chunk per read, and waits out the timeout once there are none left
+  def __init__(self, chunks):
+    self.port = "scripted"
+    self.chunks = list(chunks)
+    self.timeout = 0.1
+    self.in_waiting = 0
+    self.reads = 0
+
+  def read(self, size):
+    self.reads += 1
+    if (self.chunks):
+      return self.chunks.pop(0)
+    time.sleep(self.timeout)
+    return b""
+
+def test_encoder_delta_window_waits_on_the_serial_port(receiver):
+  sender = pyserialoscsender.SerialOscDeviceMessageSender(
+      "/monome", "localhost", receiver.getsockname()[1], encoderdeltawindow=0.05)
+  scriptedserial = ScriptedSerial([b"\x50\x01\x02", b"\x50\x01\xff"])
+  listener = pyserialoscserialadapter.SerialListener(scriptedserial, sender)
+  listener.process_data(b"\x50\x01\x03")
+  assert OscMessage(receiver.recv(1024)).params == [1, 4]
+  # Two reads with data, and one waiting out the rest of the window
+  assert scriptedserial.reads == 3 and scriptedserial.timeout == 0.1
+
+def test_ring_framebuffer_takes_floats():
+  # Max sends numbers as floats
+  ringbuffer = pyserialoscframebuffer.RingFramebuffer(2)
+  ringbuffer.pop_changed_rings()
+  ringbuffer.set_led_level(1.0, 5.0, 5.0)
+  ringbuffer.set_range_level(0.0, 2.0, 3.0, 7.0)
+  ringbuffer.set_all_level(2.0, 15)
+  changedrings = ringbuffer.pop_changed_rings()
+  assert [ring for (ring, levels) in changedrings] == [0, 1]
+  assert changedrings[0][1][2:4] == b"\x07\x07" and changedrings[1][1][5] == 5
+
+def test_tilt_decimator_keeps_rate_deadband_and_smoothing():
+  decimator = pyserialoscsender.TiltDecimator(deadband=2, smoothing=0.5)
+  assert decimator.filter(0, 100, 0, 0) == (100, 0, 0)
+  # Smoothed to 102, within the deadband
+  assert decimator.filter(0, 104, 0, 0) is None
+  assert decimator.filter(0, 120, 0, 0) == (111, 0, 0)
+  decimator = pyserialoscsender.TiltDecimator(maxrate=10)
+  assert decimator.filter(1, 5, 5, 5) == (5, 5, 5)
+  assert decimator.filter(1, 6, 6, 6) is None
+  assert decimator.droppedvalues == 1
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_tilt_is_sent_once_enabled(virtual_device, receiver, device_endpoint):
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid(8, 8))
+  device = device_endpoint(grid.port, destinationport=receiver.getsockname()[1], tiltrate=0)
+  grid.tilt(0, 1, 2, 3)
+  time.sleep(0.1)
+  device.set_tilt("/monome/tilt/set", 0, 1)
+  time.sleep(0.1)
+  assert grid.tiltsensors == {0}
+  grid.tilt(0, -4, 5, 6)
+  message = OscMessage(receiver.recv(1024))
+  assert (message.address, message.params) == ("/monome/tilt", [0, -4, 5, 6])
+
+def test_sender_sends_keys_before_tilt(receiver):
+  sender = pyserialoscsender.SerialOscDeviceMessageSender("/monome", "localhost", receiver.getsockname()[1])
+  sender.set_tilt_enabled(0, 1)
+  sender.begin_batch(time.time())
+  sender.send_tilt(0, 1, 2, 3)
+  sender.send_grid_key(1, 2, 1)
+  sender.send_tilt(0, 4, 5, 6)
+  sender.end_batch()
+  messages = [OscMessage(receiver.recv(1024)) for _ in range(2)]
+  # Only the latest tilt values of the read are sent
+  assert [(message.address, message.params) for message in messages] == [
+      ("/monome/grid/key", [1, 2, 1]), ("/monome/tilt", [0, 4, 5, 6])]
+
+def test_trace_buffer_keeps_latest_records_and_dumps_them(tmp_path, receiver):
+  sender = pyserialoscsender.SerialOscDeviceMessageSender("/monome", "localhost", receiver.getsockname()[1])
+  sender.traceindex = pyserialosctrace.device_index("/dev/traced")
+  tracer = pyserialosctrace.enable(3)
+  try:
+    for x in range(5):
+      sender.send_grid_key(x, 1, 1)
+    sender.send_enc(2, 0)
+  finally:
+    pyserialosctrace.disable()
+  assert tracer.written == 6
+  assert tracer.dump(str(tmp_path / "trace.bin")) == 3
+  devicenames, records = pyserialosctrace.read_dump(str(tmp_path / "trace.bin"))
+  assert devicenames[sender.traceindex] == "/dev/traced"
+  assert [(opcode, arguments) for (timestamp, deviceindex, direction, opcode, arguments) in records] == [
+      (0x21, [3, 1, 0, 0]), (0x21, [4, 1, 0, 0]), (0x51, [2, 0, 0, 0])]
+  assert records[0][0] <= records[1][0] <= records[2][0]
+
+  # Arguments beyond 32 bits are cut, rather than failing the traced call
+  tracer = pyserialosctrace.TraceBuffer(2)
+  tracer.record(0, pyserialosctrace.TO_DEVICE, 0x17, 2 ** 40, -2 ** 40)
+  assert pyserialosctrace.RECORD.unpack(tracer.records())[4:6] == (2 ** 31 - 1, -2 ** 31)
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_capture_records_serial_and_osc_and_replays(tmp_path, virtual_device, receiver, device_endpoint):
+  capturepath = str(tmp_path / "capture.bin")
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid(8, 8, "m0000077"))
+  oscout = "osc:127.0.0.1:{}".format(receiver.getsockname()[1])
+  pyserialosccapture.enable(capturepath)
+  try:
+    device = device_endpoint(grid.port, destinationport=receiver.getsockname()[1])
+    pyserialoscutils.get_osc_client("localhost", device.port).send_message("/monome/grid/led/set", 1, 1, 1)
+    grid.press(3, 4)
+    receiver.recv(1024)
+    time.sleep(0.1)
+  finally:
+    pyserialosccapture.disable()
+
+  with open(capturepath, "rb") as capturefile:
+    capturemap = mmap.mmap(capturefile.fileno(), 0, access=mmap.ACCESS_READ)
+  summary = pyserialosccapture.summarize(pyserialosccapture.read_records(capturemap))
+  serialstream = "serial:" + grid.port
+  assert set(summary) >= {(serialstream, pyserialosccapture.SERIAL_IN), (serialstream, pyserialosccapture.SERIAL_OUT),
+                          ("osc:m0000077", pyserialosccapture.OSC_IN), (oscout, pyserialosccapture.OSC_OUT)}
+
+  sent = []
+  def send(timestamp, streamname, kind, payload):
+    if (kind != pyserialosccapture.OSC_OUT or streamname != oscout):
+      return False
+    sent.append(OscMessage(bytes(payload)))
+    return True
+  assert pyserialosccapture.replay(pyserialosccapture.read_records(capturemap), send, speed=0) == 1
+  assert (sent[0].address, sent[0].params) == ("/monome/grid/key", [3, 4, 1])
+  capturemap.close()
+
+def test_decoder_unpacks_messages_and_nested_bundles():
+  message = OscMessageBuilder("/monome/grid/led/level/frame")
+  for argument in (3, 1.5, "text", b"\x01\x02\x03", True):
+    message.add_arg(argument)
+  inner = OscBundleBuilder(0)
+  inner.add_content(pyserialoscutils.build_message("/monome/grid/led/set", (1, 2, 1)))
+  outer = OscBundleBuilder(0)
+  outer.add_content(message.build())
+  outer.add_content(inner.build())
+  messages = []
+  pyserialoscutils.decode_packet(outer.build().dgram, messages)
+  assert [(message.address, list(message)) for message in messages] == [
+      ("/monome/grid/led/level/frame", [3, 1.5, "text", b"\x01\x02\x03", True]),
+      ("/monome/grid/led/set", [1, 2, 1])]
+  with pytest.raises(ValueError):
+    pyserialoscutils.decode_packet(b"/monome\x00,i\x00\x00\x00", messages)
+
+def test_dispatcher_handles_the_rest_of_a_batch_after_a_failing_message():
+  handled = []
+  routedispatcher = pyserialoscutils.RouteDispatcher()
+  routedispatcher.set_routes({"/fails": lambda address, *arguments: [][1],
+                              "/works": lambda address, *arguments: handled.append(arguments)})
+  routedispatcher.dispatch_messages([pyserialoscutils.OscDecodedMessage("/fails", [1]),
+                                     pyserialoscutils.OscDecodedMessage("/works", [2])], ("127.0.0.1", 0))
+  assert handled == [(2,)]
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_batched_ingress_leaves_out_leds_overwritten_in_the_same_batch(virtual_device, device_endpoint):
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid(8, 8))
+  device = device_endpoint(grid.port, oscingress="batched")
+  messages = [pyserialoscutils.build_message("/monome/grid/led/level/set", (x, 0, 9)) for x in range(8)]
+  messages += [pyserialoscutils.build_message("/monome/grid/led/level/all", (4,)),
+               pyserialoscutils.build_message("/monome/grid/led/set", (7, 7, 1))]
+  sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+  try:
+    for message in messages:
+      sender.sendto(message.dgram, ("127.0.0.1", device.port))
+  finally:
+    sender.close()
+  time.sleep(0.2)
+  assert (grid.level(0, 0), grid.level(5, 3), grid.level(7, 7)) == (4, 4, 15)
+
+  decoded = []
+  for message in messages:
+    pyserialoscutils.decode_packet(message.dgram, decoded)
+  ledsset = []
+  device.framebuffer.set_led_level = lambda x, y, level: ledsset.append((x, y, level))
+  device.handle_osc_batch(decoded, ("127.0.0.1", 0))
+  assert ledsset == [(7, 7, 15)]
+  assert device.metrics.oscin.counts["/monome/grid/led/level/set"] == 16
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_crashed_device_worker_is_restarted_on_the_same_port(virtual_device, receiver, main_endpoint):
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid(8, 8, "m0000055"))
+  serialosc = main_endpoint(onlytheseserialports=[grid.port], deviceworkers=2)
+  assert serialosc.detect_new_devices([grid.port])
+  device = serialosc.devices[0]
+  assert (device.id, device.size) == ("m0000055", [8, 8])
+  client = pyserialoscutils.get_osc_client("localhost", device.port)
+  client.send_message("/sys/port", receiver.getsockname()[1])
+  time.sleep(0.2)
+  grid.press(1, 2)
+  assert OscMessage(receiver.recv(1024)).params == [1, 2, 1]
+
+  worker = device.worker
+  os.kill(worker.process.pid, signal.SIGKILL)
+  deadline = time.monotonic() + 10
+  while (worker.restarts == 0 and time.monotonic() < deadline):
+    time.sleep(0.05)
+  assert worker.restarts == 1 and device.is_alive()
+  serialosc.remove_dead_devices([grid.port])
+  assert serialosc.devices == [device]
+
+  # Same port and the /sys/port set before the crash
+  grid.press(3, 4)
+  assert OscMessage(receiver.recv(1024)).params == [3, 4, 1]
+  client.send_message("/monome/grid/led/set", 6, 5, 1)
+  time.sleep(0.2)
+  assert grid.level(6, 5) == 15
+  time.sleep(pyserialoscworker.HEALTH_INTERVAL + 0.2)
+  text = serialosc.get_prometheus_text()
+  assert 'pyserialosc_worker_restarts_total{device="m0000055"} 1' in text
+  assert 'pyserialosc_serial_bytes_in_total{device="m0000055"}' in text
+
+def test_animation_player_follows_the_clock_and_sends_only_new_frames():
+  framebuffer = pyserialoscframebuffer.LedFramebuffer(16, 8)
+  player = pyserialoscanimation.AnimationPlayer()
+  player.define("fade", pyserialoscanimation.Fade(0, 15, 4))
+  assert player.start("fade", fps=10)
+  starttime = player.playing[2]
+  assert player.render(framebuffer, starttime) is None
+  framebuffer.pop_changed_quads()
+  # Still the first frame, so nothing changes
+  assert player.render(framebuffer, starttime + 0.05) is None
+  assert framebuffer.pop_changed_quads() == []
+  # Skipping ahead skips frames, and a fade played once ends on its last one
+  assert player.render(framebuffer, starttime + 0.25) is None
+  assert {bytes(levels) for (x, y, levels) in framebuffer.pop_changed_quads()} == {b"\x0a" * 64}
+  assert player.render(framebuffer, starttime + 1) == "fade"
+  assert player.playing is None
+
+  ramp = pyserialoscanimation.Ramp(0, 15)
+  assert ramp.frame_count(16, 8) == 16
+  assert ramp.render(1, 4, 1) == bytes((15, 0, 5, 10))
+  scroll = pyserialoscanimation.Scroll(bytes((1, 2, 3, 4, 5, 6)), 1, 1)
+  assert scroll.frame_count(3, 2) == 6
+  assert bytes(scroll.render(1, 3, 2)) == bytes((6, 4, 5, 3, 1, 2))
+
+@pytest.mark.skipif(os.name != "posix", reason="needs a pseudo terminal")
+def test_device_plays_uploaded_animations(virtual_device, receiver, device_endpoint):
+  grid = virtual_device(pyserialoscvirtualdevice.VirtualGrid(8, 8))
+  device = device_endpoint(grid.port, destinationport=receiver.getsockname()[1])
+  client = pyserialoscutils.get_osc_client("localhost", device.port)
+  client.send_message("/monome/anim/frame", "blink", bytes((5,)) * 64)
+  client.send_message("/monome/anim/frame", "blink", *([9] * 64))
+  client.send_message("/monome/anim/loop", "blink", 10)
+  time.sleep(0.05)
+  assert grid.level(3, 3) == 5
+  time.sleep(0.1)
+  assert grid.level(3, 3) == 9
+  time.sleep(0.1)
+  assert grid.level(3, 3) == 5
+  client.send_message("/monome/anim/stop")
+
+  client.send_message("/monome/anim/fade", "out", 15, 0, 3)
+  client.send_message("/monome/anim/start", "out", 50)
+  assert OscMessage(receiver.recv(1024)).params == ["out"]
+  time.sleep(0.05)
+  assert grid.level(0, 0) == 0
+
+def test_device_ignores_animation_messages_with_names_for_numbers():
+  device = pyserialoscdevice.SerialOscDeviceEndpoint("/dev/null")
+  for arguments in (("/monome/anim/fade", "n", 0, 15, "x"), ("/monome/anim/fade", "n", 0, 15, 4),
+                    ("/monome/anim/start", "n", "x"), ("/monome/anim/scroll", "s", 3, 1),
+                    ("/monome/anim/frame", "f", 1, b"\x02")):
+    device.dispatcher.call_handlers_for_packet(build_osc_message(*arguments), None)
+  assert list(device.animations.animations) == ["n"]
+  assert device.animations.playing is None
@@ -33,15 +33,15 @@ if __name__ == "__main__":
   testapplication.start(testapplication_ip, testapplication_port)
 
   print("Press CTRL-C to stop")
-  pyserialoscutils.OscClientWrapper(serialosc_ip, serialosc_port).send_message(
+  pyserialoscutils.get_osc_client(serialosc_ip, serialosc_port).send_message(
       "/serialosc/list", "localhost", 15555)
-  pyserialoscutils.OscClientWrapper(
+  pyserialoscutils.get_osc_client(
       device_ip, device_port).send_message("/info", "localhost", 15555)
 
   while(True):
-    pyserialoscutils.OscClientWrapper(device_ip, device_port).send_message(
+    pyserialoscutils.get_osc_client(device_ip, device_port).send_message(
         "/monome/grid/led/set", 5, 7, 1)
     time.sleep(2)
-    pyserialoscutils.OscClientWrapper(device_ip, device_port).send_message(
+    pyserialoscutils.get_osc_client(device_ip, device_port).send_message(
         "/monome/grid/led/set", 5, 7, 0)
     time.sleep(2)
@@ -0,0 +1,129 @@
+import argparse
+import json
+import logging
+import os
+import struct
+import time
+from itertools import count
+from threading import Lock
+
+# Set by enable() to trace into. While it is None tracing costs one global lookup per traced call
+tracer = None
+
+# Which way a traced frame goes: serial frames written to the device, and events from the device sent as OSC
+TO_DEVICE = 0
+FROM_DEVICE = 1
+DIRECTIONS = ("to device", "from device")
+
+# Timestamp, device index, direction, opcode as in pyserialoscprotocol and up to 4 arguments
+RECORD = struct.Struct("<dHBB4i")
+MAX_ARGUMENTS = 4
+# Arguments are stored as 32 bit integers, anything beyond is cut to these
+MIN_ARGUMENT = -2 ** 31
+MAX_ARGUMENT = 2 ** 31 - 1
+
+# A dump starts with this, the length of the json header and the header itself, followed by the records
+MAGIC = b"PYSOTRC1"
+HEADER_LENGTH = struct.Struct("<I")
+
+# Names of devices by index, so records only need a number. Kept whether or not tracing is on
+tracedevices = []
+tracedeviceslock = Lock()
+
+
+def device_index(name):
+  with tracedeviceslock:
+    if (name not in tracedevices):
+      tracedevices.append(name)
+    return tracedevices.index(name)
+
+
+def device_names():
+  return list(tracedevices)
+
+# -----------
+# Fixed size records in a buffer that is allocated once, the oldest records get overwritten
+# -----------
+
+
+class TraceBuffer:
+  def __init__(self, capacity):
+    super().__init__()
+    self.capacity = capacity
+    self.__buffer = bytearray(capacity * RECORD.size)
+    # Taking the next slot does not need a lock, so writers from several threads never wait for each other
+    self.__slots = count()
+    self.written = 0
+
+  def record(self, deviceindex, direction, opcode, *arguments):
+    slot = next(self.__slots)
+    arguments = [min(max(int(argument), MIN_ARGUMENT), MAX_ARGUMENT) for argument in arguments[0:MAX_ARGUMENTS]]
+    arguments += [0] * (MAX_ARGUMENTS - len(arguments))
+    RECORD.pack_into(self.__buffer, (slot % self.capacity) * RECORD.size,
+                     time.monotonic(), deviceindex, direction, opcode, *arguments)
+    # Another thread may have taken a later slot and finished first
+    self.written = max(self.written, slot + 1)
+
+  def records(self):
+    # Oldest first. Records written while copying may show up in place of old ones
+    data = bytes(self.__buffer)
+    written = self.written
+    if (written <= self.capacity):
+      return data[0:written * RECORD.size]
+    start = (written % self.capacity) * RECORD.size
+    return data[start:] + data[0:start]
+
+  def dump(self, path):
+    # Written next to it and then renamed, so the file is never read half written. Returns the number of records
+    records = self.records()
+    header = json.dumps({"devices": device_names(), "record": RECORD.format}).encode()
+    temporarypath = path + ".tmp"
+    with open(temporarypath, "wb") as tracefile:
+      tracefile.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header + records)
+    os.replace(temporarypath, path)
+    logging.info("Dumped %s trace records to %s", len(records) // RECORD.size, path)
+    return len(records) // RECORD.size
+
+
+def enable(capacity):
+  global tracer
+  tracer = TraceBuffer(capacity)
+  return tracer
+
+
+def disable():
+  global tracer
+  tracer = None
+
+
+def read_dump(path):
+  # The device names and (timestamp, device index, direction, opcode, arguments) of each record
+  with open(path, "rb") as tracefile:
+    data = tracefile.read()
+  if (not data.startswith(MAGIC)):
+    raise ValueError("{} is not a trace dump".format(path))
+  headerstart = len(MAGIC) + HEADER_LENGTH.size
+  headerlength = HEADER_LENGTH.unpack_from(data, len(MAGIC))[0]
+  header = json.loads(data[headerstart:headerstart + headerlength].decode())
+  records = [(timestamp, deviceindex, direction, opcode, arguments)
+             for (timestamp, deviceindex, direction, opcode, *arguments)
+             in RECORD.iter_unpack(data[headerstart + headerlength:])]
+  return header["devices"], records
+
+
+# -----------
+# Main entry point, prints a trace dump as text
+# -----------
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.description = "Prints a trace dump written by pyserialoscd, one record per line"
+  parser.add_argument("dumpfile", help="The trace dump, as written to --tracefile")
+  args = parser.parse_args()
+
+  devicenames, records = read_dump(args.dumpfile)
+  starttime = records[0][0] if records else 0
+  for (timestamp, deviceindex, direction, opcode, arguments) in records:
+    devicename = devicenames[deviceindex] if deviceindex < len(devicenames) else deviceindex
+    print("{:12.6f} {} {:<11} 0x{:02X} {}".format(
+        timestamp - starttime, devicename, DIRECTIONS[direction], opcode,
+        " ".join(str(argument) for argument in arguments)))
@@ -1,14 +1,24 @@
 from __future__ import absolute_import
 import logging
-from threading import Thread
+from threading import Thread, Lock
 from contextlib import closing
+from collections import OrderedDict
+import time
+import functools
+import operator
+import select
 import socket
+import struct
 import sys
 import os
 from pythonosc import dispatcher
 from pythonosc import osc_server
 from pythonosc.udp_client import SimpleUDPClient
+from pythonosc.osc_bundle_builder import OscBundleBuilder
+from pythonosc.osc_message_builder import OscMessageBuilder
 import pyserialoscutils
+import pyserialoscengine
+import pyserialosccapture
 
 # chose an implementation, depending on os
 #~ if sys.platform == 'cli':
@@ -36,19 +46,261 @@ class OscClientWrapper:
   def send_message(self, address, *osc_arguments):
     logging.debug("Sending message to %s:%s with path %s and data %s",
                   self.targethost, self.targetport, address, osc_arguments)
+    if (pyserialosccapture.capture is not None):
+      self.send(build_message(address, osc_arguments))
+      return
     self.__client.send_message(address, osc_arguments)
 
+  def send_bundle(self, messages, timetag):
+    # messages are (address, arguments) tuples, timetag is a time.time() timestamp
+    logging.debug("Sending bundle to %s:%s with %s messages",
+                  self.targethost, self.targetport, len(messages))
+    self.send(build_bundle(messages, timetag))
+
+  def send(self, content):
+    # An already built message or bundle, so it can go to several clients without being encoded again
+    self.__client.send(content)
+    capture = pyserialosccapture.capture
+    if (capture is not None):
+      capture.record("osc:{}:{}".format(self.targethost, self.targetport),
+                     pyserialosccapture.OSC_OUT, content.dgram)
+
+
+def build_message(address, osc_arguments):
+  message = OscMessageBuilder(address)
+  for argument in osc_arguments:
+    message.add_arg(argument)
+  return message.build()
+
+
+def build_bundle(messages, timetag):
+  bundle = OscBundleBuilder(timetag)
+  for (address, osc_arguments) in messages:
+    bundle.add_content(build_message(address, osc_arguments))
+  return bundle.build()
+
+# -----------
+# Decodes incoming OSC without the generic parsing of pythonosc, for the batched ingress
+# -----------
+
+
+class OscDecodedMessage:
+  # Quacks enough like pythonosc's OscMessage for dispatcher handlers: an address, and iterating gives the arguments
+  __slots__ = ("address", "params")
+
+  def __init__(self, address, params):
+    self.address = address
+    self.params = params
+
+  def __iter__(self):
+    return iter(self.params)
+
+
+OSC_BUNDLE_START = b"#bundle\x00"
+# Fixed size arguments by type tag
+OSC_ARGUMENT_FORMATS = {"i": struct.Struct(">i"), "f": struct.Struct(">f"),
+                        "h": struct.Struct(">q"), "d": struct.Struct(">d"),
+                        "t": struct.Struct(">Q")}
+OSC_CONSTANTS = {"T": True, "F": False, "N": None}
+OSC_SIZE = struct.Struct(">i")
+
+
+def decode_packet(data, messages):
+  # Appends every message in data, also those in (nested) bundles, to messages. Timetags are not waited for.
+  # Raises ValueError for anything that is not valid OSC
+  try:
+    if (data.startswith(OSC_BUNDLE_START)):
+      position = len(OSC_BUNDLE_START) + 8
+      while (position < len(data)):
+        size = OSC_SIZE.unpack_from(data, position)[0]
+        position += 4
+        if (size <= 0 or position + size > len(data)):
+          raise ValueError("bundle element of {} bytes does not fit".format(size))
+        decode_packet(data[position:position + size], messages)
+        position += size
+    else:
+      messages.append(decode_message(data))
+  except (struct.error, IndexError, UnicodeDecodeError) as e:
+    raise ValueError(str(e))
+
+
+def decode_string(data, position):
+  # The string and the position after its padding
+  end = data.index(b"\x00", position)
+  return data[position:end].decode("utf-8"), (end + 4) & ~3
+
+
+def decode_message(data):
+  address, position = decode_string(data, 0)
+  if (not address.startswith("/")):
+    raise ValueError("not an OSC address: {}".format(address))
+  if (position >= len(data)):
+    # No type tags at all, as sent by some old clients
+    return OscDecodedMessage(address, ())
+  typetags, position = decode_string(data, position)
+  if (not typetags.startswith(",")):
+    raise ValueError("no type tags in message to {}".format(address))
+  params = []
+  for typetag in typetags[1:]:
+    argumentformat = OSC_ARGUMENT_FORMATS.get(typetag)
+    if (argumentformat is not None):
+      params.append(argumentformat.unpack_from(data, position)[0])
+      position += argumentformat.size
+    elif (typetag == "s"):
+      value, position = decode_string(data, position)
+      params.append(value)
+    elif (typetag == "b"):
+      size = OSC_SIZE.unpack_from(data, position)[0]
+      position += 4
+      if (size < 0 or position + size > len(data)):
+        raise ValueError("blob of {} bytes does not fit".format(size))
+      params.append(bytes(data[position:position + size]))
+      position += (size + 3) & ~3
+    elif (typetag in OSC_CONSTANTS):
+      params.append(OSC_CONSTANTS[typetag])
+    else:
+      raise ValueError("unsupported type tag {} in message to {}".format(typetag, address))
+  return OscDecodedMessage(address, params)
+
+# -----------
+# Keeps one client per destination around, instead of opening a socket per message
+# -----------
+
+
+class OscClientPool:
+  def __init__(self, maxclients=64, idletimeout=300):
+    super().__init__()
+    self.maxclients = maxclients
+    self.idletimeout = idletimeout
+    self.__clients = OrderedDict()
+    self.__lock = Lock()
+
+  def get(self, targethost, targetport):
+    key = (map_localhost_to_ip4(targethost), targetport)
+    now = time.monotonic()
+    with self.__lock:
+      entry = self.__clients.pop(key, None)
+      if (entry is None):
+        client = OscClientWrapper(key[0], key[1])
+      else:
+        client = entry[0]
+      self.__evict(now)
+      # Most recently used ones go to the end
+      self.__clients[key] = (client, now)
+      return client
+
+  def invalidate(self, targethost, targetport):
+    with self.__lock:
+      self.__clients.pop((map_localhost_to_ip4(targethost), targetport), None)
+
+  def clear(self):
+    with self.__lock:
+      self.__clients.clear()
+
+  def __len__(self):
+    return len(self.__clients)
+
+  def __evict(self, now):
+    while (self.__clients):
+      key, (client, lastused) = next(iter(self.__clients.items()))
+      if (len(self.__clients) < self.maxclients and now - lastused < self.idletimeout):
+        break
+      logging.debug("Dropping OSC client for %s:%s", key[0], key[1])
+      del self.__clients[key]
+
+
+oscclientpool = OscClientPool()
+
+
+def get_osc_client(targethost, targetport):
+  return oscclientpool.get(targethost, targetport)
+
+# -----------
+# Looks up exact addresses in a table first, before falling back to pattern matching
+# -----------
+
+
+class RouteDispatcher(dispatcher.Dispatcher):
+  def __init__(self):
+    super().__init__()
+    self.routes = {}
+    # If set, an AddressCounter counting every incoming address
+    self.addresscounter = None
+    # Name of the incoming datagrams in a capture, set once the server starts
+    self.capturestream = None
+
+  def dispatch_messages(self, messages, client_address):
+    # For decoded messages, as pythonosc would do for each of them. One that fails does not take the others with it
+    for message in messages:
+      try:
+        for handler in self.handlers_for_address(message.address):
+          handler.invoke(client_address, message)
+      except Exception as e:
+        logging.warning("Could not handle %s from %s, Exception was %s", message.address, client_address, e)
+
+  def set_routes(self, routes):
+    # Replaced as a whole, so messages arriving meanwhile see either the old or the new table
+    self.routes = {address: dispatcher.Handler(callback, [])
+                   for (address, callback) in routes.items()}
+
+  def call_handlers_for_packet(self, data, client_address):
+    capture = pyserialosccapture.capture
+    if (capture is not None):
+      capture.record(self.capturestream, pyserialosccapture.OSC_IN, data)
+    return super().call_handlers_for_packet(data, client_address)
+
+  def handlers_for_address(self, address_pattern):
+    if (self.addresscounter is not None):
+      self.addresscounter.count(address_pattern)
+    handler = self.routes.get(address_pattern)
+    if (handler is not None):
+      return (handler,)
+    return super().handlers_for_address(address_pattern)
+
+
+class OscRoute:
+  NUMBER_TYPES = (int, float)
+  BLOB_TYPES = (bytes,)
+  NAME_TYPES = (str, bytes)
+
+  def __init__(self, callback, minarguments, argumenttypes=NUMBER_TYPES, leadingtypes=()):
+    super().__init__()
+    self.callback = callback
+    self.minarguments = minarguments
+    self.argumenttypes = argumenttypes
+    # Types of the first arguments one by one, e.g. a name in front of numbers. The rest are argumenttypes
+    self.leadingtypes = leadingtypes
+
+  def __call__(self, address, *osc_arguments):
+    if (len(osc_arguments) < self.minarguments):
+      logging.warning("Ignoring %s, expected at least %s arguments but got %s",
+                      address, self.minarguments, osc_arguments)
+      return
+    for (index, argument) in enumerate(osc_arguments):
+      argumenttypes = self.leadingtypes[index] if index < len(self.leadingtypes) else self.argumenttypes
+      if (type(argument) not in argumenttypes):
+        logging.warning("Ignoring %s, expected arguments of type %s but got %s",
+                        address, self.argumenttypes, osc_arguments)
+        return
+    self.callback(address, *osc_arguments)
+
 # -----------
 # For easy starting and stopping of oscservers
 # -----------
 
 
 class OscServerWrapper:
-  def __init__(self, friendlyname):
+  INGRESS_MODES = ("pythonosc", "batched")
+  # Datagrams handled per wakeup of the batched ingress at most, so one busy client does not keep the others waiting
+  MAX_BATCH_DATAGRAMS = 1024
+
+  def __init__(self, friendlyname, ingress="pythonosc"):
     super().__init__()
     self.friendlyname = friendlyname
-    self.dispatcher = dispatcher.Dispatcher()
+    self.dispatcher = RouteDispatcher()
     self.dispatcher.set_default_handler(self.default_osc_handler, self)
+    # pythonosc handles one datagram at a time, batched takes everything waiting and hands it to handle_osc_batch
+    self.ingress = ingress
     self.running = False
 
   def default_osc_handler(self, source, *osc_arguments):
@@ -58,6 +310,12 @@ class OscServerWrapper:
   def start(self, host, port):
     self.host = map_localhost_to_ip4(host)
     self.port = port
+    self.dispatcher.capturestream = "osc:{}".format(self.friendlyname)
+
+    if (self.ingress == "batched"):
+      return self.__start_batched()
+    if (pyserialoscengine.is_asyncio()):
+      return self.__start_asyncio()
 
     try:
       self.__server = osc_server.BlockingOSCUDPServer(
@@ -74,9 +332,101 @@ class OscServerWrapper:
     self.running = True
     return True
 
+  def __start_asyncio(self):
+    # Binding here, so a port that is in use is reported right away
+    try:
+      serversocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      serversocket.bind((self.host, self.port))
+    except OSError as e:
+      serversocket.close()
+      logging.warn("WARNING: Error starting OSCUDPServer %s: %s.",
+                   self.friendlyname, e)
+      return False
+
+    logging.info("Starting OSC server %s on: %s:%s",
+                 self.friendlyname, self.host, self.port)
+    self.__endpoint = pyserialoscengine.loop.create_task(
+        pyserialoscengine.loop.create_datagram_endpoint(
+            lambda: pyserialoscengine.OscDatagramProtocol(self.dispatcher), sock=serversocket))
+    self.running = True
+    return True
+
+  def __start_batched(self):
+    try:
+      serversocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      serversocket.bind((self.host, self.port))
+    except OSError as e:
+      serversocket.close()
+      logging.warn("WARNING: Error starting OSCUDPServer %s: %s.",
+                   self.friendlyname, e)
+      return False
+    serversocket.setblocking(False)
+    # Room for a burst to wait until the next wakeup
+    serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    self.__socket = serversocket
+
+    logging.info("Starting batched OSC server %s on: %s:%s",
+                 self.friendlyname, self.host, self.port)
+    self.running = True
+    if (pyserialoscengine.is_asyncio()):
+      pyserialoscengine.loop.add_reader(serversocket.fileno(), self.drain_socket)
+      return True
+    self.__server_thread = Thread(target=self.batchedreceiveloop)
+    self.__server_thread.start()
+    return True
+
+  def batchedreceiveloop(self):
+    while (self.running):
+      # Wakes up regularly to check for stop
+      if (select.select([self.__socket], [], [], 0.1)[0]):
+        self.drain_socket()
+
+  def drain_socket(self):
+    messages = []
+    clientaddress = None
+    capture = pyserialosccapture.capture
+    for _ in range(self.MAX_BATCH_DATAGRAMS):
+      try:
+        data, clientaddress = self.__socket.recvfrom(65536)
+      except (BlockingIOError, InterruptedError):
+        break
+      except OSError as e:
+        logging.warning("Could not receive OSC on %s, Exception was %s", self.friendlyname, e)
+        break
+      if (capture is not None):
+        capture.record(self.dispatcher.capturestream, pyserialosccapture.OSC_IN, data)
+      try:
+        decode_packet(data, messages)
+      except ValueError as e:
+        logging.warning("Ignoring OSC packet from %s that could not be decoded: %s", clientaddress, e)
+    if (messages):
+      try:
+        self.handle_osc_batch(messages, clientaddress)
+      except Exception as e:
+        logging.warning("Could not handle OSC from %s, Exception was %s", clientaddress, e)
+
+  def handle_osc_batch(self, messages, client_address):
+    # Everything read in one wakeup, oldest first. client_address is where the last datagram came from
+    self.dispatcher.dispatch_messages(messages, client_address)
+
   def stop(self):
     logging.info("Stopping OSC server: %s", self.friendlyname)
-    if (self.running):
+    if (not self.running):
+      return
+    self.running = False
+    if (self.ingress == "batched"):
+      if (pyserialoscengine.is_asyncio()):
+        pyserialoscengine.loop.remove_reader(self.__socket.fileno())
+      else:
+        self.__server_thread.join()
+      self.__socket.close()
+    elif (pyserialoscengine.is_asyncio()):
+      if (self.__endpoint.done()):
+        self.__endpoint.result()[0].close()
+      else:
+        self.__endpoint.add_done_callback(
+            lambda endpoint: endpoint.result()[0].close())
+    else:
       self.__server.shutdown()
       self.__server_thread.join()
 
@@ -102,10 +452,59 @@ def list_serial_ports():
 
     return portlist
 
-# unused so far - might include in pyserialoscdevice later
+
+def serial_port_keys(serialports):
+    # Tells devices apart by usb serial number where there is one, so they are recognized on any port
+    keys = {serialport: "port:" + serialport for serialport in serialports}
+    for port in comports(include_links=True):
+        if (port.device not in keys):
+            continue
+        if (port.serial_number):
+            keys[port.device] = "usb:" + port.serial_number
+        elif (port.vid is not None):
+            keys[port.device] = "usb:{:04x}:{:04x}@{}".format(
+                port.vid, port.pid or 0, port.device)
+    return keys
+
+# -----------
+# Remembers ports without a device we understand, so they are not opened over and over again
+# -----------
+
+
+class PortBackoff:
+  def __init__(self, initialdelay=2, maxdelay=60):
+    super().__init__()
+    self.initialdelay = initialdelay
+    self.maxdelay = maxdelay
+    # port: (delay, monotonic time of the next try)
+    self.__ports = {}
+
+  def failed(self, serialport):
+    delay, _ = self.__ports.get(serialport, (self.initialdelay / 2, 0))
+    delay = min(delay * 2, self.maxdelay)
+    self.__ports[serialport] = (delay, time.monotonic() + delay)
+    logging.info("Not trying serial port %s again for %s seconds", serialport, delay)
+
+  def succeeded(self, serialport):
+    self.__ports.pop(serialport, None)
+
+  def is_waiting(self, serialport):
+    entry = self.__ports.get(serialport)
+    return entry is not None and time.monotonic() < entry[1]
+
+  def forget_missing(self, currentports):
+    # Something plugged in again gets a fresh chance
+    for serialport in set(self.__ports).difference(currentports):
+      del self.__ports[serialport]
+
+  def __contains__(self, serialport):
+    return serialport in self.__ports
+
+ROTATIONS = (0, 90, 180, 270)
 
 
 def rotate_coordinates(x, y, xsize, ysize, degrees):
+  # From device coordinates to what the application sees, which is ysize x xsize for 90 and 270 degrees
   if (degrees == 0):
     return (x, y)
   elif(degrees == 90):
@@ -121,14 +520,85 @@ def rotate_coordinates(x, y, xsize, ysize, degrees):
 
 
 def rotate_map(map, degrees):
-  returnmap = map
+  # map is a list of rows, rotated the same way as rotate_coordinates does it
   if (not degrees % 90 == 0):
     logging.error(
         "Only rotations in increments of 90 are allowed (i.e. 0, 90, 180, 270). Got %s. Ignoring rotation.", degrees)
-    return
+    return map
 
-  rotatetimes = int(degrees / 90)
+  returnmap = [list(row) for row in map]
+  rotatetimes = int(degrees / 90) % 4
   for _ in range(rotatetimes):
-    returnmap = zip(*returnmap[::-1])
+    returnmap = [list(row) for row in zip(*returnmap)][::-1]
 
   return returnmap
+
+# -----------
+# Everything needed to rotate a grid, computed once per size and rotation
+# -----------
+
+
+class RotationTables:
+  QUAD_SIZE = 8
+
+  def __init__(self, width, height, rotation):
+    super().__init__()
+    self.width = width
+    self.height = height
+    self.rotation = rotation
+    if (rotation in (90, 270)):
+      self.appwidth, self.appheight = height, width
+    else:
+      self.appwidth, self.appheight = width, height
+
+    # Application coordinates of each key, by device index
+    self.keycoordinates = [rotate_coordinates(x, y, width, height, rotation)
+                           for y in range(height) for x in range(width)]
+    # Device index of each led, by application index
+    self.ledindices = [0] * (width * height)
+    for (deviceindex, (appx, appy)) in enumerate(self.keycoordinates):
+      self.ledindices[appy * self.appwidth + appx] = deviceindex
+    # Picks the application levels in device order out of a whole frame
+    self.frameorder = permutation(
+        [self.keycoordinates[deviceindex][1] * self.appwidth + self.keycoordinates[deviceindex][0]
+         for deviceindex in range(width * height)])
+
+    # For each whole application quad, the device quad it ends up in and the order of its levels there
+    self.quadpermutations = {}
+    for appoffsety in range(0, self.appheight - self.QUAD_SIZE + 1, self.QUAD_SIZE):
+      for appoffsetx in range(0, self.appwidth - self.QUAD_SIZE + 1, self.QUAD_SIZE):
+        self.quadpermutations[(appoffsetx, appoffsety)] = self.__quad_permutation(
+            appoffsetx, appoffsety)
+
+  def __quad_permutation(self, appoffsetx, appoffsety):
+    deviceindices = [self.ledindices[(appoffsety + row) * self.appwidth + appoffsetx + column]
+                     for row in range(self.QUAD_SIZE) for column in range(self.QUAD_SIZE)]
+    deviceoffsetx = min(deviceindex % self.width for deviceindex in deviceindices)
+    deviceoffsety = min(deviceindex // self.width for deviceindex in deviceindices)
+    quadorder = [0] * len(deviceindices)
+    for (quadindex, deviceindex) in enumerate(deviceindices):
+      devicequadindex = (deviceindex // self.width - deviceoffsety) * self.QUAD_SIZE + \
+          deviceindex % self.width - deviceoffsetx
+      quadorder[devicequadindex] = quadindex
+    return (deviceoffsetx, deviceoffsety, permutation(quadorder))
+
+  def rotate_key(self, x, y):
+    if (x >= self.width or y >= self.height):
+      return (x, y)
+    return self.keycoordinates[y * self.width + x]
+
+
+@functools.lru_cache(maxsize=None)
+def rotation_tables(width, height, rotation):
+  return RotationTables(width, height, rotation)
+
+
+def permutation(indices):
+  # A function returning the items at these indices as a tuple, in C rather than in a python loop
+  if (not indices):
+    # Devices without a grid, like the arc
+    return lambda items: ()
+  if (len(indices) == 1):
+    index = indices[0]
+    return lambda items: (items[index],)
+  return operator.itemgetter(*indices)
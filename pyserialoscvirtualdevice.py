@@ -0,0 +1,377 @@
+import argparse
+import logging
+import os
+import select
+import sys
+import time
+import tty
+from threading import Thread, Lock
+
+import serial
+import pyserialoscprotocol
+
+# Quirks of real devices a virtual one can be told to have
+QUIRKS = ("mono", "noid", "splitreplies", "noise")
+
+# -----------
+# A pseudo terminal standing in for a serial port, so no hardware is needed
+# -----------
+
+
+class PtyPort:
+  def __init__(self):
+    super().__init__()
+    self.masterfd, self.slavefd = os.openpty()
+    tty.setraw(self.slavefd)
+    self.port = os.ttyname(self.slavefd)
+
+  def open_serial(self):
+    serialport = serial.Serial()
+    serialport.port = self.port
+    serialport.baudrate = 115200
+    serialport.open()
+    return serialport
+
+  def write(self, data):
+    os.write(self.masterfd, data)
+
+  def close(self):
+    os.close(self.slavefd)
+    os.close(self.masterfd)
+
+# -----------
+# A device behind a pseudo terminal that answers queries. VirtualGrid and VirtualArc add what they do with the rest
+# -----------
+
+
+class VirtualDevice:
+  def __init__(self, deviceid, firmware="virtual", quirks=(), replydelay=0):
+    super().__init__()
+    self.deviceid = deviceid
+    self.firmware = firmware
+    # mono: ignores varibright frames like the older grids, noid: never says who it is,
+    # splitreplies: answers one byte at a time, noise: sends garbage before the first answer
+    self.quirks = set(quirks)
+    self.replydelay = replydelay
+    self.bytesreceived = 0
+    self.framesreceived = 0
+    self.ignoredframes = 0
+    self.running = False
+    self.ptyport = None
+    self.port = None
+    self.__writelock = Lock()
+    self.__sentnoise = False
+    self.parser = pyserialoscprotocol.SerialFrameParser(
+        pyserialoscprotocol.HOST_FRAME_LENGTHS)
+    for (opcode, process) in ((0x00, self.process_info_request),
+                              (0x01, self.process_id_request),
+                              (0x0F, self.process_firmware_request)) + self.frame_handlers():
+      self.parser.register(opcode, self.__counted(opcode, process))
+
+  def frame_handlers(self):
+    # (opcode, process) for every frame the device understands besides the queries
+    return ()
+
+  def ignores(self, opcode):
+    return False
+
+  def start(self):
+    self.ptyport = PtyPort()
+    self.port = self.ptyport.port
+    self.running = True
+    self.__responder_thread = Thread(target=self.respondloop, daemon=True)
+    self.__responder_thread.start()
+    return self.port
+
+  def stop(self):
+    if (not self.running):
+      return
+    self.running = False
+    self.__responder_thread.join()
+    self.ptyport.close()
+
+  def respondloop(self):
+    while (self.running):
+      if (not select.select([self.ptyport.masterfd], [], [], 0.05)[0]):
+        continue
+      try:
+        data = os.read(self.ptyport.masterfd, 4096)
+      except OSError:
+        # Happens when the other end closes the port
+        time.sleep(0.05)
+        continue
+      self.bytesreceived += len(data)
+      self.parser.feed(data)
+
+  def write(self, data):
+    with self.__writelock:
+      self.ptyport.write(data)
+
+  def reply(self, data):
+    if (self.replydelay):
+      time.sleep(self.replydelay)
+    if ("noise" in self.quirks and not self.__sentnoise):
+      self.__sentnoise = True
+      self.write(b"\xee\xff")
+    if ("splitreplies" in self.quirks):
+      for byte in data:
+        self.write(bytes((byte,)))
+    else:
+      self.write(data)
+
+  def __counted(self, opcode, process):
+    def counted(payload, offset):
+      self.framesreceived += 1
+      if (self.ignores(opcode)):
+        self.ignoredframes += 1
+        return
+      process(payload, offset)
+    return counted
+
+  def process_info_request(self, payload, offset):
+    pass
+
+  def process_id_request(self, payload, offset):
+    if ("noid" in self.quirks):
+      return
+    self.reply(b"\x01" + self.deviceid.encode()[0:32].ljust(32, b"\x00"))
+
+  def process_firmware_request(self, payload, offset):
+    self.reply(b"\x0f" + self.firmware.encode()[0:8].ljust(8, b"\x00"))
+
+# -----------
+# A grid that keeps its led levels and sends key presses
+# -----------
+
+
+class VirtualGrid(VirtualDevice):
+  def __init__(self, width=16, height=8, deviceid="m0000001", firmware="virtual", quirks=(), replydelay=0):
+    self.width = width
+    self.height = height
+    self.levels = bytearray(width * height)
+    self.intensity = 15
+    # Tilt sensors switched on by the host
+    self.tiltsensors = set()
+    super().__init__(deviceid, firmware, quirks, replydelay)
+
+  def frame_handlers(self):
+    return ((0x05, self.process_size_request),
+            (0x10, self.process_led_off),
+            (0x11, self.process_led_on),
+            (0x12, self.process_all_off),
+            (0x13, self.process_all_on),
+            (0x14, self.process_map),
+            (0x15, self.process_row),
+            (0x16, self.process_col),
+            (0x17, self.process_intensity),
+            (0x18, self.process_led_level),
+            (0x19, self.process_all_level),
+            (0x1A, self.process_map_level),
+            (0x1B, self.process_row_level),
+            (0x1C, self.process_col_level),
+            (0x82, self.process_tilt_enable),
+            (0x83, self.process_tilt_disable))
+
+  def ignores(self, opcode):
+    # Varibright frames
+    return 0x18 <= opcode <= 0x1C and "mono" in self.quirks
+
+  def press(self, x, y):
+    self.write(bytes((0x21, x, y)))
+
+  def release(self, x, y):
+    self.write(bytes((0x20, x, y)))
+
+  def level(self, x, y):
+    return self.levels[y * self.width + x]
+
+  def tilt(self, n, x, y, z):
+    self.write(bytes((0x81, n)) + pyserialoscprotocol.TILT_VALUES.pack(x, y, z))
+
+  def process_tilt_enable(self, payload, offset):
+    self.tiltsensors.add(payload[offset])
+
+  def process_tilt_disable(self, payload, offset):
+    self.tiltsensors.discard(payload[offset])
+
+  # -----------
+  # Queries
+  # -----------
+
+  def process_info_request(self, payload, offset):
+    quads = max(1, (self.width // 8) * (self.height // 8))
+    self.reply(bytes((0x00, 0x01, quads)))
+
+  def process_size_request(self, payload, offset):
+    self.reply(bytes((0x03, self.width, self.height)))
+
+  # -----------
+  # Leds, which end up as levels whatever way they were set
+  # -----------
+
+  def set_level(self, x, y, level):
+    if (0 <= x < self.width and 0 <= y < self.height):
+      self.levels[y * self.width + x] = min(level, 15)
+
+  def set_bitmap(self, x, y, stepx, stepy, bitmap):
+    for bit in range(8):
+      self.set_level(x + bit * stepx, y + bit * stepy, 15 if (bitmap >> bit) & 1 else 0)
+
+  def set_levels(self, x, y, stepx, stepy, payload, offset):
+    for index in range(8):
+      self.set_level(x + index * stepx, y + index * stepy, payload[offset + index])
+
+  def process_led_off(self, payload, offset):
+    self.set_level(payload[offset], payload[offset + 1], 0)
+
+  def process_led_on(self, payload, offset):
+    self.set_level(payload[offset], payload[offset + 1], 15)
+
+  def process_all_off(self, payload, offset):
+    self.levels[:] = bytes(len(self.levels))
+
+  def process_all_on(self, payload, offset):
+    self.levels[:] = b"\x0f" * len(self.levels)
+
+  def process_map(self, payload, offset):
+    x, y = payload[offset], payload[offset + 1]
+    for row in range(8):
+      self.set_bitmap(x, y + row, 1, 0, payload[offset + 2 + row])
+
+  def process_row(self, payload, offset):
+    self.set_bitmap(payload[offset], payload[offset + 1], 1, 0, payload[offset + 2])
+
+  def process_col(self, payload, offset):
+    self.set_bitmap(payload[offset], payload[offset + 1], 0, 1, payload[offset + 2])
+
+  def process_intensity(self, payload, offset):
+    self.intensity = payload[offset]
+
+  def process_led_level(self, payload, offset):
+    self.set_level(payload[offset], payload[offset + 1], payload[offset + 2])
+
+  def process_all_level(self, payload, offset):
+    self.levels[:] = bytes((min(payload[offset], 15),)) * len(self.levels)
+
+  def process_map_level(self, payload, offset):
+    x, y = payload[offset], payload[offset + 1]
+    for row in range(8):
+      self.set_levels(x, y + row, 1, 0, payload, offset + 2 + row * 8)
+
+  def process_row_level(self, payload, offset):
+    self.set_levels(payload[offset], payload[offset + 1], 1, 0, payload, offset + 2)
+
+  def process_col_level(self, payload, offset):
+    self.set_levels(payload[offset], payload[offset + 1], 0, 1, payload, offset + 2)
+
+# -----------
+# An arc that keeps the levels of its rings and sends turns and pushes of its encoders
+# -----------
+
+
+class VirtualArc(VirtualDevice):
+  def __init__(self, encoders=4, deviceid="m0000101", firmware="virtual", quirks=(), replydelay=0):
+    self.encoders = encoders
+    self.rings = [bytearray(pyserialoscprotocol.RING_SIZE) for _ in range(encoders)]
+    super().__init__(deviceid, firmware, quirks, replydelay)
+
+  def frame_handlers(self):
+    # Arcs do not know the size query and ignore it
+    return ((0x05, lambda payload, offset: None),
+            (0x90, self.process_ring_set),
+            (0x91, self.process_ring_all),
+            (0x92, self.process_ring_map),
+            (0x93, self.process_ring_range))
+
+  def turn(self, n, delta):
+    self.write(bytes((0x50, n, delta & 0xFF)))
+
+  def push(self, n):
+    self.write(bytes((0x52, n)))
+
+  def release(self, n):
+    self.write(bytes((0x51, n)))
+
+  def level(self, n, x):
+    return self.rings[n][x]
+
+  def process_info_request(self, payload, offset):
+    self.reply(bytes((0x00, 0x05, self.encoders)))
+
+  def set_level(self, n, x, level):
+    if (0 <= n < self.encoders):
+      self.rings[n][x % pyserialoscprotocol.RING_SIZE] = min(level, 15)
+
+  def process_ring_set(self, payload, offset):
+    self.set_level(payload[offset], payload[offset + 1], payload[offset + 2])
+
+  def process_ring_all(self, payload, offset):
+    for x in range(pyserialoscprotocol.RING_SIZE):
+      self.set_level(payload[offset], x, payload[offset + 1])
+
+  def process_ring_map(self, payload, offset):
+    levels = pyserialoscprotocol.unpack_levels(payload[offset + 1:offset + 33])
+    for (x, level) in enumerate(levels):
+      self.set_level(payload[offset], x, level)
+
+  def process_ring_range(self, payload, offset):
+    first, last = payload[offset + 1], payload[offset + 2]
+    for x in range(first, first + (last - first) % pyserialoscprotocol.RING_SIZE + 1):
+      self.set_level(payload[offset], x, payload[offset + 3])
+
+
+# -----------
+# Main entry point, runs virtual grids until stopped and prints their ports, one per line
+# -----------
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.description = "Virtual monome grids behind pseudo terminals, for trying out and benchmarking pyserialoscd without hardware (posix only). Use the printed ports with --onlytheseserialports"
+  parser.add_argument("--count", default=1, type=int,
+                      help="How many grids to run")
+  parser.add_argument("--width", default=16, type=int,
+                      help="The number of columns of each grid")
+  parser.add_argument("--height", default=8, type=int,
+                      help="The number of rows of each grid")
+  parser.add_argument("--quirks", nargs="*", default=[],
+                      help="Firmware quirks the grids should have. Any of: " + ", ".join(QUIRKS))
+  parser.add_argument("--replydelay", default=0, type=float,
+                      help="How many seconds the grids take to answer a query")
+  parser.add_argument("--keyrate", default=0, type=float,
+                      help="If set, every grid presses and releases keys this many times per second")
+  parser.add_argument("--loglevel", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                      default="WARNING", help="The output log level, e.g. ERROR, WARNING, INFO, DEBUG")
+  args = parser.parse_args()
+  for quirk in args.quirks:
+    if (quirk not in QUIRKS):
+      parser.error("Unknown quirk: {}".format(quirk))
+
+  logging.getLogger().setLevel(args.loglevel)
+
+  grids = []
+  for number in range(args.count):
+    grid = VirtualGrid(args.width, args.height, "v{:07d}".format(number + 1),
+                       quirks=args.quirks, replydelay=args.replydelay)
+    print(grid.start())
+    grids.append(grid)
+  sys.stdout.flush()
+
+  try:
+    keypress = 0
+    while (True):
+      if (not args.keyrate):
+        time.sleep(1)
+        continue
+      # Half of the events are presses and half releases, walking over the whole grid
+      x, y = (keypress // 2) % args.width, (keypress // 2 // args.width) % args.height
+      for grid in grids:
+        if (keypress % 2):
+          grid.release(x, y)
+        else:
+          grid.press(x, y)
+      keypress += 1
+      time.sleep(0.5 / args.keyrate)
+  except KeyboardInterrupt:
+    pass
+  finally:
+    for grid in grids:
+      grid.stop()
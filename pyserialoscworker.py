@@ -0,0 +1,374 @@
+import logging
+import multiprocessing
+import time
+from itertools import count
+from threading import Thread, Lock, Event
+import pyserialoscdevice
+
+# Seconds between the health reports of a worker, with whether each device is alive and its metrics
+HEALTH_INTERVAL = 1
+# A worker that crashes more often than this within RESTART_PERIOD seconds is given up on
+MAX_RESTARTS = 3
+RESTART_PERIOD = 60
+# Seconds a worker gets to answer, on top of what the device itself may take. Includes starting the process
+CALL_TIMEOUT = 5
+# What the supervisor may ask a device in a worker to do
+COMMANDS = ("probe", "start", "start_from_cache", "validate", "apply_settings", "stop")
+
+# -----------
+# The worker process: runs its devices like the main process would, and answers the supervisor over a pipe
+# -----------
+
+
+class WorkerHost:
+  def __init__(self, connection, deviceoptions):
+    super().__init__()
+    self.connection = connection
+    self.deviceoptions = deviceoptions
+    # serialport: SerialOscDeviceEndpoint
+    self.devices = {}
+    # Serial ports of the devices that are started, only those report their health
+    self.running = frozenset()
+    self.__sendlock = Lock()
+    self.__stopevent = Event()
+
+  def send(self, *message):
+    try:
+      with self.__sendlock:
+        self.connection.send(message)
+    except (OSError, ValueError):
+      # The supervisor is gone, the read loop notices as well
+      pass
+
+  def run(self):
+    Thread(target=self.healthloop, daemon=True).start()
+    try:
+      while (True):
+        callid, serialport, command, arguments = self.connection.recv()
+        if (command == "exit"):
+          break
+        if (command == "create"):
+          # In order, so whatever comes next for the device finds it
+          self.create_device(serialport, arguments)
+        elif (command in COMMANDS):
+          # Each in its own thread, so probing one device does not hold up the others
+          Thread(target=self.call, args=(callid, serialport, command, arguments), daemon=True).start()
+    except (EOFError, OSError):
+      pass
+    finally:
+      self.__stopevent.set()
+      for device in list(self.devices.values()):
+        device.stop()
+
+  def create_device(self, serialport, options):
+    olddevice = self.devices.pop(serialport, None)
+    if (olddevice is not None):
+      olddevice.stop()
+    device = pyserialoscdevice.SerialOscDeviceEndpoint(serialport, **dict(self.deviceoptions, **options))
+    device.onsettingschanged = self.report_settings
+    self.devices[serialport] = device
+
+  def call(self, callid, serialport, command, arguments):
+    device = self.devices.get(serialport)
+    if (device is None):
+      self.send("error", callid, "No device at {}".format(serialport))
+      return
+    try:
+      result = getattr(device, command)(*arguments)
+    except Exception as e:
+      logging.warning("%s of device at %s failed, Exception was %s", command, serialport, e)
+      self.send("error", callid, str(e))
+      return
+    if (command in ("start", "start_from_cache") and result):
+      self.running = self.running.union((serialport,))
+    elif (command == "stop"):
+      self.running = self.running.difference((serialport,))
+      if (self.devices.get(serialport) is device):
+        del self.devices[serialport]
+    self.send("result", callid, result, self.describe(device))
+
+  def describe(self, device):
+    return {"id": device.id, "type": device.type, "size": list(device.size), "rings": device.rings,
+            "friendlyname": device.friendlyname, "cacheentry": device.get_cache_entry()}
+
+  def report_settings(self, device):
+    self.send("settings", device.serialport, device.get_cache_entry())
+
+  def healthloop(self):
+    while (not self.__stopevent.wait(HEALTH_INTERVAL)):
+      for serialport in self.running:
+        device = self.devices.get(serialport)
+        if (device is not None):
+          self.send("health", serialport, device.is_alive(), device.get_metrics())
+
+
+def run_worker(connection, deviceoptions, loglevel):
+  # The entry point of the worker process
+  logging.getLogger().setLevel(loglevel)
+  WorkerHost(connection, deviceoptions).run()
+
+# -----------
+# The supervisor side of one worker process, shared by all devices running in it.
+# Restarts the process if it crashes, with the devices it ran
+# -----------
+
+
+class WorkerProcess:
+  def __init__(self, name, deviceoptions):
+    super().__init__()
+    self.name = name
+    self.deviceoptions = deviceoptions
+    # serialport: DeviceWorkerProxy
+    self.devices = {}
+    self.running = False
+    self.restarts = 0
+    self.process = None
+    self.__restarttimes = []
+    self.__connection = None
+    self.__sendlock = Lock()
+    # callid: (event set once answered, list the answer goes into)
+    self.__calls = {}
+    self.__callids = count()
+
+  def start(self):
+    # A fresh interpreter rather than a fork, which would copy the threads' locks in whatever state they are
+    context = multiprocessing.get_context("spawn")
+    connection, workerconnection = context.Pipe()
+    process = context.Process(target=run_worker, name=self.name, daemon=True,
+                              args=(workerconnection, self.deviceoptions, logging.getLogger().level))
+    process.start()
+    workerconnection.close()
+    self.__connection = connection
+    self.process = process
+    self.running = True
+    Thread(target=self.readloop, args=(connection, process), daemon=True).start()
+    logging.debug("Started worker %s as process %s", self.name, process.pid)
+
+  def stop(self):
+    if (not self.running):
+      return
+    self.running = False
+    self.post(None, "exit")
+    self.process.join(CALL_TIMEOUT)
+    if (self.process.is_alive()):
+      logging.warning("Worker %s did not stop, terminating it", self.name)
+      self.process.terminate()
+      self.process.join(1)
+
+  def add(self, proxy, options):
+    self.devices[proxy.serialport] = proxy
+    self.post(proxy.serialport, "create", options)
+
+  def remove(self, proxy):
+    if (self.devices.get(proxy.serialport) is not proxy):
+      return
+    self.call(proxy.serialport, "stop")
+    del self.devices[proxy.serialport]
+    if (not self.devices):
+      # Nothing left to run, the next device gets a new worker
+      self.stop()
+
+  def post(self, serialport, command, arguments=()):
+    return self.__send((None, serialport, command, arguments))
+
+  def call(self, serialport, command, arguments=(), timeout=CALL_TIMEOUT):
+    # The result and the state of the device afterwards, or None if the worker failed to answer
+    callid = next(self.__callids)
+    answered = Event()
+    answer = []
+    self.__calls[callid] = (answered, answer)
+    if (not self.__send((callid, serialport, command, arguments)) or not answered.wait(timeout) or not answer):
+      self.__calls.pop(callid, None)
+      logging.warning("Worker %s did not answer %s for %s", self.name, command, serialport)
+      return None
+    if (answer[0][0] == "error"):
+      logging.warning("Worker %s failed %s for %s: %s", self.name, command, serialport, answer[0][2])
+      return None
+    return answer[0][2:]
+
+  def __send(self, message):
+    try:
+      with self.__sendlock:
+        self.__connection.send(message)
+      return True
+    except (OSError, ValueError, AttributeError):
+      return False
+
+  def readloop(self, connection, process):
+    try:
+      while (True):
+        message = connection.recv()
+        if (message[0] in ("result", "error")):
+          answered, answer = self.__calls.pop(message[1], (None, None))
+          if (answered is not None):
+            answer.append(message)
+            answered.set()
+          continue
+        proxy = self.devices.get(message[1])
+        if (proxy is not None):
+          proxy.on_worker_message(message)
+    except (EOFError, OSError):
+      pass
+    connection.close()
+    process.join(1)
+    if (process is not self.process):
+      return
+    # Whoever waits for an answer from this process won't get one
+    for (answered, answer) in list(self.__calls.values()):
+      answered.set()
+    self.__calls = {}
+    if (self.running):
+      self.restart(process.exitcode)
+
+  def restart(self, exitcode):
+    now = time.monotonic()
+    self.__restarttimes = [restarttime for restarttime in self.__restarttimes
+                           if now - restarttime < RESTART_PERIOD] + [now]
+    if (len(self.__restarttimes) > MAX_RESTARTS):
+      logging.error("Worker %s crashed %s times within %s seconds, giving up on %s",
+                    self.name, len(self.__restarttimes), RESTART_PERIOD, ", ".join(self.devices))
+      self.running = False
+      return
+    # Devices that were still being probed are left out, they get probed again like any new device
+    self.devices = {serialport: proxy for (serialport, proxy) in self.devices.items() if proxy.started}
+    if (not self.devices):
+      self.running = False
+      return
+    logging.warning("Worker %s running %s stopped with exit code %s, restarting it",
+                    self.name, ", ".join(self.devices), exitcode)
+    self.start()
+    for proxy in list(self.devices.values()):
+      proxy.restart()
+    self.restarts += 1
+
+# -----------
+# Stands in for a SerialOscDeviceEndpoint running in a worker process, as far as the main endpoint is concerned
+# -----------
+
+
+class DeviceWorkerProxy:
+  def __init__(self, serialport, worker, destinationport=12222, probetimeout=2):
+    super().__init__()
+    self.serialport = serialport
+    self.worker = worker
+    self.probetimeout = probetimeout
+    self.destinationport = destinationport
+    self.id = "unknown"
+    self.type = "unknown"
+    self.size = [0, 0]
+    self.rings = 0
+    self.friendlyname = "unknown"
+    self.host = None
+    self.port = None
+    self.started = False
+    self.alive = True
+    # As last reported by the worker
+    self.samples = []
+    self.cacheentry = None
+    # Called with the device whenever a /sys setting changes, so it can be remembered
+    self.onsettingschanged = None
+    worker.add(self, {"destinationport": destinationport})
+
+  def is_alive(self):
+    return self.alive and self.worker.running
+
+  def get_metrics(self):
+    return self.samples + [("worker_restarts_total", (), self.worker.restarts)]
+
+  def get_cache_entry(self):
+    return dict(self.cacheentry)
+
+  def call(self, command, *arguments, timeout=CALL_TIMEOUT):
+    answer = self.worker.call(self.serialport, command, arguments, timeout)
+    if (answer is None):
+      return None
+    result, state = answer
+    self.id = state["id"]
+    self.type = state["type"]
+    self.size = state["size"]
+    self.rings = state["rings"]
+    self.friendlyname = state["friendlyname"]
+    self.cacheentry = state["cacheentry"]
+    return result
+
+  def probe(self):
+    if (self.call("probe", timeout=self.probetimeout + CALL_TIMEOUT)):
+      return True
+    # Nothing runs for a port without a device
+    self.stop()
+    return False
+
+  def validate(self):
+    return bool(self.call("validate", timeout=self.probetimeout + CALL_TIMEOUT))
+
+  def apply_settings(self, settings):
+    self.call("apply_settings", settings)
+
+  def start(self, ip, port):
+    self.host = ip
+    self.port = port
+    self.started = bool(self.call("start", ip, port, timeout=self.probetimeout + CALL_TIMEOUT))
+    return self.started
+
+  def start_from_cache(self, ip, port, cacheentry):
+    self.host = ip
+    self.port = port
+    self.started = bool(self.call("start_from_cache", ip, port, cacheentry))
+    return self.started
+
+  def restart(self):
+    # In a new worker, on the same port with the last known settings, so applications keep talking to it
+    self.worker.add(self, {"destinationport": self.destinationport})
+    if (not self.started):
+      return
+    self.samples = []
+    if (not self.start_from_cache(self.host, self.port, self.cacheentry)):
+      logging.error("Could not restart device %s at %s in worker %s", self.id, self.serialport, self.worker.name)
+      self.alive = False
+
+  def stop(self):
+    self.started = False
+    self.worker.remove(self)
+
+  def on_worker_message(self, message):
+    if (message[0] == "health"):
+      self.alive = message[2]
+      self.samples = message[3]
+    elif (message[0] == "settings"):
+      self.cacheentry = message[2]
+      if (self.onsettingschanged is not None):
+        self.onsettingschanged(self)
+
+# -----------
+# Spreads devices over a number of worker processes, one per device as long as there are enough
+# -----------
+
+
+class DeviceWorkerPool:
+  def __init__(self, maxworkers, deviceoptions={}):
+    super().__init__()
+    self.maxworkers = maxworkers
+    self.deviceoptions = dict(deviceoptions)
+    self.probetimeout = self.deviceoptions.get("probetimeout", 2)
+    self.workers = []
+    self.__lock = Lock()
+    self.__workernumbers = count(1)
+
+  def create_device(self, serialport, destinationport):
+    with self.__lock:
+      # Workers without devices have stopped, and those given up on are no use either
+      self.workers = [worker for worker in self.workers if worker.running]
+      if (len(self.workers) < self.maxworkers):
+        worker = WorkerProcess("pyserialoscworker-{}".format(next(self.__workernumbers)), self.deviceoptions)
+        worker.start()
+        self.workers.append(worker)
+      else:
+        worker = min(self.workers, key=lambda worker: len(worker.devices))
+      return DeviceWorkerProxy(serialport, worker, destinationport, self.probetimeout)
+
+  def stop(self):
+    with self.__lock:
+      workers = self.workers
+      self.workers = []
+    for worker in workers:
+      worker.stop()